@@ -3,7 +3,7 @@ import numpy as np
 from unidecode import unidecode
 import streamlit as st
 import plotly.express as px
-from io import BytesIO
+from processamento import ler_planilha, normalizar_nomes, aba_exportacao, exportar_em_bytes, condicoes_por_cid
 
 # ---------------------------
 # 1. Configuração do Streamlit
@@ -18,18 +18,12 @@ uploaded_file = st.file_uploader("Escolha o arquivo .xltx", type="xltx")
 
 if uploaded_file is not None:
     # Leitura das abas
-    utilizacao = pd.read_excel(uploaded_file, sheet_name='Utilizacao')
-    cadastro = pd.read_excel(uploaded_file, sheet_name='Cadastro')
-    
-    try:
-        medicina_trabalho = pd.read_excel(uploaded_file, sheet_name='Medicina_do_Trabalho')
-    except:
-        medicina_trabalho = pd.DataFrame()
-        
-    try:
-        atestados = pd.read_excel(uploaded_file, sheet_name='Atestados')
-    except:
-        atestados = pd.DataFrame()
+    # Abre o arquivo uma única vez e lê todas as abas (opcionais ausentes viram DataFrames vazios)
+    abas, _ = ler_planilha(uploaded_file)
+    utilizacao = abas['Utilizacao']
+    cadastro = abas['Cadastro']
+    medicina_trabalho = abas['Medicina_do_Trabalho']
+    atestados = abas['Atestados']
     
     # ---------------------------
     # 3. Padronização de colunas
@@ -215,11 +209,9 @@ if uploaded_file is not None:
         st.subheader("⚠️ Inconsistências")
         inconsistencias = pd.DataFrame()
         if sexo_col and 'Codigo_do_CID' in utilizacao_filtrada.columns:
-            def padronizar_nome(nome):
-                return unidecode(str(nome)).strip().upper()
-            
-            utilizacao_filtrada['Nome_merge'] = utilizacao_filtrada['Nome_do_Associado'].apply(padronizar_nome)
-            cadastro_filtrado['Nome_merge'] = cadastro_filtrado['Nome_do_Associado'].apply(padronizar_nome)
+            # Normaliza cada nome distinto uma única vez (em vez de apply linha a linha)
+            utilizacao_filtrada['Nome_merge'] = normalizar_nomes(utilizacao_filtrada['Nome_do_Associado'])
+            cadastro_filtrado['Nome_merge'] = normalizar_nomes(cadastro_filtrado['Nome_do_Associado'])
             
             utilizacao_merge = utilizacao_filtrada.merge(
                 cadastro_filtrado[['Nome_merge', sexo_col]].drop_duplicates(),
@@ -245,9 +237,9 @@ if uploaded_file is not None:
     # ---------------------------
     with tab4:
         st.subheader("🏥 Beneficiários Crônicos")
-        cids_cronicos = ['E11','I10','J45']
         if 'Codigo_do_CID' in utilizacao_filtrada.columns:
-            utilizacao_filtrada['Cronico'] = utilizacao_filtrada['Codigo_do_CID'].isin(cids_cronicos)
+            # Mesmo catálogo de condições crônicas (por prefixo de CID) do dashboard principal
+            utilizacao_filtrada['Cronico'] = condicoes_por_cid(utilizacao_filtrada)['codigos'] >= 0
             beneficiarios_cronicos = utilizacao_filtrada[utilizacao_filtrada['Cronico']].groupby('Nome_do_Associado')['Valor'].sum()
             st.dataframe(beneficiarios_cronicos.reset_index().rename(columns={'Nome_do_Associado':'Nome do Associado','Valor':'Valor'}))
         
@@ -261,15 +253,13 @@ if uploaded_file is not None:
     # ---------------------------
     with tab5:
         st.subheader("📤 Exportar Relatório")
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            utilizacao_filtrada.to_excel(writer, sheet_name='Utilizacao', index=False)
-            cadastro_filtrado.to_excel(writer, sheet_name='Cadastro', index=False)
-            if not medicina_trabalho.empty:
-                medicina_trabalho.to_excel(writer, sheet_name='Medicina_do_Trabalho', index=False)
-            if not atestados.empty:
-                atestados.to_excel(writer, sheet_name='Atestados', index=False)
-        st.download_button("📥 Baixar Relatório Completo", buffer, "dashboard_plano_saude.xlsx", "application/vnd.ms-excel")
+        # O arquivo só é gerado quando o usuário clica em baixar, em modo de memória constante
+        abas_export = [aba_exportacao('Utilizacao', utilizacao_filtrada), aba_exportacao('Cadastro', cadastro_filtrado)]
+        if not medicina_trabalho.empty:
+            abas_export.append(aba_exportacao('Medicina_do_Trabalho', medicina_trabalho))
+        if not atestados.empty:
+            abas_export.append(aba_exportacao('Atestados', atestados))
+        st.download_button("📥 Baixar Relatório Completo", lambda: exportar_em_bytes(abas_export), "dashboard_plano_saude.xlsx", "application/vnd.ms-excel")
 
     st.success("✅ Dashboard carregado com sucesso!")
 else:
@@ -0,0 +1,117 @@
+"""Pipeline em lote (sem interface): ingestão -> filtros -> agregados -> exportação.
+
+Processa todos os .xlsx/.xltx de uma pasta em paralelo (um processo por
+arquivo) e grava, para cada um, o mesmo relatório filtrado da aba
+"📤 Exportação" do dashboard e uma planilha de agregados.
+
+Exemplo:
+    python pipeline_lote.py entradas/ saidas/ --plano "Plano A" --inicio 2024-01-01 --fim 2024-12-31
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from processamento import (preparar_dados, construir_indices, aplicar_filtros, construir_cubo, agregar_cubo,
+                           exportar_relatorio, exportar_agregados, em_reais, EXTENSOES_EXPORTACAO)
+
+EXTENSOES = ('.xlsx', '.xltx')
+
+
+def processar_arquivo(caminho, pasta_saida, filtros, formato='xlsx'):
+    """Roda o pipeline completo para um arquivo e retorna um resumo (executado no processo filho)."""
+    inicio = time.perf_counter()
+    nome = os.path.splitext(os.path.basename(caminho))[0]
+    with open(caminho, 'rb') as f:
+        dados = construir_indices(preparar_dados(f.read()), interface=False)
+
+    mask_cad, mask_util = aplicar_filtros(dados, **filtros)
+    utilizacao_filtrada = dados['utilizacao'][mask_util]
+    cadastro_filtrado = dados['cadastro'][mask_cad]
+    cubo = construir_cubo(dados['utilizacao'], mask_util, dados['dimensoes_cubo'])
+
+    exportar_relatorio(os.path.join(pasta_saida, f'{nome}_filtrado.{EXTENSOES_EXPORTACAO[formato]}'),
+                       utilizacao_filtrada, cadastro_filtrado, dados['medicina_trabalho'], dados['atestados'], formato)
+    exportar_agregados(os.path.join(pasta_saida, f'{nome}_agregados.xlsx'),
+                       cubo, dados['dimensoes_cubo'], dados['beneficiarios'])
+
+    totais = agregar_cubo(cubo)
+    return {
+        'arquivo': os.path.basename(caminho),
+        'atendimentos': int(totais['Volume']),
+        'valor': float(em_reais(totais['Valor'])),
+        'beneficiarios': len(cadastro_filtrado),
+        'segundos': round(time.perf_counter() - inicio, 2),
+        'erro': '',
+    }
+
+
+def listar_arquivos(pasta_entrada):
+    """Planilhas da pasta de entrada (ignora arquivos temporários do Excel, '~$...')."""
+    return sorted(
+        os.path.join(pasta_entrada, nome) for nome in os.listdir(pasta_entrada)
+        if nome.lower().endswith(EXTENSOES) and not nome.startswith('~$')
+    )
+
+
+def montar_filtros(args):
+    """Traduz os argumentos da linha de comando para os parâmetros de aplicar_filtros."""
+    filtros = {
+        'sexo': args.sexo,
+        'tipo_beneficiario': args.tipo,
+        'plano': args.plano,
+        'municipio': args.municipio,
+    }
+    if args.idade_min is not None or args.idade_max is not None:
+        filtros['faixa_etaria'] = (args.idade_min or 0, args.idade_max if args.idade_max is not None else 200)
+    if args.inicio or args.fim:
+        filtros['periodo'] = (pd.Timestamp(args.inicio or '1900-01-01'), pd.Timestamp(args.fim or '2262-01-01'))
+    return filtros
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Processa em lote as planilhas do plano de saúde.")
+    parser.add_argument('entrada', help="pasta com os arquivos .xlsx/.xltx")
+    parser.add_argument('saida', help="pasta onde os relatórios serão gravados")
+    parser.add_argument('--sexo', nargs='+', help="valores de sexo a manter (padrão: todos)")
+    parser.add_argument('--tipo', nargs='+', help="Titular e/ou Dependente (padrão: todos)")
+    parser.add_argument('--plano', nargs='+', help="planos a manter (padrão: todos)")
+    parser.add_argument('--municipio', nargs='+', help="municípios a manter (padrão: todos)")
+    parser.add_argument('--idade-min', type=int)
+    parser.add_argument('--idade-max', type=int)
+    parser.add_argument('--inicio', help="data inicial do atendimento (AAAA-MM-DD)")
+    parser.add_argument('--fim', help="data final do atendimento (AAAA-MM-DD)")
+    parser.add_argument('--formato', choices=list(EXTENSOES_EXPORTACAO), default='xlsx',
+                        help="formato do relatório filtrado (csv/parquet geram um .zip com um arquivo por aba)")
+    parser.add_argument('--processos', type=int, default=os.cpu_count(), help="processos em paralelo (padrão: nº de CPUs)")
+    args = parser.parse_args(argv)
+
+    arquivos = listar_arquivos(args.entrada)
+    if not arquivos:
+        print(f"Nenhuma planilha encontrada em {args.entrada}", file=sys.stderr)
+        return 1
+    os.makedirs(args.saida, exist_ok=True)
+    filtros = montar_filtros(args)
+
+    resumos = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.processos, len(arquivos)))) as executor:
+        futuros = {executor.submit(processar_arquivo, caminho, args.saida, filtros, args.formato): caminho for caminho in arquivos}
+        for futuro in as_completed(futuros):
+            try:
+                resumo = futuro.result()
+            except Exception as e:  # um arquivo com problema não interrompe o lote
+                resumo = {'arquivo': os.path.basename(futuros[futuro]), 'erro': str(e)}
+            resumos.append(resumo)
+            print(f"{resumo['arquivo']}: {resumo['erro'] or 'ok'}", file=sys.stderr)
+
+    resumo = pd.DataFrame(resumos).sort_values('arquivo')
+    resumo.to_csv(os.path.join(args.saida, 'resumo_lote.csv'), index=False)
+    print(resumo.to_string(index=False))
+    return 1 if resumo['erro'].astype(bool).any() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
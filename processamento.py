@@ -0,0 +1,2287 @@
+"""Ingestão e preparação dos dados do plano de saúde.
+
+Funções puras (sem Streamlit) usadas pelo dashboard para transformar o
+arquivo enviado em DataFrames limpos e tipados.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from io import BytesIO, TextIOWrapper
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import xlsxwriter
+from unidecode import unidecode
+
+# ---------------------------
+# 1. CONSTANTES
+# ---------------------------
+ABAS_OBRIGATORIAS = ['Utilizacao', 'Cadastro']
+ABAS_OPCIONAIS = ['Medicina_do_Trabalho', 'Atestados']
+
+# Colunas de data por aba (nomes já padronizados por clean_cols)
+DATE_COLS = {
+    'Utilizacao': ['Data_do_Atendimento', 'Competencia', 'Data_de_Nascimento'],
+    'Cadastro': ['Data_de_Nascimento', 'Data_de_Admissao_do_Empregado', 'Data_de_Adesao_ao_Plano', 'Data_de_Cancelamento'],
+    'Medicina_do_Trabalho': ['Data_do_Exame'],
+    'Atestados': ['Data_do_Afastamento'],
+}
+
+# Chave no dicionário de dados -> nome da aba no Excel
+CHAVES_ABAS = {
+    'utilizacao': 'Utilizacao',
+    'cadastro': 'Cadastro',
+    'medicina_trabalho': 'Medicina_do_Trabalho',
+    'atestados': 'Atestados',
+}
+
+# Tabelas gravadas no snapshot: as abas mais a dimensão de beneficiários
+CHAVES_SNAPSHOT = list(CHAVES_ABAS) + ['beneficiarios']
+
+# Snapshots colunares (Feather) dos arquivos já processados
+DIRETORIO_SNAPSHOTS = os.environ.get('DASHBOARD_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dados'))
+MAX_SNAPSHOTS = 12
+# Incrementar sempre que preparar_dados mudar o formato dos DataFrames (snapshots antigos são ignorados)
+VERSAO_SNAPSHOT = 7
+
+# Base histórica: utilização particionada por mês, acumulada a cada extrato mensal
+DIRETORIO_HISTORICO = os.path.join(DIRETORIO_SNAPSHOTS, 'historico')
+VERSAO_HISTORICO = 2
+# Colunas que identificam um atendimento (as que existirem na aba) para descartar reenvios
+COLUNAS_CHAVE_ATENDIMENTO = ['Nome_do_Associado', 'Data_do_Atendimento', 'Competencia', 'Codigo_do_Procedimento',
+                             'Nome_do_Procedimento', 'Codigo_do_CID', 'Valor']
+
+# Textos de valor com mais caracteres que isto são contados como inválidos
+LARGURA_MAXIMA_MOEDA = 30
+
+# Colunas monetárias: guardadas e somadas em centavos (Int64); viram reais só na exibição e na exportação
+COLUNAS_MONETARIAS = ['Valor']
+
+# Exportação em blocos de linhas (memória constante) e extensão do arquivo por formato
+LINHAS_POR_BLOCO = 50_000
+EXTENSOES_EXPORTACAO = {'xlsx': 'xlsx', 'csv': 'zip', 'parquet': 'zip'}
+
+# Busca de beneficiários: nº máximo de resultados e tamanho mínimo da palavra para aceitar
+# um erro de digitação (letra a mais/menos, trocada ou invertida)
+LIMITE_RESULTADOS_BUSCA = 50
+TAMANHO_MINIMO_ERRO_BUSCA = 4
+# Último recurso da busca: similaridade mínima (fração de trigramas em comum) entre palavras
+SIMILARIDADE_MINIMA_BUSCA = 0.4
+
+# Gráficos: séries longas são reduzidas (LTTB) e barras com muitas categorias viram top-N + "Outros"
+LIMITE_PONTOS_SERIE = 500
+LIMITE_CATEGORIAS_BARRAS = 15
+
+# Regras de consistência clínica/cadastral, avaliadas juntas sobre todos os atendimentos (avaliar_regras).
+# Cada regra marca os atendimentos que satisfazem TODAS as condições presentes:
+#   'coluna' + 'prefixos'  código (CID/procedimento) começando com um dos prefixos
+#   'sexo'                 sexo do beneficiário no cadastro ('M' ou 'F')
+#   'idade_fora'           (mín, máx): idade em anos na data do atendimento fora do intervalo
+#   'condicao'             coluna booleana da tabela de atendimentos ('apos_cancelamento', 'antes_adesao', 'duplicado')
+_FEMININOS = ([f'C{i}' for i in range(51, 59)] + ['D06', 'D25', 'D26', 'D27', 'D28']
+              + [f'N{i}' for i in range(70, 99)] + ['Z32', 'Z33', 'Z34', 'Z35', 'Z36', 'Z37', 'Z39'])
+_MASCULINOS = ['C60', 'C61', 'C62', 'C63', 'D29'] + [f'N{i}' for i in range(40, 52)]
+REGRAS_CONSISTENCIA = [
+    {'regra': 'CID de gravidez/parto (O00-O99) em paciente masculino', 'coluna': 'Codigo_do_CID', 'prefixos': ['O'], 'sexo': 'M'},
+    {'regra': 'CID exclusivo do sexo feminino em paciente masculino', 'coluna': 'Codigo_do_CID', 'prefixos': _FEMININOS, 'sexo': 'M'},
+    {'regra': 'CID exclusivo do sexo masculino em paciente feminino', 'coluna': 'Codigo_do_CID', 'prefixos': _MASCULINOS, 'sexo': 'F'},
+    {'regra': 'CID de gravidez/parto fora da idade fértil (10 a 55 anos)', 'coluna': 'Codigo_do_CID', 'prefixos': ['O'], 'idade_fora': (10, 55)},
+    {'regra': 'CID perinatal (P00-P96) após o primeiro ano de vida', 'coluna': 'Codigo_do_CID', 'prefixos': ['P'], 'idade_fora': (0, 1)},
+    {'regra': 'Hiperplasia/câncer de próstata antes dos 30 anos', 'coluna': 'Codigo_do_CID', 'prefixos': ['N40', 'C61'], 'idade_fora': (30, 150)},
+    {'regra': 'Demência/Alzheimer antes dos 30 anos', 'coluna': 'Codigo_do_CID', 'prefixos': ['F00', 'F01', 'F03', 'G30'], 'idade_fora': (30, 150)},
+    {'regra': 'Atendimento após o cancelamento do plano', 'condicao': 'apos_cancelamento'},
+    {'regra': 'Atendimento antes da adesão ao plano', 'condicao': 'antes_adesao'},
+    {'regra': 'Cobrança duplicada (mesmo beneficiário, código, data e valor)', 'condicao': 'duplicado'},
+]
+# Cobranças duplicadas: mesmo beneficiário e código cobrados de novo dentro desta janela (dias)
+JANELA_DUPLICIDADE_DIAS = 7
+
+# Escore robusto de anomalia (mediana/MAD por coorte): faixas etárias da ANS, coorte mínima e limiar padrão
+FAIXAS_ETARIAS = [0, 19, 24, 29, 34, 39, 44, 49, 54, 59]
+TAMANHO_MINIMO_COORTE = 5
+LIMIAR_ESCORE_ANOMALIA = 3.5
+
+# Uso frequente: janelas móveis (dias) e nº de atendimentos no pico que gera o alerta, por nível
+JANELAS_UTILIZACAO = [7, 30, 90]
+LIMITES_USO_FREQUENTE = {
+    'beneficiario': {7: 6, 30: 15, 90: 30},
+    'procedimento': {7: 3, 30: 5, 90: 10},
+}
+
+# Catálogo de condições crônicas: condição -> prefixos de CID-10 (o prefixo mais longo vence).
+# Pode ser substituído por um JSON no mesmo formato apontado por DASHBOARD_CATALOGO_CRONICOS.
+CATALOGO_CRONICOS = {
+    'Diabetes': ['E10', 'E11', 'E12', 'E13', 'E14'],
+    'Hipertensão': ['I10', 'I11', 'I12', 'I13', 'I15'],
+    'Doença isquêmica do coração': ['I20', 'I21', 'I22', 'I23', 'I24', 'I25'],
+    'Insuficiência cardíaca': ['I50'],
+    'Fibrilação/flutter atrial': ['I48'],
+    'Doença cerebrovascular': [f'I{i}' for i in range(60, 70)],
+    'Asma': ['J45', 'J46'],
+    'DPOC': ['J40', 'J41', 'J42', 'J43', 'J44', 'J47'],
+    'Doença renal crônica': ['N18', 'N19'],
+    'Obesidade': ['E66'],
+    'Dislipidemia': ['E78'],
+    'Hipotireoidismo': ['E01', 'E02', 'E03'],
+    'Câncer': [f'C{i:02d}' for i in range(0, 98)] + [f'D0{i}' for i in range(0, 10)],
+    'Depressão': ['F32', 'F33', 'F341'],
+    'Ansiedade': ['F40', 'F41'],
+    'Transtorno bipolar': ['F31'],
+    'Esquizofrenia e psicoses': [f'F{i}' for i in range(20, 30)],
+    'Demência/Alzheimer': ['F00', 'F01', 'F02', 'F03', 'G30'],
+    'Parkinson': ['G20'],
+    'Epilepsia': ['G40', 'G41'],
+    'Esclerose múltipla': ['G35'],
+    'HIV/AIDS': ['B20', 'B21', 'B22', 'B23', 'B24', 'Z21'],
+    'Hepatite crônica/cirrose': ['B18', 'K70', 'K74'],
+    'Doença inflamatória intestinal': ['K50', 'K51'],
+    'Artrite reumatoide': ['M05', 'M06'],
+    'Lúpus': ['M32'],
+    'Artrose': ['M15', 'M16', 'M17', 'M18', 'M19'],
+    'Osteoporose': ['M80', 'M81', 'M82'],
+}
+ARQUIVO_CATALOGO_CRONICOS = os.environ.get('DASHBOARD_CATALOGO_CRONICOS')
+
+# Códigos do cadastro de sexo na tabela de atendimentos (0 = não informado)
+CODIGOS_SEXO = {'M': 1, 'F': 2}
+
+# Colunas auxiliares criadas na ingestão: não aparecem em telas nem exportações
+COLUNAS_INTERNAS = ['Nome_norm', 'ID_Beneficiario']
+
+# Otimização de tipos: texto com até esta fração de valores distintos vira categórico
+LIMITE_CARDINALIDADE_CATEGORIA = 0.5
+
+# Dicas de tipo por aba: códigos são sempre texto (evita '10101012' virar int e 'O80' misturar tipos)
+DTYPE_HINTS = {
+    'Utilizacao': {'Codigo_do_CID': 'str', 'Codigo_do_Procedimento': 'str'},
+    'Atestados': {'Codigo_do_CID': 'str'},
+}
+
+
+# ---------------------------
+# 2. FUNÇÕES DE LIMPEZA
+# ---------------------------
+def hash_arquivo(conteudo):
+    """Retorna o hash SHA-256 (hex) dos bytes do arquivo enviado."""
+    return hashlib.sha256(conteudo).hexdigest()
+
+
+def hash_arquivos(arquivos):
+    """Hash de um conjunto de arquivos [(nome, conteudo)], independente da ordem de envio."""
+    partes = sorted(f'{nome}:{hash_arquivo(conteudo)}' for nome, conteudo in arquivos)
+    return hashlib.sha256('|'.join(partes).encode('utf-8')).hexdigest()
+
+
+def clean_cols(df):
+    """Padroniza os nomes de colunas (sem acento, espaços e hífens viram '_')."""
+    df.columns = [unidecode(str(col)).strip().replace(' ', '_').replace('-', '_') for col in df.columns]
+    return df
+
+
+def converter_datas(df, aba):
+    """Converte as colunas de data conhecidas da aba para datetime64."""
+    for col in DATE_COLS.get(aba, []):
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    return df
+
+
+def detectar_formato_moeda(amostra):
+    """Decide se os textos de valor estão no padrão 'br' (1.234,56) ou 'us' (1,234.56).
+
+    Cada texto da amostra vota pelo separador decimal (último separador
+    seguido de 1 ou 2 dígitos) ou pelo separador de milhar (grupos de 3
+    dígitos sem decimais). Empate ou nenhum voto: 'us' (padrão histórico
+    dos arquivos da operadora).
+    """
+    textos = pd.Series(amostra, dtype=object).astype(str).str.replace(r'[^\d\.\,]', '', regex=True)
+    votos_br = (textos.str.fullmatch(r'[\d\.]*,\d{1,2}') | textos.str.fullmatch(r'\d{1,3}(\.\d{3})+')).sum()
+    votos_us = (textos.str.fullmatch(r'[\d,]*\.\d{1,2}') | textos.str.fullmatch(r'\d{1,3}(,\d{3})+')).sum()
+    return 'br' if votos_br > votos_us else 'us'
+
+
+def _converter_textos_moeda(textos, formato):
+    """Converte um array de textos de valor em (mantissa inteira, casas decimais, válido, vazio).
+
+    Os textos viram uma matriz de códigos de caractere (posição x texto) e os
+    dígitos são acumulados posição a posição, sem laço por valor. São aceitos
+    dígitos, os dois separadores, sinal, espaços e o prefixo opcional 'R$'. Com
+    separador de milhar, o primeiro grupo tem de 1 a 3 dígitos e os demais
+    exatamente 3 ('1.2.3' é inválido). Os textos devem ter no máximo
+    LARGURA_MAXIMA_MOEDA caracteres (a matriz tem a largura do maior).
+    """
+    textos = np.asarray(textos, dtype=np.str_)
+    largura = max(textos.dtype.itemsize // 4, 1)
+    codigos = np.ascontiguousarray(textos.view(np.uint32).reshape(len(textos), largura).T)
+    decimal, milhar = (ord(','), ord('.')) if formato == 'br' else (ord('.'), ord(','))
+
+    mantissa = np.zeros(len(textos), dtype=np.int64)
+    casas = np.zeros(len(textos), dtype=np.int64)
+    n_digitos = np.zeros(len(textos), dtype=np.int64)
+    n_decimais = np.zeros(len(textos), dtype=np.int64)
+    valido = np.ones(len(textos), dtype=bool)
+    vazio = np.ones(len(textos), dtype=bool)
+    negativo = np.zeros(len(textos), dtype=bool)
+    viu_milhar = np.zeros(len(textos), dtype=bool)
+    grupo = np.zeros(len(textos), dtype=np.int64)  # dígitos desde o último separador de milhar
+    prefixo = np.zeros(len(textos), dtype=np.int8)  # 0: antes do número, 1: logo após o 'R' do 'R$', 2: depois
+    for linha in codigos:
+        digito = (linha >= ord('0')) & (linha <= ord('9'))
+        e_decimal = linha == decimal
+        e_milhar = linha == milhar
+        branco = (linha == 0) | (linha == ord(' ')) | (linha == 0xA0)
+        sinal = linha == ord('-')
+        e_r, e_cifrao, e_mais = linha == ord('R'), linha == ord('$'), linha == ord('+')
+        valido &= digito | e_decimal | e_milhar | branco | sinal | e_mais | e_r | e_cifrao
+        # 'R$' só como prefixo opcional: antes dele, apenas brancos e sinal ('-R$ 1,00' do Excel)
+        valido &= ~(e_r & (prefixo != 0)) & ~(e_cifrao != (prefixo == 1))
+        prefixo = np.where(e_r, 1, np.where((branco | sinal | e_mais) & (prefixo == 0), 0, 2)).astype(np.int8)
+        valido &= ~(e_milhar & (n_decimais > 0))  # separador de milhar depois do decimal
+        valido &= ~(e_milhar & viu_milhar & (grupo != 3))
+        valido &= ~(e_milhar & ~viu_milhar & ((grupo < 1) | (grupo > 3)))
+        valido &= ~(e_decimal & viu_milhar & (n_decimais == 0) & (grupo != 3))
+        viu_milhar |= e_milhar
+        grupo = np.where(e_milhar, 0, grupo + digito)
+        mantissa = np.where(digito, mantissa * 10 + (linha.astype(np.int64) - ord('0')), mantissa)
+        casas += digito & (n_decimais > 0)
+        n_digitos += digito
+        n_decimais += e_decimal
+        vazio &= branco
+        negativo |= sinal
+
+    valido &= ~(viu_milhar & (n_decimais == 0) & (grupo != 3)) & (prefixo != 1)
+    valido &= (n_decimais <= 1) & (n_digitos > 0) & (n_digitos <= 18) & ~vazio
+    return np.where(negativo, -mantissa, mantissa), casas, valido, vazio
+
+
+def _mantissa_em_centavos(mantissa, casas):
+    """mantissa * 10^(2 - casas) em int64, arredondando meio para cima quando há mais de 2 casas."""
+    excesso = np.maximum(casas - 2, 0)
+    divisor = 10 ** excesso
+    return np.where(excesso > 0,
+                    np.sign(mantissa) * ((np.abs(mantissa) + divisor // 2) // divisor),
+                    mantissa * 10 ** np.maximum(2 - casas, 0))
+
+
+def _reais_em_centavos(numeros):
+    """Números em reais (float64, NaN = vazio) -> centavos inteiros (ainda em float64).
+
+    `x * 100` em float erra os meios centavos (0.285 * 100 = 28.4999...): só
+    esses valores são refeitos a partir do texto decimal mais curto do float,
+    com o mesmo arredondamento meio para cima dos textos.
+    """
+    escalados = numeros * 100
+    convertidos = np.round(escalados)
+    meios = np.abs(escalados - np.floor(escalados) - 0.5) < 1e-6
+    if meios.any():
+        textos = np.array([repr(float(v)) for v in numeros[meios]], dtype=np.str_)
+        mantissa, casas, valido, _ = _converter_textos_moeda(textos, 'us')
+        convertidos[meios] = np.where(valido, _mantissa_em_centavos(mantissa, casas), convertidos[meios])
+    return convertidos
+
+
+def converter_moeda(serie, centavos=False, formato=None):
+    """Converte uma coluna de valores monetários (texto BR/US ou números) numa só passada.
+
+    O formato dos textos é detectado por uma amostra (detectar_formato_moeda)
+    quando não é informado. Retorna (Series, nº de células preenchidas que
+    não puderam ser convertidas). A Series é float64 (NaN para vazios e
+    inválidos) ou, com `centavos=True`, Int64 em centavos (arredondamento
+    meio para cima além da 2ª casa).
+    """
+    if pd.api.types.is_numeric_dtype(serie):
+        if centavos and pd.api.types.is_integer_dtype(serie) and not serie.hasnans:
+            return pd.Series(serie.to_numpy(dtype=np.int64) * 100, index=serie.index, dtype='Int64'), 0
+        numeros = serie.to_numpy(dtype=np.float64, na_value=np.nan)
+        if centavos:
+            return pd.Series(pd.array(_reais_em_centavos(numeros), dtype='Int64'), index=serie.index), 0
+        return pd.Series(numeros, index=serie.index), 0
+
+    brutos = serie.to_numpy(dtype=object)
+    preenchido = pd.notna(brutos)
+    if pd.api.types.infer_dtype(brutos, skipna=True) == 'string':
+        e_texto = preenchido
+    else:
+        e_texto = preenchido & np.array([isinstance(v, str) for v in brutos], dtype=bool)
+    valores = np.full(len(brutos), np.nan)
+
+    # células numéricas (planilhas mistas): usadas como estão
+    outros = preenchido & ~e_texto
+    if outros.any():
+        valores[outros] = pd.to_numeric(pd.Series(brutos[outros]), errors='coerce').to_numpy(dtype=np.float64)
+    invalidos = int(np.isnan(valores[outros]).sum())
+    if centavos:
+        valores = _reais_em_centavos(valores)
+
+    textos = brutos[e_texto]
+    if len(textos):
+        formato = formato or detectar_formato_moeda(textos[:1000])
+        # Textos longos demais não são valor: ficam inválidos sem alargar a matriz de caracteres
+        curtos = pd.Series(textos, dtype=object).str.len().to_numpy() <= LARGURA_MAXIMA_MOEDA
+        mantissa = np.zeros(len(textos), dtype=np.int64)
+        casas = np.zeros(len(textos), dtype=np.int64)
+        valido = np.zeros(len(textos), dtype=bool)
+        vazio = np.zeros(len(textos), dtype=bool)
+        (mantissa[curtos], casas[curtos], valido[curtos],
+         vazio[curtos]) = _converter_textos_moeda(textos[curtos].astype(np.str_), formato)
+        vazio[~curtos] = pd.Series(textos[~curtos], dtype=object).str.strip().eq('').to_numpy(dtype=bool)
+        if centavos:
+            convertidos = _mantissa_em_centavos(mantissa, casas).astype(np.float64)
+        else:
+            convertidos = mantissa / 10.0 ** casas
+        valores[np.flatnonzero(e_texto)] = np.where(valido, convertidos, np.nan)
+        invalidos += int((~valido & ~vazio).sum())
+
+    if centavos:
+        return pd.Series(pd.array(valores, dtype='Int64'), index=serie.index), invalidos
+    return pd.Series(valores, index=serie.index), invalidos
+
+
+def converter_valor(utilizacao):
+    """Converte a coluna 'Valor' (texto em padrão BR ou US, ou números em reais) para centavos (Int64).
+
+    Retorna (utilizacao, nº de valores preenchidos que não puderam ser convertidos).
+    """
+    if 'Valor' not in utilizacao.columns:
+        return utilizacao, 0
+    utilizacao['Valor'], invalidos = converter_moeda(utilizacao['Valor'], centavos=True)
+    return utilizacao, invalidos
+
+
+def centavos(df, coluna='Valor'):
+    """Coluna monetária como array int64 de centavos (vazios = 0), pronta para somas exatas."""
+    if coluna not in df.columns:
+        return np.zeros(len(df), dtype=np.int64)
+    return df[coluna].to_numpy(dtype=np.int64, na_value=0)
+
+
+def somar_centavos(grupos, valores, n_grupos):
+    """Soma exata de centavos por grupo (códigos 0..n_grupos-1), acumulada em int64."""
+    soma = np.zeros(n_grupos, dtype=np.int64)
+    np.add.at(soma, grupos, np.asarray(valores, dtype=np.int64))
+    return soma
+
+
+def em_reais(valores):
+    """Centavos (escalar, array ou Series) -> reais (float), só para exibição e exportação."""
+    return valores / 100
+
+
+def adicionar_tipo_beneficiario(utilizacao):
+    """Deriva a coluna 'Tipo_Beneficiario' (Titular/Dependente) da aba de utilização."""
+    if 'Nome_Titular' in utilizacao.columns and 'Nome_do_Associado' in utilizacao.columns:
+        utilizacao['Tipo_Beneficiario'] = np.where(
+            utilizacao['Nome_Titular'] == utilizacao['Nome_do_Associado'],
+            'Titular', 'Dependente'
+        )
+    else:
+        utilizacao['Tipo_Beneficiario'] = 'Desconhecido'
+    return utilizacao
+
+
+@lru_cache(maxsize=200_000)
+def normalize_name(nome):
+    """Normaliza um nome para comparação (sem acentos, sem espaços nas pontas, maiúsculo).
+    Memoizada: cada nome distinto é processado pelo unidecode uma única vez."""
+    return unidecode(str(nome)).strip().upper()
+
+
+def normalizar_nomes(serie):
+    """Versão vetorizada de normalize_name para uma Series de nomes.
+
+    Normaliza apenas os valores distintos (os nomes se repetem a cada
+    atendimento) e devolve uma Series categórica alinhada à original.
+    """
+    categorica = serie.astype('category')
+    normalizados = pd.Index([normalize_name(nome) for nome in categorica.cat.categories])
+    codigos_norm, categorias_norm = pd.factorize(normalizados, sort=True)
+    codigos = categorica.cat.codes.to_numpy()
+    codigos = np.where(codigos >= 0, codigos_norm[codigos] if len(codigos_norm) else -1, -1)
+    return pd.Series(pd.Categorical.from_codes(codigos, categories=categorias_norm), index=serie.index)
+
+
+def construir_dimensao_beneficiarios(frames):
+    """Cria a dimensão de beneficiários e as colunas de chave em cada aba.
+
+    A chave é o nome normalizado (normalize_name): variações de acento,
+    caixa ou espaços do mesmo 'Nome_do_Associado' (em qualquer aba) recebem
+    o mesmo ID inteiro compacto. Cada aba com nome ganha 'ID_Beneficiario'
+    (int32, -1 quando o nome está vazio) e 'Nome_norm' (categórica com as
+    mesmas categorias em todas as abas, código = ID). Retorna a dimensão: um
+    DataFrame em que a posição da linha é o ID, com 'Nome_norm' (em ordem
+    crescente) e 'Nome_do_Associado' (a grafia mais frequente, para exibição).
+    """
+    com_nome = [df for df in frames if 'Nome_do_Associado' in df.columns]
+    if not com_nome:
+        return pd.DataFrame({'Nome_do_Associado': pd.Series(dtype=object), 'Nome_norm': pd.Categorical([])})
+    todos = pd.concat([df['Nome_do_Associado'] for df in com_nome], ignore_index=True)
+    codigos_brutos, brutos = pd.factorize(todos)
+    # Normaliza só as grafias distintas; nomes que ficam vazios contam como sem nome
+    normalizados = pd.Index([normalize_name(nome) for nome in brutos], dtype=object)
+    id_por_bruto, nomes_norm = pd.factorize(normalizados.where(normalizados != '', None), sort=True)
+    id_por_bruto = np.append(id_por_bruto, -1).astype(np.int32)  # última posição: nome vazio (código -1)
+    codigos = id_por_bruto[codigos_brutos]
+
+    # Grafia de exibição: a mais frequente entre as que viram o mesmo nome normalizado
+    frequencia = np.bincount(codigos_brutos[codigos_brutos >= 0], minlength=len(brutos))
+    com_id = np.flatnonzero(id_por_bruto[:-1] >= 0)
+    ordem = com_id[np.lexsort((-frequencia[com_id], id_por_bruto[com_id]))]
+    primeiras = ordem[np.concatenate([[True], id_por_bruto[ordem][1:] != id_por_bruto[ordem][:-1]])]
+    categorias = pd.CategoricalDtype(pd.Index(nomes_norm, dtype=object))
+    beneficiarios = pd.DataFrame({
+        'Nome_do_Associado': np.asarray(brutos, dtype=object)[primeiras],
+        'Nome_norm': pd.Categorical.from_codes(np.arange(len(nomes_norm)), dtype=categorias),
+    })
+
+    inicio = 0
+    for df in com_nome:
+        fim = inicio + len(df)
+        df['ID_Beneficiario'] = codigos[inicio:fim]
+        df['Nome_norm'] = pd.Series(pd.Categorical.from_codes(codigos[inicio:fim], dtype=categorias), index=df.index)
+        inicio = fim
+    return beneficiarios
+
+
+def nomes_por_id(beneficiarios, ids):
+    """Traduz IDs de beneficiário para os nomes originais (usado apenas para exibição)."""
+    return beneficiarios['Nome_do_Associado'].to_numpy()[np.asarray(ids, dtype=np.int64)]
+
+
+def id_por_nome(beneficiarios, nome):
+    """Retorna o ID do beneficiário com o nome informado (em qualquer grafia), ou None se não existir.
+
+    A dimensão está ordenada pelo nome normalizado (posição = ID): busca binária, O(log N).
+    """
+    normalizados = beneficiarios['Nome_norm'].cat.categories
+    alvo = normalize_name(nome)
+    posicao = int(normalizados.searchsorted(alvo))
+    return posicao if posicao < len(normalizados) and normalizados[posicao] == alvo else None
+
+
+def agregar_por_beneficiario(df, beneficiarios, coluna_valor='Valor'):
+    """Soma de valor e número de atendimentos por beneficiário, agrupando pelos IDs.
+
+    Retorna um DataFrame indexado pelo ID (apenas beneficiários com atendimentos)
+    com as colunas 'Nome_do_Associado', 'Valor' (centavos) e 'Volume'.
+    """
+    ids = df['ID_Beneficiario'].to_numpy()
+    validos = ids >= 0
+    ids = ids[validos]
+    n = len(beneficiarios)
+    volume = np.bincount(ids, minlength=n)
+    valor = somar_centavos(ids, centavos(df, coluna_valor)[validos], n)
+    presentes = np.flatnonzero(volume)
+    return pd.DataFrame({
+        'Nome_do_Associado': nomes_por_id(beneficiarios, presentes),
+        'Valor': valor[presentes],
+        'Volume': volume[presentes],
+    }, index=pd.Index(presentes, name='ID_Beneficiario'))
+
+
+# ---------------------------
+# 3. INGESTÃO
+# ---------------------------
+def aplicar_dtype_hints(df, aba):
+    """Aplica as dicas de tipo de DTYPE_HINTS às colunas existentes da aba."""
+    for col, dtype in DTYPE_HINTS.get(aba, {}).items():
+        if col not in df.columns:
+            continue
+        if dtype == 'str':
+            # Mantém vazios como NaN em vez de virar a string 'nan'
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str).str.strip())
+        else:
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def ler_planilha(arquivo, abas=None):
+    """Lê várias abas abrindo o arquivo Excel uma única vez (openpyxl em modo read-only).
+
+    As abas existentes são descobertas pelo índice do arquivo: abas opcionais
+    ausentes viram DataFrames vazios e abas obrigatórias ausentes geram ValueError.
+    Retorna (dict aba -> DataFrame com colunas padronizadas, dict aba -> segundos de leitura).
+    """
+    abas = abas or ABAS_OBRIGATORIAS + ABAS_OPCIONAIS
+    if isinstance(arquivo, bytes):
+        arquivo = BytesIO(arquivo)
+
+    wb = openpyxl.load_workbook(arquivo, read_only=True, data_only=True)
+    try:
+        existentes = set(wb.sheetnames)
+        faltando = [aba for aba in abas if aba in ABAS_OBRIGATORIAS and aba not in existentes]
+        if faltando:
+            raise ValueError(f"Aba(s) obrigatória(s) não encontrada(s) no arquivo: {', '.join(faltando)}")
+
+        frames, tempos = {}, {}
+        for aba in abas:
+            inicio = time.perf_counter()
+            if aba not in existentes:
+                frames[aba] = pd.DataFrame()
+                continue
+            linhas = wb[aba].iter_rows(values_only=True)
+            cabecalho = next(linhas, None)
+            if cabecalho is None:
+                df = pd.DataFrame()
+            else:
+                colunas = [c if c is not None else f'Unnamed: {i}' for i, c in enumerate(cabecalho)]
+                df = pd.DataFrame.from_records(list(linhas), columns=colunas)
+                # O modo read-only pode devolver linhas totalmente vazias no fim da aba
+                df = df.dropna(how='all').reset_index(drop=True)
+            frames[aba] = aplicar_dtype_hints(clean_cols(df), aba)
+            tempos[aba] = time.perf_counter() - inicio
+    finally:
+        wb.close()
+    return frames, tempos
+
+
+def preparar_dados(conteudo):
+    """Lê e limpa o arquivo enviado.
+
+    Retorna um dicionário com os DataFrames 'utilizacao', 'cadastro',
+    'medicina_trabalho' e 'atestados' já padronizados e tipados. Os
+    DataFrames retornados são compartilhados pelo cache do dashboard e
+    devem ser tratados como somente leitura. 'beneficiarios' é a dimensão
+    de beneficiários (ID -> nome), 'tempos_leitura' traz os segundos
+    gastos na leitura de cada aba e 'valores_invalidos' quantos valores
+    preenchidos de cada coluna monetária não puderam ser convertidos e
+    'memoria' os bytes de cada aba antes e depois de otimizar_tipos.
+    """
+    abas, tempos = ler_planilha(conteudo)
+    return montar_dados(*limpar_abas(abas), tempos)
+
+
+def limpar_abas(abas):
+    """Padroniza as abas já lidas de um arquivo: datas, valor e tipo de beneficiário.
+
+    Retorna (abas, dict coluna -> nº de valores que não puderam ser convertidos).
+    """
+    for aba, df in abas.items():
+        abas[aba] = converter_datas(df, aba)
+    utilizacao, invalidos = converter_valor(abas['Utilizacao'])
+    abas['Utilizacao'] = adicionar_tipo_beneficiario(utilizacao)
+    return abas, {'Valor': invalidos}
+
+
+def _ler_e_limpar(conteudo):
+    """Leitura + limpeza de um arquivo; roda no processo filho em preparar_varios."""
+    abas, tempos = ler_planilha(conteudo)
+    return *limpar_abas(abas), tempos
+
+
+def nomes_empresas(nomes_arquivo):
+    """Nome da empresa de cada arquivo: o nome sem extensão, sem repetir.
+
+    Arquivos com o mesmo nome base ('a.xlsx' e 'a.xltx') mantêm a extensão e
+    nomes ainda repetidos ganham um sufixo ' (2)', ' (3)'...
+    """
+    bases = [os.path.splitext(nome)[0] for nome in nomes_arquivo]
+    contagem = {}
+    for base in bases:
+        contagem[base] = contagem.get(base, 0) + 1
+    empresas, usados = [], set()
+    for nome, base in zip(nomes_arquivo, bases):
+        empresa = nome if contagem[base] > 1 else base
+        candidato, sufixo = empresa, 1
+        while candidato in usados:
+            sufixo += 1
+            candidato = f'{empresa} ({sufixo})'
+        usados.add(candidato)
+        empresas.append(candidato)
+    return empresas
+
+
+@contextmanager
+def _filhos_importam_este_modulo():
+    """Faz os filhos 'spawn' importarem este módulo no lugar do script principal.
+
+    O 'spawn' reexecuta nos filhos o arquivo do módulo __main__ quando ele
+    não tem __spec__ (script rodado direto ou pelo Streamlit, que registra o
+    app como __main__). Com o __spec__ deste módulo, os filhos só importam
+    processamento, que basta para _ler_e_limpar.
+    """
+    principal = sys.modules['__main__']
+    if getattr(principal, '__spec__', None) is not None:
+        yield
+        return
+    principal.__spec__ = sys.modules[__name__].__spec__
+    try:
+        yield
+    finally:
+        principal.__spec__ = None
+
+
+def preparar_varios(arquivos, max_processos=None):
+    """Lê e consolida vários arquivos (um por empresa) no mesmo layout.
+
+    `arquivos` é uma lista de (nome_arquivo, conteudo). Cada arquivo é lido
+    e limpo num processo separado (o openpyxl usa um único núcleo por
+    arquivo) e as abas são concatenadas com a coluna 'Empresa' (ver
+    nomes_empresas). Os IDs de beneficiário são criados depois, sobre o
+    conjunto consolidado. Retorna o mesmo dicionário de preparar_dados,
+    com 'tempos_leitura' por empresa.
+
+    O pool usa 'spawn' e no máximo min(len(arquivos), os.cpu_count())
+    processos; com um processo só a leitura é feita no próprio processo.
+    Falhas do pool (BrokenProcessPool, OSError) sobem para quem chamou, que
+    pode repetir com max_processos=1.
+    """
+    arquivos = sorted(arquivos)
+    conteudos = [conteudo for _, conteudo in arquivos]
+    processos = min(len(arquivos), max_processos or os.cpu_count() or 1)
+    if processos <= 1:
+        resultados = [_ler_e_limpar(conteudo) for conteudo in conteudos]
+    else:
+        # 'spawn': os filhos não herdam o estado do processo pai (threads, locks, sockets)
+        with _filhos_importam_este_modulo(), ProcessPoolExecutor(
+                max_workers=processos, mp_context=multiprocessing.get_context('spawn')) as executor:
+            resultados = list(executor.map(_ler_e_limpar, conteudos))
+
+    por_aba, invalidos, tempos = {}, {}, {}
+    empresas = nomes_empresas([nome for nome, _ in arquivos])
+    for empresa, (abas, invalidos_arquivo, tempos_arquivo) in zip(empresas, resultados):
+        for aba, df in abas.items():
+            df.insert(0, 'Empresa', empresa)
+            por_aba.setdefault(aba, []).append(df)
+        for coluna, quantidade in invalidos_arquivo.items():
+            invalidos[coluna] = invalidos.get(coluna, 0) + quantidade
+        tempos[empresa] = sum(tempos_arquivo.values())
+    abas = {aba: pd.concat(frames, ignore_index=True) for aba, frames in por_aba.items()}
+    return montar_dados(abas, invalidos, tempos)
+
+
+def otimizar_tipos(df):
+    """Reduz a memória de uma aba: texto repetitivo vira categórico e números são rebaixados.
+
+    Inteiros vão para o menor tipo que comporta os valores e floats para
+    float32 só quando a conversão não perde precisão. Colunas internas e
+    monetárias (centavos Int64) não são alteradas. Datas já são datetime64
+    de 8 bytes e ficam como estão.
+    """
+    df = df.copy(deep=False)
+    for col in df.columns.difference(COLUNAS_INTERNAS + COLUNAS_MONETARIAS, sort=False):
+        serie = df[col]
+        if pd.api.types.is_integer_dtype(serie.dtype) and not pd.api.types.is_extension_array_dtype(serie.dtype):
+            df[col] = pd.to_numeric(serie, downcast='integer')
+        elif pd.api.types.is_float_dtype(serie.dtype) and serie.dtype != np.float32:
+            reduzida = serie.astype(np.float32)
+            if np.array_equal(reduzida.to_numpy(dtype=np.float64), serie.to_numpy(dtype=np.float64), equal_nan=True):
+                df[col] = reduzida
+        elif (serie.dtype == object or pd.api.types.is_string_dtype(serie.dtype)) and len(serie):
+            if (serie.nunique() <= LIMITE_CARDINALIDADE_CATEGORIA * len(serie)
+                    and pd.api.types.infer_dtype(serie, skipna=True) == 'string'):
+                df[col] = serie.astype('category')
+    return df
+
+
+def sem_categoricos(df):
+    """Volta as colunas categóricas ao tipo dos valores (para gravar e concatenar lotes de arquivos diferentes)."""
+    categoricas = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    if not categoricas:
+        return df
+    return df.astype({col: df[col].cat.categories.dtype for col in categoricas})
+
+
+def uso_memoria(df):
+    """Bytes ocupados pelo DataFrame, incluindo o conteúdo dos textos."""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def montar_dados(abas, invalidos, tempos):
+    """Cria a dimensão de beneficiários sobre as abas já limpas e monta o dicionário de dados.
+
+    As abas passam por otimizar_tipos; 'memoria' guarda os bytes de cada
+    aba antes e depois da otimização.
+    """
+    beneficiarios = construir_dimensao_beneficiarios(list(abas.values()))
+    memoria = {}
+    for aba, df in abas.items():
+        antes = uso_memoria(df)
+        abas[aba] = otimizar_tipos(df)
+        memoria[aba] = {'antes': antes, 'depois': uso_memoria(abas[aba])}
+    return {
+        'utilizacao': abas['Utilizacao'],
+        'cadastro': abas['Cadastro'],
+        'medicina_trabalho': abas['Medicina_do_Trabalho'],
+        'atestados': abas['Atestados'],
+        'beneficiarios': beneficiarios,
+        'tempos_leitura': tempos,
+        'valores_invalidos': invalidos,
+        'memoria': memoria,
+    }
+
+
+# ---------------------------
+# 4. SNAPSHOTS COLUNARES
+# ---------------------------
+def _texto_misto_para_str(df):
+    """Converte colunas object (tipos misturados) para texto, que o Arrow não aceita."""
+    df = df.copy()
+    for col in df.select_dtypes(include='object').columns:
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def gravar_feather(df, caminho):
+    """Grava um DataFrame como Feather sem compressão (permite memory-map na leitura)."""
+    try:
+        df.to_feather(caminho, compression='uncompressed')
+    except (ValueError, TypeError):
+        _texto_misto_para_str(df).to_feather(caminho, compression='uncompressed')
+
+
+def salvar_snapshot(dados, hash_conteudo, nome_arquivo='', diretorio=DIRETORIO_SNAPSHOTS):
+    """Grava os DataFrames processados como Feather (sem compressão, para permitir memory-map).
+
+    A gravação é feita numa pasta temporária renomeada ao final, então um
+    snapshot incompleto nunca é lido. Mantém apenas os MAX_SNAPSHOTS mais recentes.
+    """
+    destino = os.path.join(diretorio, hash_conteudo)
+    if carregar_meta_snapshot(destino) is not None:
+        return destino
+    # Snapshot de versão antiga: é substituído
+    shutil.rmtree(destino, ignore_errors=True)
+    temporario = f"{destino}.tmp{os.getpid()}"
+    os.makedirs(temporario, exist_ok=True)
+    try:
+        for chave in CHAVES_SNAPSHOT:
+            gravar_feather(dados[chave], os.path.join(temporario, f'{chave}.feather'))
+        meta = {
+            'hash': hash_conteudo,
+            'versao': VERSAO_SNAPSHOT,
+            'arquivo': nome_arquivo,
+            'salvo_em': datetime.now().isoformat(timespec='seconds'),
+            'tempos_leitura': dados.get('tempos_leitura', {}),
+            'valores_invalidos': dados.get('valores_invalidos', {}),
+            'memoria': dados.get('memoria', {}),
+        }
+        with open(os.path.join(temporario, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(temporario, destino)
+    except OSError:
+        shutil.rmtree(temporario, ignore_errors=True)
+        if not os.path.isdir(destino):
+            raise
+    for antigo in listar_snapshots(diretorio)[MAX_SNAPSHOTS:]:
+        shutil.rmtree(os.path.join(diretorio, antigo['hash']), ignore_errors=True)
+    return destino
+
+
+def carregar_meta_snapshot(pasta):
+    """Lê o meta.json de um snapshot. Retorna None se não existir ou for de outra versão."""
+    try:
+        with open(os.path.join(pasta, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('versao') == VERSAO_SNAPSHOT else None
+
+
+def listar_snapshots(diretorio=DIRETORIO_SNAPSHOTS):
+    """Lista os metadados dos snapshots válidos, do mais recente para o mais antigo."""
+    if not os.path.isdir(diretorio):
+        return []
+    snapshots = [carregar_meta_snapshot(os.path.join(diretorio, nome)) for nome in os.listdir(diretorio)]
+    snapshots = [meta for meta in snapshots if meta is not None]
+    return sorted(snapshots, key=lambda m: m.get('salvo_em', ''), reverse=True)
+
+
+def carregar_snapshot(hash_conteudo, diretorio=DIRETORIO_SNAPSHOTS):
+    """Carrega (via memory-map) um snapshot salvo. Retorna None se não existir."""
+    pasta = os.path.join(diretorio, hash_conteudo)
+    meta = carregar_meta_snapshot(pasta)
+    if meta is None:
+        return None
+    inicio = time.perf_counter()
+    dados = {}
+    for chave in CHAVES_SNAPSHOT:
+        tabela = feather.read_table(os.path.join(pasta, f'{chave}.feather'), memory_map=True)
+        dados[chave] = tabela.to_pandas()
+    # Int64 com vazios volta do Arrow como float64: restaura os centavos inteiros
+    for coluna in COLUNAS_MONETARIAS:
+        if coluna in dados['utilizacao'].columns:
+            dados['utilizacao'][coluna] = dados['utilizacao'][coluna].astype('Int64')
+    dados['tempos_leitura'] = {'snapshot': time.perf_counter() - inicio}
+    dados['valores_invalidos'] = meta.get('valores_invalidos', {})
+    dados['memoria'] = meta.get('memoria', {})
+    return dados
+
+
+# ---------------------------
+# 5. ÍNDICE DE FILTROS
+# ---------------------------
+def coluna_sexo(cadastro):
+    """Primeira coluna do cadastro cujo nome contém 'sexo' (ou None)."""
+    colunas = [col for col in cadastro.columns if 'sexo' in col.lower()]
+    return colunas[0] if colunas else None
+
+
+def coluna_plano(utilizacao):
+    """Primeira coluna da utilização com 'plano' e 'descricao' no nome (ou None)."""
+    colunas = [col for col in utilizacao.columns if 'plano' in col.lower() and 'descricao' in col.lower()]
+    return colunas[0] if colunas else None
+
+
+def coluna_codigo(df):
+    """Coluna usada como código do atendimento: procedimento (nome ou código) ou CID."""
+    for col in ['Nome_do_Procedimento', 'Codigo_do_Procedimento', 'Codigo_do_CID']:
+        if col in df.columns:
+            return col
+    return None
+
+
+def _rotulos(valores):
+    """Index simples com os valores distintos de um factorize (colunas categóricas incluídas)."""
+    if isinstance(valores.dtype, pd.CategoricalDtype):
+        valores = valores.astype(valores.categories.dtype)
+    return pd.Index(valores)
+
+
+def _indice_categoria(serie):
+    """Códigos inteiros por linha (-1 = vazio) e valores distintos, na ordem de aparição."""
+    codigos, valores = pd.factorize(serie)
+    return {'codigos': codigos.astype(np.int32), 'valores': _rotulos(valores)}
+
+
+def _indice_intervalo(serie):
+    """Posições das linhas ordenadas pelo valor (vazios ficam de fora) e os valores ordenados."""
+    valores = serie.to_numpy()
+    validos = np.flatnonzero(~pd.isna(valores))
+    ordem = validos[np.argsort(valores[validos], kind='stable')]
+    return {'ordem': ordem, 'valores': valores[ordem], 'n': len(valores)}
+
+
+def construir_indice_filtros(dados):
+    """Pré-calcula, uma vez por arquivo, as estruturas usadas pelos filtros da sidebar.
+
+    Colunas categóricas (sexo, município, tipo de beneficiário, plano, empresa) viram
+    códigos inteiros por linha; colunas de data (nascimento, atendimento)
+    viram arrays ordenados para busca binária.
+    """
+    cadastro, utilizacao = dados['cadastro'], dados['utilizacao']
+    indice = {'cadastro': {}, 'utilizacao': {}}
+    for col in [coluna_sexo(cadastro), 'Municipio_do_Participante', 'Empresa']:
+        if col in cadastro.columns:
+            indice['cadastro'][col] = _indice_categoria(cadastro[col])
+    if 'Data_de_Nascimento' in cadastro.columns:
+        indice['cadastro']['Data_de_Nascimento'] = _indice_intervalo(cadastro['Data_de_Nascimento'])
+    for col in ['Tipo_Beneficiario', coluna_plano(utilizacao), 'Empresa']:
+        if col in utilizacao.columns:
+            indice['utilizacao'][col] = _indice_categoria(utilizacao[col])
+    if 'Data_do_Atendimento' in utilizacao.columns:
+        indice['utilizacao']['Data_do_Atendimento'] = _indice_intervalo(utilizacao['Data_do_Atendimento'])
+    return indice
+
+
+def mascara_valores(indice, selecionados):
+    """Máscara booleana das linhas cujo valor está em `selecionados` (equivale a isin)."""
+    permitidos = np.zeros(len(indice['valores']) + 1, dtype=bool) # última posição: código -1 (vazio)
+    posicoes = indice['valores'].get_indexer(list(selecionados))
+    permitidos[posicoes[posicoes >= 0]] = True
+    return permitidos[indice['codigos']]
+
+
+def _como_data(valor, dtype):
+    return np.datetime64(pd.Timestamp(valor)).astype(dtype)
+
+
+def mascara_intervalo(indice, inicio=None, fim=None, inclui_inicio=True):
+    """Máscara booleana das linhas com valor entre `inicio` e `fim` (fim inclusivo), por busca binária."""
+    valores = indice['valores']
+    i, j = 0, len(valores)
+    if inicio is not None:
+        i = np.searchsorted(valores, _como_data(inicio, valores.dtype), side='left' if inclui_inicio else 'right')
+    if fim is not None:
+        j = np.searchsorted(valores, _como_data(fim, valores.dtype), side='right')
+    mascara = np.zeros(indice['n'], dtype=bool)
+    mascara[indice['ordem'][i:j]] = True
+    return mascara
+
+
+def mascara_faixa_etaria(indice, idade_min, idade_max, hoje):
+    """Máscara da faixa etária, com idade = (hoje - nascimento) em dias // 365.
+
+    idade >= min equivale a nascimento <= hoje - 365*min dias e
+    idade <= max equivale a nascimento > hoje - 365*(max+1) dias.
+    """
+    return mascara_intervalo(
+        indice,
+        inicio=hoje - pd.Timedelta(days=365 * (idade_max + 1)),
+        fim=hoje - pd.Timedelta(days=365 * idade_min),
+        inclui_inicio=False,
+    )
+
+
+def intervalo_valores(indice):
+    """Menor e maior valor preenchido de um índice de intervalo (ou (None, None))."""
+    valores = indice['valores']
+    if len(valores) == 0:
+        return None, None
+    return valores[0], valores[-1]
+
+
+def mascara_ids(ids, ids_permitidos, n_beneficiarios):
+    """Máscara das linhas cujo ID_Beneficiario está em `ids_permitidos` (o ID -1 nunca passa)."""
+    permitidos = np.zeros(n_beneficiarios + 1, dtype=bool)
+    permitidos[ids_permitidos[ids_permitidos >= 0]] = True
+    return permitidos[ids]
+
+
+def aplicar_filtros(dados, sexo=None, tipo_beneficiario=None, plano=None, municipio=None,
+                    faixa_etaria=None, periodo=None, hoje=None, empresa=None):
+    """Combina os filtros do dashboard nas máscaras (mask_cad, mask_util).
+
+    Mesma semântica da barra lateral: listas vazias de sexo, tipo, plano e
+    empresa não filtram; `municipio` filtra sempre que não for None; `faixa_etaria`
+    é (idade_min, idade_max) e `periodo` é (inicio, fim). Depois dos filtros
+    próprios, cadastro e utilização são cruzados pelos IDs de beneficiário.
+    """
+    cadastro, utilizacao = dados['cadastro'], dados['utilizacao']
+    indice_cad = dados['indice_filtros']['cadastro']
+    indice_util = dados['indice_filtros']['utilizacao']
+
+    mask_cad = np.ones(len(cadastro), dtype=bool)
+    if faixa_etaria is not None and 'Data_de_Nascimento' in indice_cad:
+        hoje = pd.Timestamp.today() if hoje is None else hoje
+        mask_cad &= mascara_faixa_etaria(indice_cad['Data_de_Nascimento'], faixa_etaria[0], faixa_etaria[1], hoje)
+    sexo_col = coluna_sexo(cadastro)
+    if sexo and sexo_col:
+        mask_cad &= mascara_valores(indice_cad[sexo_col], sexo)
+    if municipio is not None and 'Municipio_do_Participante' in indice_cad:
+        mask_cad &= mascara_valores(indice_cad['Municipio_do_Participante'], municipio)
+    if empresa and 'Empresa' in indice_cad:
+        mask_cad &= mascara_valores(indice_cad['Empresa'], empresa)
+
+    mask_util = np.ones(len(utilizacao), dtype=bool)
+    if tipo_beneficiario:
+        mask_util &= mascara_valores(indice_util['Tipo_Beneficiario'], tipo_beneficiario)
+    plano_col = coluna_plano(utilizacao)
+    if plano and plano_col:
+        mask_util &= mascara_valores(indice_util[plano_col], plano)
+    if empresa and 'Empresa' in indice_util:
+        mask_util &= mascara_valores(indice_util['Empresa'], empresa)
+
+    # Beneficiários válidos após os filtros do cadastro (comparando IDs inteiros, não nomes)
+    cruza_benef = 'ID_Beneficiario' in utilizacao.columns and 'ID_Beneficiario' in cadastro.columns
+    if cruza_benef:
+        ids_cad = cadastro['ID_Beneficiario'].to_numpy()
+        ids_util = utilizacao['ID_Beneficiario'].to_numpy()
+        mask_util &= mascara_ids(ids_util, ids_cad[mask_cad], len(dados['beneficiarios']))
+    if periodo is not None and 'Data_do_Atendimento' in indice_util:
+        mask_util &= mascara_intervalo(indice_util['Data_do_Atendimento'], periodo[0], periodo[1])
+    # Refiltra o cadastro para manter só quem sobrou na utilização
+    if cruza_benef:
+        mask_cad &= mascara_ids(ids_cad, ids_util[mask_util], len(dados['beneficiarios']))
+    return mask_cad, mask_util
+
+
+# ---------------------------
+# 6. CUBO DE AGREGADOS
+# ---------------------------
+DIMENSOES_CUBO = ['ID_Beneficiario', 'mes', 'plano', 'codigo']
+
+
+def construir_dimensoes_cubo(utilizacao):
+    """Códigos inteiros por linha da utilização para as dimensões do cubo (mês, plano, código).
+
+    Cada dimensão é um dict com 'codigos' (int32, -1 = vazio) e 'valores'
+    (rótulo de cada código, em ordem crescente).
+    """
+    dimensoes = {}
+    if 'Data_do_Atendimento' in utilizacao.columns:
+        codigos, meses = pd.factorize(utilizacao['Data_do_Atendimento'].dt.to_period('M'), sort=True)
+        dimensoes['mes'] = {'codigos': codigos.astype(np.int32), 'valores': pd.Index(meses.astype(str))}
+    for dim, col in [('plano', coluna_plano(utilizacao)), ('codigo', coluna_codigo(utilizacao))]:
+        if col is not None:
+            codigos, valores = pd.factorize(utilizacao[col], sort=True)
+            dimensoes[dim] = {'codigos': codigos.astype(np.int32), 'valores': _rotulos(valores), 'coluna': col}
+    return dimensoes
+
+
+def construir_cubo(utilizacao, mascara, dimensoes):
+    """Agrega as linhas selecionadas da utilização em um cubo pequeno.
+
+    Chave: (ID_Beneficiario, mes, plano, codigo), todos inteiros (-1 = vazio
+    ou dimensão inexistente). Medidas: 'Valor' (soma em centavos) e 'Volume' (número de
+    atendimentos). O município não entra na chave: é um atributo do
+    beneficiário e é cruzado na leitura, sem duplicar valores.
+    """
+    n = int(mascara.sum())
+    colunas = {}
+    if 'ID_Beneficiario' in utilizacao.columns:
+        colunas['ID_Beneficiario'] = utilizacao['ID_Beneficiario'].to_numpy()[mascara]
+    else:
+        colunas['ID_Beneficiario'] = np.full(n, -1, dtype=np.int32)
+    for dim in ['mes', 'plano', 'codigo']:
+        colunas[dim] = dimensoes[dim]['codigos'][mascara] if dim in dimensoes else np.full(n, -1, dtype=np.int32)
+    colunas['Valor'] = centavos(utilizacao)[mascara]
+    return (pd.DataFrame(colunas)
+            .groupby(DIMENSOES_CUBO, sort=False)
+            .agg(Valor=('Valor', 'sum'), Volume=('Valor', 'size'))
+            .reset_index())
+
+
+def agregar_cubo(cubo, por=None, dimensoes=None):
+    """Soma 'Valor' e 'Volume' do cubo pelas dimensões em `por`.
+
+    Linhas com código -1 (vazio) em alguma dimensão de `por` são descartadas,
+    como no groupby do pandas. Se `dimensoes` for informado, os códigos de
+    mês/plano/código viram rótulos. Sem `por`, retorna os totais (Series).
+    """
+    if not por:
+        return cubo[['Valor', 'Volume']].sum()
+    selecao = cubo[(cubo[por] >= 0).all(axis=1)] if len(cubo) else cubo
+    resultado = selecao.groupby(por, sort=True)[['Valor', 'Volume']].sum().reset_index()
+    if dimensoes is not None:
+        for dim in por:
+            if dim in dimensoes:
+                resultado[dim] = dimensoes[dim]['valores'].take(resultado[dim].to_numpy())
+    return resultado
+
+
+# ---------------------------
+# 7. ESTRUTURAS DERIVADAS
+# ---------------------------
+def construir_indices(dados, interface=True):
+    """Acrescenta a `dados` as estruturas derivadas (índices) que não vão para o snapshot.
+
+    Deve ser chamada depois de preparar_dados ou carregar_snapshot. Com
+    `interface=False` (pipeline em lote) monta só o índice dos filtros e as
+    dimensões do cubo; busca, linhas por beneficiário, regras, anomalias e
+    condições servem apenas ao dashboard.
+    """
+    dados['indice_filtros'] = construir_indice_filtros(dados)
+    dados['dimensoes_cubo'] = construir_dimensoes_cubo(dados['utilizacao'])
+    if not interface:
+        return dados
+    dados['indice_busca'] = construir_indice_busca(dados['beneficiarios'])
+    dados['indice_linhas'] = construir_indice_linhas(dados)
+    dados['inconsistencias'] = avaliar_regras(construir_tabela_atendimentos(dados))
+    dados['anomalias'] = pontuar_beneficiarios(dados)
+    dados['condicoes'] = condicoes_por_cid(dados['utilizacao'], carregar_catalogo_cronicos())
+    return dados
+
+
+# ---------------------------
+# 8. BASE HISTÓRICA (CARGA MENSAL INCREMENTAL)
+# ---------------------------
+# Layout da pasta:
+#   manifesto.json               meses, agregados por mês e cargas já feitas
+#   utilizacao_<AAAA-MM>.feather uma partição por mês (com a coluna Chave_Atendimento)
+#   cadastro/medicina_trabalho/atestados.feather  versões acumuladas
+def chave_atendimento(utilizacao):
+    """Hash (uint64) das colunas que identificam um atendimento."""
+    colunas = [col for col in COLUNAS_CHAVE_ATENDIMENTO if col in utilizacao.columns]
+    if not colunas:
+        return pd.util.hash_pandas_object(utilizacao, index=False).to_numpy()
+    return pd.util.hash_pandas_object(utilizacao[colunas], index=False).to_numpy()
+
+
+def mes_da_particao(utilizacao):
+    """Mês ('AAAA-MM') de cada linha pela Competência (ou, linha a linha, pela data do atendimento); 'sem_data' quando ausente."""
+    datas = None
+    for coluna in ['Competencia', 'Data_do_Atendimento']:
+        if coluna in utilizacao.columns:
+            datas = utilizacao[coluna] if datas is None else datas.fillna(utilizacao[coluna])
+    if datas is None:
+        return np.full(len(utilizacao), 'sem_data', dtype=object)
+    return datas.dt.strftime('%Y-%m').fillna('sem_data').to_numpy(dtype=object)
+
+
+def ler_manifesto(diretorio=DIRETORIO_HISTORICO):
+    """Lê o manifesto da base histórica (ou um manifesto vazio se a base não existir)."""
+    try:
+        with open(os.path.join(diretorio, 'manifesto.json'), encoding='utf-8') as f:
+            manifesto = json.load(f)
+        if manifesto.get('versao') == 1:
+            # Versão 1 somava Valor em reais (float): migra os totais para centavos inteiros
+            for resumo in manifesto['meses'].values():
+                resumo['Valor'] = int(round(resumo.get('Valor', 0) * 100))
+            manifesto['versao'] = VERSAO_HISTORICO
+        if manifesto.get('versao') == VERSAO_HISTORICO:
+            return manifesto
+    except (OSError, ValueError):
+        pass
+    return {'versao': VERSAO_HISTORICO, 'meses': {}, 'cargas': [], 'atualizado_em': None}
+
+
+def _gravar_manifesto(manifesto, diretorio):
+    temporario = os.path.join(diretorio, f'manifesto.json.tmp{os.getpid()}')
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump(manifesto, f, ensure_ascii=False, indent=1)
+    os.replace(temporario, os.path.join(diretorio, 'manifesto.json'))
+
+
+def _substituir_feather(df, caminho):
+    """Grava o Feather num arquivo temporário e troca de uma vez (leitores nunca veem arquivo parcial)."""
+    temporario = f'{caminho}.tmp{os.getpid()}'
+    gravar_feather(df.reset_index(drop=True), temporario)
+    os.replace(temporario, caminho)
+
+
+def _ler_feather(caminho, colunas=None):
+    return feather.read_table(caminho, columns=colunas, memory_map=True).to_pandas()
+
+
+def anexar_mes(conteudo, nome_arquivo='', diretorio=DIRETORIO_HISTORICO):
+    """Acrescenta à base histórica um extrato (normalmente de um único mês).
+
+    Só o arquivo novo é lido do Excel. Atendimentos cuja chave já está na
+    partição do mês são descartados, então reenviar o mesmo extrato não
+    duplica valores. Os agregados por mês do manifesto são atualizados
+    somando apenas as linhas novas. O Cadastro do extrato substitui as
+    linhas dos mesmos beneficiários (pelo nome normalizado); Medicina do Trabalho e Atestados são
+    acumulados sem repetição. Retorna o registro da carga.
+    """
+    manifesto = ler_manifesto(diretorio)
+    hash_conteudo = hash_arquivo(conteudo)
+    for carga in manifesto['cargas']:
+        if carga['hash'] == hash_conteudo:
+            return {**carga, 'repetida': True}
+
+    novos = preparar_dados(conteudo)
+    # as partições guardam os tipos originais: categorias de meses diferentes não se comparam
+    utilizacao = sem_categoricos(novos['utilizacao'].drop(columns=COLUNAS_INTERNAS + ['Tipo_Beneficiario'], errors='ignore'))
+    # os totais do manifesto somam centavos inteiros; as partições guardam Valor em reais, como no Excel
+    # (carregar_historico converte de novo para centavos)
+    valor_centavos = centavos(utilizacao) if 'Valor' in utilizacao.columns else None
+    for coluna in COLUNAS_MONETARIAS:
+        if coluna in utilizacao.columns:
+            utilizacao[coluna] = em_reais(utilizacao[coluna]).astype(np.float64)
+    utilizacao['Chave_Atendimento'] = chave_atendimento(utilizacao)
+    meses = mes_da_particao(utilizacao)
+    os.makedirs(diretorio, exist_ok=True)
+
+    carga = {'hash': hash_conteudo, 'arquivo': nome_arquivo, 'novas': 0, 'duplicadas': 0, 'meses': []}
+    for mes in sorted(set(meses)):
+        do_mes = meses == mes
+        lote = utilizacao[do_mes]
+        valor_lote = valor_centavos[do_mes] if valor_centavos is not None else None
+        caminho = os.path.join(diretorio, f'utilizacao_{mes}.feather')
+        existente = _ler_feather(caminho) if os.path.exists(caminho) else None
+        if existente is not None:
+            repetida = np.isin(lote['Chave_Atendimento'].to_numpy(), existente['Chave_Atendimento'].to_numpy())
+            carga['duplicadas'] += int(repetida.sum())
+            lote = lote[~repetida]
+            valor_lote = valor_lote[~repetida] if valor_lote is not None else None
+        if lote.empty:
+            continue
+        particao = lote if existente is None else pd.concat([existente, lote], ignore_index=True)
+        _substituir_feather(particao, caminho)
+
+        resumo = manifesto['meses'].setdefault(mes, {'linhas': 0, 'Valor': 0})
+        resumo['linhas'] += len(lote)
+        if valor_lote is not None:
+            resumo['Valor'] += int(valor_lote.sum())
+        carga['novas'] += len(lote)
+        carga['meses'].append(mes)
+
+    for chave in ['cadastro', 'medicina_trabalho', 'atestados']:
+        df = sem_categoricos(novos[chave].drop(columns=COLUNAS_INTERNAS, errors='ignore'))
+        caminho = os.path.join(diretorio, f'{chave}.feather')
+        if os.path.exists(caminho):
+            anterior = _ler_feather(caminho)
+            if chave == 'cadastro' and 'Nome_do_Associado' in df.columns and 'Nome_do_Associado' in anterior.columns:
+                # mesma chave dos IDs de beneficiário: o nome normalizado (acentos, caixa e espaços nas pontas)
+                substituidos = normalizar_nomes(df['Nome_do_Associado']).dropna().astype(object)
+                anterior = anterior[~normalizar_nomes(anterior['Nome_do_Associado']).astype(object).isin(substituidos).to_numpy()]
+                df = pd.concat([anterior, df], ignore_index=True)
+            else:
+                df = pd.concat([anterior, df], ignore_index=True)
+                df = df[~df.astype(str).duplicated()]
+        _substituir_feather(df, caminho)
+
+    carga['anexado_em'] = datetime.now().isoformat(timespec='seconds')
+    manifesto['cargas'].append(carga)
+    manifesto['atualizado_em'] = carga['anexado_em']
+    _gravar_manifesto(manifesto, diretorio)
+    return carga
+
+
+def versao_historico(diretorio=DIRETORIO_HISTORICO):
+    """Identificador do estado atual da base histórica (muda a cada carga), usado como chave de cache."""
+    manifesto = ler_manifesto(diretorio)
+    if not manifesto['meses']:
+        return None
+    assinatura = json.dumps([manifesto['atualizado_em'], manifesto['meses']], sort_keys=True)
+    return 'historico-' + hashlib.sha256(assinatura.encode()).hexdigest()[:16]
+
+
+def evolucao_historico(diretorio=DIRETORIO_HISTORICO):
+    """Totais por mês da base histórica lidos só do manifesto, sem abrir as partições.
+
+    DataFrame com 'Mes_Ano' ('AAAA-MM'), 'Valor' (centavos) e 'Volume'
+    (atendimentos), em ordem de mês; as linhas 'sem_data' ficam de fora.
+    """
+    meses = sorted((mes, resumo) for mes, resumo in ler_manifesto(diretorio)['meses'].items() if mes != 'sem_data')
+    return pd.DataFrame({
+        'Mes_Ano': [mes for mes, _ in meses],
+        'Valor': np.array([resumo['Valor'] for _, resumo in meses], dtype=np.int64),
+        'Volume': np.array([resumo['linhas'] for _, resumo in meses], dtype=np.int64),
+    })
+
+
+def carregar_historico(diretorio=DIRETORIO_HISTORICO, meses=None):
+    """Monta o dicionário de dados (mesmo formato de preparar_dados) a partir da base histórica.
+
+    Lê as partições Feather via memory-map; nenhum Excel é reprocessado.
+    `meses` ('AAAA-MM' ou 'sem_data') restringe as partições lidas; o
+    cadastro e as demais abas vêm inteiros. Retorna None se não houver
+    partição a ler.
+    """
+    manifesto = ler_manifesto(diretorio)
+    selecionados = sorted(mes for mes in manifesto['meses'] if meses is None or mes in meses)
+    if not selecionados:
+        return None
+    inicio = time.perf_counter()
+    particoes = [_ler_feather(os.path.join(diretorio, f'utilizacao_{mes}.feather')) for mes in selecionados]
+    abas = {'Utilizacao': pd.concat(particoes, ignore_index=True).drop(columns='Chave_Atendimento')}
+    for chave in ['cadastro', 'medicina_trabalho', 'atestados']:
+        caminho = os.path.join(diretorio, f'{chave}.feather')
+        abas[CHAVES_ABAS[chave]] = _ler_feather(caminho) if os.path.exists(caminho) else pd.DataFrame()
+    return montar_dados(*limpar_abas(abas), {'historico': time.perf_counter() - inicio})
+
+
+# ---------------------------
+# 9. EXPORTAÇÃO
+# ---------------------------
+def aba_exportacao(nome, df, colunas=None, linhas=None):
+    """Descreve uma aba a exportar sem copiar o DataFrame.
+
+    `colunas` restringe as colunas (padrão: todas menos COLUNAS_INTERNAS) e
+    `linhas` são as posições a exportar (padrão: todas).
+    """
+    if colunas is None:
+        colunas = [col for col in df.columns if col not in COLUNAS_INTERNAS]
+    if linhas is None:
+        linhas = np.arange(len(df))
+    return {'nome': nome, 'df': df, 'colunas': colunas, 'linhas': linhas}
+
+
+def abas_relatorio(utilizacao_filtrada, cadastro_filtrado, medicina_trabalho, atestados):
+    """Abas do relatório filtrado (aba 📤 Exportação).
+
+    Medicina do Trabalho e Atestados são filtrados pelos beneficiários do
+    cadastro filtrado; a coluna derivada 'Tipo_Beneficiario' e as colunas
+    internas não são exportadas.
+    """
+    colunas_util = [col for col in utilizacao_filtrada.columns if col not in ['Tipo_Beneficiario'] + COLUNAS_INTERNAS]
+    abas = [aba_exportacao('Utilizacao_Filtrada', utilizacao_filtrada, colunas_util),
+            aba_exportacao('Cadastro_Filtrado', cadastro_filtrado)]
+    for df, nome in [(medicina_trabalho, 'Medicina_do_Trabalho_Filtrada'), (atestados, 'Atestados_Filtrados')]:
+        linhas = None
+        if 'ID_Beneficiario' in df.columns and 'ID_Beneficiario' in cadastro_filtrado.columns:
+            linhas = np.flatnonzero(df['ID_Beneficiario'].isin(cadastro_filtrado['ID_Beneficiario']).to_numpy())
+        aba = aba_exportacao(nome, df, linhas=linhas)
+        if len(aba['linhas']):
+            abas.append(aba)
+    return abas
+
+
+def _celula_exportavel(valor):
+    """Valores que o xlsxwriter/Arrow não gravam (Period, Decimal, objetos...) viram texto, como fazia o to_excel."""
+    if isinstance(valor, (np.number, np.bool_)):
+        valor = valor.item()
+    if valor is None or isinstance(valor, (str, bool, int, float, date, timedelta)):
+        return valor
+    if pd.api.types.is_scalar(valor) and pd.isna(valor):
+        return None
+    return str(valor)
+
+
+def _blocos(aba, linhas_por_bloco=LINHAS_POR_BLOCO):
+    """Percorre a aba em blocos de linhas (cada bloco é uma cópia pequena), com valores em centavos convertidos para reais.
+
+    Colunas categóricas saem como texto, para o esquema do arquivo não depender de otimizar_tipos;
+    períodos e outros objetos sem tipo próprio no arquivo também viram texto.
+    """
+    linhas = aba['linhas']
+    # Só colunas em centavos (Int64, de converter_valor) viram reais; valores já em reais ou texto saem como estão
+    monetarias = [col for col in aba['colunas']
+                  if col in COLUNAS_MONETARIAS and isinstance(aba['df'][col].dtype, pd.Int64Dtype)]
+    for inicio in range(0, len(linhas), linhas_por_bloco):
+        bloco = sem_categoricos(aba['df'].iloc[linhas[inicio:inicio + linhas_por_bloco]][aba['colunas']])
+        for col in monetarias:
+            bloco[col] = em_reais(bloco[col]).astype(np.float64)
+        for col in bloco.columns:
+            if isinstance(bloco[col].dtype, pd.PeriodDtype):
+                bloco[col] = bloco[col].astype(str).where(bloco[col].notna(), None)
+            elif bloco[col].dtype == object:
+                bloco[col] = bloco[col].map(_celula_exportavel)
+        yield bloco
+
+
+def escrever_xlsx(destino, abas, linhas_por_bloco=LINHAS_POR_BLOCO):
+    """Grava as abas em .xlsx no modo constant_memory do xlsxwriter.
+
+    Cada linha vai para o disco assim que é escrita, então o pico de memória
+    não cresce com o número de linhas. Exige um caminho de arquivo (o modo
+    constant_memory não funciona com buffers em memória).
+    """
+    workbook = xlsxwriter.Workbook(destino, {'constant_memory': True,
+                                             'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+    negrito = workbook.add_format({'bold': True, 'border': 1})
+    try:
+        for aba in abas:
+            planilha = workbook.add_worksheet(aba['nome'][:31])
+            planilha.write_row(0, 0, [str(col) for col in aba['colunas']], negrito)
+            linha = 1
+            for bloco in _blocos(aba, linhas_por_bloco):
+                # Valores nulos (NaN/NaT/None) viram células vazias
+                valores = bloco.astype(object).where(bloco.notna(), None)
+                for registro in valores.itertuples(index=False, name=None):
+                    planilha.write_row(linha, 0, registro)
+                    linha += 1
+    finally:
+        workbook.close()
+
+
+def _schema_arrow(bloco):
+    """Schema estável entre blocos: colunas de texto (object) são sempre string."""
+    campos = []
+    for col in bloco.columns:
+        if bloco[col].dtype == object:
+            campos.append(pa.field(str(col), pa.string()))
+        else:
+            campos.append(pa.Schema.from_pandas(bloco[[col]], preserve_index=False).field(str(col)))
+    return pa.schema(campos)
+
+
+def escrever_zip(destino, abas, formato='csv', linhas_por_bloco=LINHAS_POR_BLOCO):
+    """Grava um .zip com um arquivo CSV ou Parquet por aba, bloco a bloco."""
+    compressao = zipfile.ZIP_DEFLATED if formato == 'csv' else zipfile.ZIP_STORED
+    with zipfile.ZipFile(destino, 'w', compression=compressao) as zf:
+        for aba in abas:
+            with zf.open(f"{aba['nome']}.{formato}", 'w') as f:
+                if formato == 'csv':
+                    texto = TextIOWrapper(f, encoding='utf-8-sig', newline='')
+                    pd.DataFrame(columns=aba['colunas']).to_csv(texto, index=False)
+                    for bloco in _blocos(aba, linhas_por_bloco):
+                        bloco.to_csv(texto, index=False, header=False)
+                    texto.flush()
+                    texto.detach()
+                    continue
+                escritor, schema = None, None
+                for bloco in _blocos(aba, linhas_por_bloco):
+                    bloco = _texto_misto_para_str(bloco)
+                    if escritor is None:
+                        schema = _schema_arrow(bloco)
+                        escritor = pq.ParquetWriter(f, schema)
+                    escritor.write_table(pa.Table.from_pandas(bloco, schema=schema, preserve_index=False))
+                if escritor is not None:
+                    escritor.close()
+
+
+def exportar_abas(destino, abas, formato='xlsx'):
+    """Grava as abas em `destino` (caminho) no formato 'xlsx', 'csv' ou 'parquet' (zip)."""
+    if formato == 'xlsx':
+        escrever_xlsx(destino, abas)
+    else:
+        escrever_zip(destino, abas, formato)
+
+
+def exportar_em_bytes(abas, formato='xlsx'):
+    """Gera o arquivo num temporário em disco (memória constante durante a escrita) e devolve os bytes.
+
+    Pensada para o download sob demanda do dashboard: só roda quando o
+    usuário clica em baixar.
+    """
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, f'exportacao.{EXTENSOES_EXPORTACAO[formato]}')
+        exportar_abas(caminho, abas, formato)
+        with open(caminho, 'rb') as f:
+            return f.read()
+
+
+def exportar_relatorio(destino, utilizacao_filtrada, cadastro_filtrado, medicina_trabalho, atestados, formato='xlsx'):
+    """Grava o relatório filtrado (aba 📤 Exportação) no caminho `destino`."""
+    exportar_abas(destino, abas_relatorio(utilizacao_filtrada, cadastro_filtrado, medicina_trabalho, atestados), formato)
+
+
+def exportar_agregados(destino, cubo, dimensoes, beneficiarios):
+    """Grava os agregados do cubo filtrado: totais por mês, por plano e por beneficiário."""
+    with pd.ExcelWriter(destino, engine='xlsxwriter') as writer:
+        for dim, aba in [('mes', 'Por_Mes'), ('plano', 'Por_Plano')]:
+            if dim in dimensoes:
+                agregado = agregar_cubo(cubo, [dim], dimensoes)
+                agregado['Valor'] = em_reais(agregado['Valor'])
+                agregado.to_excel(writer, sheet_name=aba, index=False)
+        por_benef = agregar_cubo(cubo, ['ID_Beneficiario'])
+        por_benef['Valor'] = em_reais(por_benef['Valor'])
+        por_benef.insert(0, 'Nome_do_Associado', nomes_por_id(beneficiarios, por_benef['ID_Beneficiario']))
+        (por_benef.drop(columns='ID_Beneficiario')
+         .sort_values('Valor', ascending=False)
+         .to_excel(writer, sheet_name='Por_Beneficiario', index=False))
+
+
+# ---------------------------
+# 10. ÍNDICE DE BUSCA
+# ---------------------------
+_ESPACO = ord(' ')
+_SEM_IDS = np.array([], dtype=np.int32)
+
+
+def _intervalos(inicios, tamanhos):
+    """Concatena os intervalos [inicio, inicio + tamanho) num único array de posições."""
+    tamanhos = np.asarray(tamanhos, dtype=np.int64)
+    deslocamentos = np.asarray(inicios, dtype=np.int64) - np.cumsum(tamanhos) + tamanhos
+    return np.repeat(deslocamentos, tamanhos) + np.arange(int(tamanhos.sum()))
+
+
+def _primeiros(ordenados):
+    """Máscara da primeira ocorrência de cada valor num array ordenado."""
+    return np.append(len(ordenados) > 0, ordenados[1:] != ordenados[:-1])[:len(ordenados)]
+
+
+def _buffer(textos):
+    """Textos (array de bytes) concatenados num buffer uint8 ' T1 T2 ... ', com o início e o tamanho de cada um."""
+    tamanhos = np.strings.str_len(textos).astype(np.int64)
+    largura = textos.dtype.itemsize
+    inicios = np.cumsum(tamanhos + 1) - tamanhos
+    buffer = np.full(int(tamanhos.sum()) + len(textos) + 1, _ESPACO, dtype=np.uint8)
+    buffer[_intervalos(inicios, tamanhos)] = (
+        textos.view(np.uint8).reshape(len(textos), largura)[np.arange(largura) < tamanhos[:, None]])
+    return buffer, inicios, tamanhos
+
+
+def _recortes(buffer, inicios, tamanhos, largura):
+    """Trechos buffer[inicio:inicio + tamanho] (tamanho <= largura) como array de bytes S{largura}."""
+    matriz = np.zeros((len(inicios), largura), dtype=np.uint8)
+    matriz[np.arange(largura) < tamanhos[:, None]] = buffer[_intervalos(inicios, tamanhos)]
+    return matriz.view(f'S{largura}').ravel()
+
+
+def _listas_invertidas(chaves, ids):
+    """Listas invertidas compactas: chaves distintas ordenadas e, para cada uma, seus IDs (ordenados, sem repetição).
+
+    Os IDs da chave i são ids[limites[i]:limites[i + 1]].
+    """
+    # Chave nos 32 bits altos e ID nos baixos: uma ordenação só, sem divisões
+    pares = np.sort((chaves.astype(np.int64) << 32) | ids)
+    pares = pares[_primeiros(pares)]
+    chaves = pares >> 32
+    primeiros = np.flatnonzero(_primeiros(chaves))
+    return {'chaves': chaves[primeiros], 'limites': np.append(primeiros, len(pares)), 'ids': pares.astype(np.int32)}
+
+
+def _ids_das_listas(listas, posicoes):
+    """IDs das listas nas posições informadas, concatenados (podem repetir)."""
+    limites = listas['limites']
+    return listas['ids'][_intervalos(limites[posicoes], limites[posicoes + 1] - limites[posicoes])]
+
+
+def _posicoes_das_chaves(listas, chaves):
+    """Posições, nas listas invertidas, das chaves que existem nelas (as ausentes são descartadas)."""
+    posicoes = np.searchsorted(listas['chaves'], chaves)
+    dentro = posicoes < len(listas['chaves'])
+    posicoes = posicoes[dentro]
+    return posicoes[listas['chaves'][posicoes] == chaves[dentro]]
+
+
+def _codigos_trigramas(buffer, posicoes):
+    """Código inteiro do trigrama de bytes que começa em cada posição do buffer."""
+    return ((buffer[posicoes].astype(np.int64) << 16) | (buffer[posicoes + 1].astype(np.int64) << 8)
+            | buffer[posicoes + 2])
+
+
+def _codigos_do_texto(texto):
+    """Códigos distintos dos trigramas de um texto (bytes)."""
+    buffer = np.frombuffer(texto, dtype=np.uint8)
+    return np.unique(_codigos_trigramas(buffer, np.arange(len(buffer) - 2)))
+
+
+def construir_indice_busca(beneficiarios):
+    """Índice de busca sobre os nomes normalizados da dimensão de beneficiários (tudo vetorizado).
+
+    Os nomes (ASCII após a normalização) são concatenados num buffer de bytes
+    e quebrados em palavras. O 'vocabulario' (palavras distintas, ordenadas)
+    leva às listas palavra -> IDs ('ids_vocabulario') e tem seus próprios
+    índices, bem menores que um por nome: 'trigramas' (trigrama -> palavras,
+    para substring e semelhança) e 'delecoes'/'vocab_delecoes' (cada palavra
+    sem dígitos com TAMANHO_MINIMO_ERRO_BUSCA ou mais letras, menos uma letra,
+    para erros de digitação). 'nomes' são os nomes normalizados por ID
+    (posição = ID) e 'ordem' os IDs em ordem alfabética dos nomes (busca por
+    prefixo do nome).
+    """
+    nomes = beneficiarios['Nome_norm'].astype(object).fillna('').to_numpy().astype(str)
+    ordem = np.argsort(nomes, kind='stable').astype(np.int32)
+    buffer, inicios, tamanhos = _buffer(np.strings.encode(nomes, 'ascii', 'replace'))
+
+    espaco = buffer == _ESPACO
+    inicio_palavras = np.flatnonzero(espaco[:-1] & ~espaco[1:]) + 1
+    tamanho_palavras = np.flatnonzero(~espaco[:-1] & espaco[1:]) + 1 - inicio_palavras
+    donos = np.searchsorted(inicios, inicio_palavras, side='right') - 1
+    largura = int(tamanho_palavras.max()) if len(tamanho_palavras) else 1
+    vocabulario, palavra_do_vocab = np.unique(_recortes(buffer, inicio_palavras, tamanho_palavras, largura),
+                                              return_inverse=True)
+
+    # Trigramas de cada palavra do vocabulário com um espaço de cada lado
+    buffer_vocab, inicios_vocab, tamanhos_vocab = _buffer(vocabulario)
+    trigramas = _listas_invertidas(_codigos_trigramas(buffer_vocab, _intervalos(inicios_vocab - 1, tamanhos_vocab)),
+                                   np.repeat(np.arange(len(vocabulario)), tamanhos_vocab))
+
+    # Deleções de uma letra: erro de digitação = deleção em comum
+    matriz = vocabulario.view(np.uint8).reshape(len(vocabulario), largura)
+    aptas = (tamanhos_vocab >= TAMANHO_MINIMO_ERRO_BUSCA) & ~((matriz >= ord('0')) & (matriz <= ord('9'))).any(axis=1)
+    delecoes, vocab_delecoes = [np.array([], dtype='S1')], [np.array([], dtype=np.int64)]
+    for posicao in range(largura if aptas.any() else 0):
+        selecionadas = np.flatnonzero(aptas & (tamanhos_vocab > posicao))
+        delecoes.append(np.delete(matriz[selecionadas], posicao, axis=1).view(f'S{largura - 1}').ravel())
+        vocab_delecoes.append(selecionadas)
+    delecoes, vocab_delecoes = np.concatenate(delecoes), np.concatenate(vocab_delecoes)
+    ordem_delecoes = np.argsort(delecoes, kind='stable')
+
+    return {
+        'nomes': nomes, 'ordem': ordem, 'ordenados': nomes[ordem],
+        'vocabulario': vocabulario, 'ids_vocabulario': _listas_invertidas(palavra_do_vocab, donos),
+        'trigramas': trigramas, 'delecoes': delecoes[ordem_delecoes], 'vocab_delecoes': vocab_delecoes[ordem_delecoes],
+    }
+
+
+def _contidos(ids, lista):
+    """Máscara de `ids` presentes na lista ordenada `lista` (busca binária)."""
+    if not len(lista):
+        return np.zeros(len(ids), dtype=bool)
+    posicoes = np.minimum(np.searchsorted(lista, ids), len(lista) - 1)
+    return lista[posicoes] == ids
+
+
+def _no_tipo(ordenados, valores):
+    """Valores convertidos ao dtype (texto) de `ordenados`, para a busca binária não converter o array inteiro.
+
+    Devolve também a máscara dos que cabem na largura do dtype: os mais
+    longos não podem estar no array.
+    """
+    valores = np.asarray(valores)
+    largura = ordenados.dtype.itemsize // (4 if ordenados.dtype.kind == 'U' else 1)
+    return valores.astype(ordenados.dtype), np.strings.str_len(valores) <= largura
+
+
+def _faixa_prefixo(ordenados, prefixo):
+    """Início e fim do trecho de `ordenados` (array de texto ordenado) que começa com `prefixo`."""
+    (prefixo_no_tipo, limite), (cabe, cabe_limite) = _no_tipo(
+        ordenados, [prefixo, prefixo + (b'\xff' if isinstance(prefixo, bytes) else '\uffff')])
+    if not cabe:
+        return 0, 0
+    inicio = int(np.searchsorted(ordenados, prefixo_no_tipo))
+    # Prefixo com a largura toda do dtype: só os iguais a ele começam com ele
+    fim = np.searchsorted(ordenados, limite) if cabe_limite else np.searchsorted(ordenados, prefixo_no_tipo, 'right')
+    return inicio, int(fim)
+
+
+def _novos(ids, encontrados, permitidos):
+    """IDs (ordenados, sem repetição) ainda não encontrados e dentro da população permitida."""
+    ids = np.sort(ids)
+    ids = ids[_primeiros(ids)]
+    ids = ids[~encontrados[ids]]
+    return ids if permitidos is None else ids[permitidos[ids]]
+
+
+def _inicios_de_palavra(indice, consulta, encontrados, permitidos, falta):
+    """Até `falta` IDs (em ordem) de nomes com uma palavra, fora a primeira, que começa com a consulta.
+
+    Uma palavra só: as palavras do vocabulário com o prefixo. Várias: nomes
+    com todas as palavras completas da consulta, com o trecho conferido em
+    blocos até haver resultados suficientes.
+    """
+    vocabulario, listas = indice['vocabulario'], indice['ids_vocabulario']
+    palavras = consulta.encode('ascii', 'replace').split(b' ')
+    if len(palavras) == 1:
+        inicio, fim = _faixa_prefixo(vocabulario, palavras[0])
+        return _novos(listas['ids'][listas['limites'][inicio]:listas['limites'][fim]], encontrados, permitidos)[:falta]
+    completas, cabem = _no_tipo(vocabulario, [palavra for palavra in palavras[:-1] if palavra])
+    posicoes = np.minimum(np.searchsorted(vocabulario, completas), len(vocabulario) - 1)
+    if not cabem.all() or (vocabulario[posicoes] != completas).any():
+        return _SEM_IDS
+    limites = listas['limites']
+    tamanho_bloco = max(4 * falta, 256)
+    # Interseção das listas das palavras completas, da mais rara para a mais comum, até caber num bloco
+    por_tamanho = [listas['ids'][limites[i]:limites[i + 1]] for i in np.unique(posicoes)]
+    por_tamanho.sort(key=len)
+    candidatos = _novos(por_tamanho[0], encontrados, permitidos)
+    for lista in por_tamanho[1:]:
+        if len(candidatos) <= tamanho_bloco:
+            break
+        candidatos = candidatos[_contidos(candidatos, lista)]
+    # A última palavra pode estar incompleta: basta uma palavra do nome começar com ela
+    inicio, fim = _faixa_prefixo(vocabulario, palavras[-1])
+    if inicio == fim:
+        return _SEM_IDS
+    if len(candidatos) > tamanho_bloco:
+        com_ultima = np.zeros(len(encontrados), dtype=bool)
+        com_ultima[listas['ids'][limites[inicio]:limites[fim]]] = True
+        candidatos = candidatos[com_ultima[candidatos]]
+    resultado = [_SEM_IDS]
+    for inicio in range(0, len(candidatos), tamanho_bloco):
+        bloco = candidatos[inicio:inicio + tamanho_bloco]
+        resultado.append(bloco[np.strings.find(indice['nomes'][bloco], ' ' + consulta) >= 0])
+        if sum(map(len, resultado)) >= falta:
+            break
+    return np.concatenate(resultado)[:falta]
+
+
+def _palavras_com_trigramas(indice, codigos, minimo):
+    """Posições no vocabulário das palavras com pelo menos a fração `minimo` dos trigramas informados."""
+    trigramas = indice['trigramas']
+    limites = trigramas['limites']
+    listas = [trigramas['ids'][limites[i]:limites[i + 1]] for i in _posicoes_das_chaves(trigramas, codigos)]
+    comuns = np.bincount(np.concatenate([_SEM_IDS] + listas), minlength=len(indice['vocabulario']))
+    return np.flatnonzero(comuns >= minimo * len(codigos))
+
+
+def _substrings(indice, consulta, encontrados, permitidos, falta):
+    """Até `falta` IDs (em ordem) de nomes com uma palavra que contém a consulta (sem espaços) fora do início.
+
+    Palavras do vocabulário com todos os trigramas da consulta, conferidas pela substring.
+    """
+    texto = consulta.encode('ascii', 'replace')
+    if b' ' in texto:
+        # Várias palavras: quem casa fora do início das palavras fica para a busca por palavra
+        return _SEM_IDS
+    candidatas = _palavras_com_trigramas(indice, _codigos_do_texto(texto), 1.0)
+    candidatas = candidatas[np.strings.find(indice['vocabulario'][candidatas], texto) > 0]
+    return _novos(_ids_das_listas(indice['ids_vocabulario'], candidatas), encontrados, permitidos)[:falta]
+
+
+def _palavra_nos_nomes(indice, palavra, parecidas=False):
+    """Máscaras por ID: nomes com uma palavra que começa com `palavra` (exatos) e também os a um erro dela (todos).
+
+    Erro de digitação (só para palavras sem dígitos com TAMANHO_MINIMO_ERRO_BUSCA
+    ou mais letras): letra a mais (uma deleção dela está no vocabulário), letra a
+    menos (ela é uma deleção de uma palavra do vocabulário), letra trocada ou
+    invertida (deleções em comum). Com `parecidas`, `todos` inclui ainda as
+    palavras com fração de trigramas em comum >= SIMILARIDADE_MINIMA_BUSCA.
+    """
+    vocabulario, listas = indice['vocabulario'], indice['ids_vocabulario']
+    texto = palavra.encode('ascii', 'replace')
+    # O vocabulário é ordenado: as palavras com o prefixo são um trecho contínuo das listas
+    inicio, fim = _faixa_prefixo(vocabulario, texto)
+    exatos = np.zeros(len(indice['nomes']), dtype=bool)
+    exatos[listas['ids'][listas['limites'][inicio]:listas['limites'][fim]]] = True
+    proximas = [_SEM_IDS]
+    if len(texto) >= TAMANHO_MINIMO_ERRO_BUSCA and not any(caractere.isdigit() for caractere in palavra):
+        variantes = [texto[:i] + texto[i + 1:] for i in range(len(texto))]
+        delecoes, cabem = _no_tipo(vocabulario, variantes)
+        posicoes = np.minimum(np.searchsorted(vocabulario, delecoes), len(vocabulario) - 1)
+        proximas.append(posicoes[cabem & (vocabulario[posicoes] == delecoes)])
+        chaves, cabem = _no_tipo(indice['delecoes'], [texto] + variantes)
+        inicios = np.searchsorted(indice['delecoes'], chaves[cabem], side='left')
+        fins = np.searchsorted(indice['delecoes'], chaves[cabem], side='right')
+        proximas.append(indice['vocab_delecoes'][_intervalos(inicios, fins - inicios)])
+    if parecidas:
+        proximas.append(_palavras_com_trigramas(indice, _codigos_do_texto(b' ' + texto + b' '),
+                                                SIMILARIDADE_MINIMA_BUSCA))
+    proximas = np.unique(np.concatenate(proximas))
+    # As palavras com o prefixo já estão em `exatos`
+    proximas = proximas[(proximas < inicio) | (proximas >= fim)]
+    todos = exatos.copy()
+    todos[_ids_das_listas(listas, proximas)] = True
+    return exatos, todos
+
+
+def _por_palavra(indice, consulta, encontrados, permitidos, parecidas=False):
+    """IDs de nomes em que cada palavra da consulta casa com uma palavra do nome (início ou um erro de digitação).
+
+    Com 3 ou mais palavras na consulta, aceita nomes em que falta uma delas.
+    Ordem: mais palavras encontradas, menos correções e, no empate, o ID.
+    """
+    palavras = consulta.split()
+    acertos = np.zeros(len(encontrados), dtype=np.int8)
+    correcoes = np.zeros(len(encontrados), dtype=np.int8)
+    for palavra in palavras:
+        exatos, todos = _palavra_nos_nomes(indice, palavra, parecidas)
+        acertos += todos.view(np.int8)
+        correcoes += (todos & ~exatos).view(np.int8)
+    aceitos = (acertos >= len(palavras) - (len(palavras) >= 3)) & ~encontrados
+    if permitidos is not None:
+        aceitos &= permitidos
+    ids = np.flatnonzero(aceitos).astype(np.int32)
+    return ids[np.lexsort((correcoes[ids], -acertos[ids]))]
+
+
+def buscar_beneficiarios(indice, consulta, permitidos=None, k=LIMITE_RESULTADOS_BUSCA):
+    """Retorna até k IDs de beneficiários para a consulta, do mais para o menos relevante.
+
+    A consulta é normalizada como os nomes (sem acento, maiúscula). A ordem é:
+    nomes que começam com a consulta (busca binária nos nomes ordenados),
+    nomes com uma palavra que começa com ela, nomes com uma palavra que a
+    contém no meio (consulta de uma palavra só: trigramas do vocabulário +
+    conferência da substring) e, se sobrar espaço, nomes em que cada palavra
+    da consulta casa com uma palavra do nome mesmo com um erro de digitação.
+    Cada etapa só roda se as anteriores não completaram os k resultados; se
+    nenhuma achou nada, as palavras podem casar só por semelhança (trigramas
+    em comum). Empates seguem o ID (ordem alfabética). `permitidos` (array
+    booleano por ID) restringe o resultado à população filtrada. Consultas com
+    menos de 3 caracteres buscam só pelo início do nome.
+    """
+    consulta = normalize_name(consulta)
+    if not consulta or not len(indice['nomes']):
+        return _SEM_IDS
+
+    inicio, fim = _faixa_prefixo(indice['ordenados'], consulta)
+    resultado = np.sort(indice['ordem'][inicio:fim])
+    if permitidos is not None:
+        resultado = resultado[permitidos[resultado]]
+    if len(resultado) >= k or len(consulta) < 3:
+        return resultado[:k].astype(np.int32)
+
+    encontrados = np.zeros(len(indice['nomes']), dtype=bool)
+    encontrados[resultado] = True
+    etapas = [
+        lambda: _inicios_de_palavra(indice, consulta, encontrados, permitidos, k - len(resultado)),
+        lambda: _substrings(indice, consulta, encontrados, permitidos, k - len(resultado)),
+        lambda: _por_palavra(indice, consulta, encontrados, permitidos),
+    ]
+    for etapa in etapas:
+        novos = etapa()
+        encontrados[novos] = True
+        resultado = np.concatenate([resultado, novos])
+        if len(resultado) >= k:
+            break
+    if not len(resultado):
+        resultado = _por_palavra(indice, consulta, encontrados, permitidos, parecidas=True)
+    return resultado[:k].astype(np.int32)
+
+
+# ---------------------------
+# 11. ÍNDICE DE LINHAS POR BENEFICIÁRIO
+# ---------------------------
+def _indice_linhas(ids, n_beneficiarios):
+    """Posições das linhas ordenadas por ID ('ordem') e o início do trecho de cada ID ('inicio').
+
+    As linhas do ID i são ordem[inicio[i]:inicio[i + 1]], na ordem original
+    do arquivo. Linhas sem beneficiário (-1) ficam antes de todos os trechos.
+    """
+    ordem = np.argsort(ids, kind='stable')
+    contagem = np.bincount(ids[ids >= 0], minlength=n_beneficiarios)
+    inicio = np.concatenate([[0], np.cumsum(contagem)]) + int((ids < 0).sum())
+    return {'ordem': ordem, 'inicio': inicio}
+
+
+def construir_indice_linhas(dados):
+    """Índice beneficiário -> linhas para cada aba com ID_Beneficiario (detalhamento da Busca)."""
+    n_beneficiarios = len(dados['beneficiarios'])
+    return {
+        chave: _indice_linhas(dados[chave]['ID_Beneficiario'].to_numpy(), n_beneficiarios)
+        for chave in CHAVES_ABAS
+        if 'ID_Beneficiario' in dados[chave].columns
+    }
+
+
+def linhas_do_beneficiario(indice_linhas, chave, id_benef, mascara=None):
+    """Posições (crescentes) das linhas do beneficiário na aba `chave`, opcionalmente só as da máscara.
+
+    Custo proporcional ao número de linhas do beneficiário, não ao tamanho da aba.
+    """
+    indice = indice_linhas.get(chave)
+    if indice is None or id_benef is None:
+        return np.array([], dtype=np.int64)
+    linhas = indice['ordem'][indice['inicio'][id_benef]:indice['inicio'][id_benef + 1]]
+    return linhas[mascara[linhas]] if mascara is not None else linhas
+
+
+def agregar_linhas(utilizacao, linhas, dim, dimensoes):
+    """Soma 'Valor' e 'Volume' das linhas indicadas por uma dimensão do cubo ('mes', 'plano' ou 'codigo').
+
+    Mesmo resultado de agregar_cubo(cubo_do_beneficiario, [dim], dimensoes),
+    sem montar o cubo: pensado para as poucas linhas de um beneficiário.
+    """
+    if dim not in dimensoes:
+        return pd.DataFrame({dim: [], 'Valor': np.array([], dtype=np.int64), 'Volume': np.array([], dtype=np.int64)})
+    codigos = dimensoes[dim]['codigos'][linhas]
+    valores = centavos(utilizacao)[linhas]
+    validos = codigos >= 0
+    grupos, posicao = np.unique(codigos[validos], return_inverse=True)
+    return pd.DataFrame({
+        dim: dimensoes[dim]['valores'].take(grupos),
+        'Valor': somar_centavos(posicao, valores[validos], len(grupos)),
+        'Volume': np.bincount(posicao, minlength=len(grupos)),
+    })
+
+
+# ---------------------------
+# 12. REDUÇÃO DE DADOS PARA GRÁFICOS
+# ---------------------------
+def indices_lttb(y, n_pontos, x=None):
+    """Posições dos pontos mantidos pelo Largest-Triangle-Three-Buckets.
+
+    Mantém o primeiro e o último ponto e, em cada um dos n_pontos - 2 baldes
+    intermediários, o ponto que forma o maior triângulo com o ponto já
+    escolhido e a média do balde seguinte, preservando picos e vales.
+    Sem `x`, os pontos são considerados igualmente espaçados (ex.: meses).
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n_pontos >= n or n_pontos < 3:
+        return np.arange(n)
+    x = np.arange(n, dtype=np.float64) if x is None else np.asarray(x, dtype=np.float64)
+    limites = np.linspace(1, n - 1, n_pontos - 1).astype(np.int64)
+    escolhidos = np.empty(n_pontos, dtype=np.int64)
+    escolhidos[0], escolhidos[-1] = 0, n - 1
+    anterior = 0
+    for b in range(n_pontos - 2):
+        inicio, fim = limites[b], limites[b + 1]
+        if b + 2 < len(limites):
+            media_x, media_y = x[fim:limites[b + 2]].mean(), y[fim:limites[b + 2]].mean()
+        else:
+            media_x, media_y = x[n - 1], y[n - 1]
+        areas = np.abs((x[anterior] - media_x) * (y[inicio:fim] - y[anterior])
+                       - (x[anterior] - x[inicio:fim]) * (media_y - y[anterior]))
+        anterior = inicio + int(np.argmax(areas))
+        escolhidos[b + 1] = anterior
+    return escolhidos
+
+
+def reduzir_serie(df, coluna_y, n_pontos=LIMITE_PONTOS_SERIE):
+    """Linhas de `df` (série já ordenada) reduzidas por LTTB quando passam de `n_pontos`."""
+    if len(df) <= n_pontos:
+        return df
+    return df.iloc[indices_lttb(df[coluna_y].to_numpy(), n_pontos)]
+
+
+def top_n_com_outros(df, coluna_rotulo, coluna_ordem, n=LIMITE_CATEGORIAS_BARRAS, rotulo_outros='Outros'):
+    """Mantém as n - 1 categorias com maior `coluna_ordem` e soma as demais numa linha "Outros".
+
+    As colunas numéricas são somadas; as categorias mantidas ficam na ordem
+    original. Com até n categorias, `df` volta inalterado.
+    """
+    if len(df) <= n:
+        return df
+    mantidas = np.zeros(len(df), dtype=bool)
+    mantidas[np.argsort(-df[coluna_ordem].to_numpy(), kind='stable')[:n - 1]] = True
+    resto = df[~mantidas]
+    outros = {col: resto[col].sum() for col in df.columns if col != coluna_rotulo and pd.api.types.is_numeric_dtype(df[col])}
+    outros[coluna_rotulo] = rotulo_outros
+    return pd.concat([df[mantidas], pd.DataFrame([outros])], ignore_index=True)
+
+
+# ---------------------------
+# 13. REGRAS DE CONSISTÊNCIA
+# ---------------------------
+COLUNAS_CODIGO_REGRAS = ['Codigo_do_CID', 'Codigo_do_Procedimento', 'Nome_do_Procedimento']
+
+
+def _faixas_prefixos(ordenados, prefixos):
+    """Início e fim (em `ordenados`) dos textos que começam com cada prefixo: entre p e p + '\U0010ffff'."""
+    prefixos = np.asarray(prefixos, dtype=str)
+    inicio = np.searchsorted(ordenados, prefixos, side='left')
+    fim = np.searchsorted(ordenados, np.strings.add(prefixos, '\U0010ffff'), side='left')
+    return inicio, fim
+
+
+def mascara_prefixos(valores, prefixos):
+    """Máscara de `valores` (array de textos) que começam com algum dos `prefixos`.
+
+    Busca por faixas numa cópia ordenada (_faixas_prefixos), sem comparar
+    cada valor com cada prefixo. Custo O((n + nº de prefixos) log n).
+    """
+    valores = np.asarray(valores, dtype=str)
+    if not len(valores) or not len(prefixos):
+        return np.zeros(len(valores), dtype=bool)
+    ordem = np.argsort(valores, kind='stable')
+    inicio, fim = _faixas_prefixos(valores[ordem], prefixos)
+    cobertura = np.zeros(len(valores) + 1, dtype=np.int32)
+    np.add.at(cobertura, inicio, 1)
+    np.add.at(cobertura, fim, -1)
+    mascara = np.empty(len(valores), dtype=bool)
+    mascara[ordem] = np.cumsum(cobertura[:-1]) > 0
+    return mascara
+
+
+def _por_beneficiario(cadastro, valores, n_beneficiarios, vazio):
+    """Array indexado pelo ID com um atributo do cadastro; a última posição (ID -1) fica `vazio`."""
+    atributo = np.full(n_beneficiarios + 1, vazio, dtype=valores.dtype)
+    ids = cadastro['ID_Beneficiario'].to_numpy()
+    validos = ids >= 0
+    atributo[ids[validos]] = valores[validos]
+    return atributo
+
+
+def construir_tabela_atendimentos(dados):
+    """Tabela (dict de arrays alinhados às linhas da utilização) com o necessário para as regras.
+
+    Atributos do cadastro são cruzados pelo ID inteiro (sem merge por nome):
+    'sexo' (CODIGOS_SEXO), 'idade' (anos na data do atendimento, NaN se
+    desconhecida) e as condições 'apos_cancelamento', 'antes_adesao' e
+    'duplicado'. 'codigos' traz, por coluna de código, os códigos inteiros por
+    linha (-1 = vazio) e os valores distintos normalizados.
+    """
+    utilizacao, cadastro = dados['utilizacao'], dados['cadastro']
+    n = len(utilizacao)
+    n_beneficiarios = len(dados['beneficiarios'])
+    ids = (utilizacao['ID_Beneficiario'].to_numpy() if 'ID_Beneficiario' in utilizacao.columns
+           else np.full(n, -1, dtype=np.int32))
+    cadastrado = 'ID_Beneficiario' in cadastro.columns
+    datas = (utilizacao['Data_do_Atendimento'].to_numpy(dtype='datetime64[D]') if 'Data_do_Atendimento' in utilizacao.columns
+             else np.full(n, np.datetime64('NaT'), dtype='datetime64[D]'))
+    tabela = {'n': n, 'codigos': {}}
+
+    sexo_col = coluna_sexo(cadastro)
+    sexo = np.zeros(n, dtype=np.int8)
+    if cadastrado and sexo_col is not None:
+        iniciais = cadastro[sexo_col].astype(object).fillna('').astype(str).str.strip().str.upper().str[:1]
+        codigos_sexo = iniciais.map(CODIGOS_SEXO).fillna(0).to_numpy(dtype=np.int8)
+        sexo = _por_beneficiario(cadastro, codigos_sexo, n_beneficiarios, 0)[ids]
+    tabela['sexo'] = sexo
+
+    def data_cadastro(coluna):
+        if not cadastrado or coluna not in cadastro.columns:
+            return np.full(n, np.datetime64('NaT'), dtype='datetime64[D]')
+        valores = cadastro[coluna].to_numpy(dtype='datetime64[D]')
+        return _por_beneficiario(cadastro, valores, n_beneficiarios, np.datetime64('NaT'))[ids]
+
+    vividos = datas - data_cadastro('Data_de_Nascimento')
+    idade = vividos.astype(np.float64) / 365.25
+    idade[np.isnat(vividos)] = np.nan
+    tabela['idade'] = idade.astype(np.float32)
+    # Comparações com NaT são sempre falsas: sem data, a condição não é marcada
+    tabela['apos_cancelamento'] = datas > data_cadastro('Data_de_Cancelamento')
+    tabela['antes_adesao'] = datas < data_cadastro('Data_de_Adesao_ao_Plano')
+    tabela['duplicado'] = np.zeros(n, dtype=bool)
+    tabela['duplicado'][duplicados_exatos(utilizacao)[0]] = True
+
+    for col in COLUNAS_CODIGO_REGRAS:
+        if col in utilizacao.columns:
+            codigos, valores = pd.factorize(utilizacao[col])
+            valores = _rotulos(valores).astype(str).str.strip().str.upper().to_numpy(dtype=str)
+            tabela['codigos'][col] = {'codigos': codigos.astype(np.int32), 'valores': valores}
+    return tabela
+
+
+def _mascara_regra(tabela, regra):
+    """Máscara dos atendimentos que violam uma regra (todas as condições presentes)."""
+    mascara = np.ones(tabela['n'], dtype=bool)
+    if 'prefixos' in regra:
+        coluna = tabela['codigos'].get(regra['coluna'])
+        if coluna is None:
+            return np.zeros(tabela['n'], dtype=bool)
+        # Casamento só nos códigos distintos; a última posição atende o código -1 (vazio)
+        por_codigo = np.append(mascara_prefixos(coluna['valores'], regra['prefixos']), False)
+        mascara &= por_codigo[coluna['codigos']]
+    if 'sexo' in regra:
+        mascara &= tabela['sexo'] == CODIGOS_SEXO[regra['sexo']]
+    if 'idade_fora' in regra:
+        idade_min, idade_max = regra['idade_fora']
+        mascara &= (tabela['idade'] < idade_min) | (tabela['idade'] > idade_max)
+    if 'condicao' in regra:
+        mascara &= tabela[regra['condicao']]
+    return mascara
+
+
+def avaliar_regras(tabela, regras=REGRAS_CONSISTENCIA):
+    """Avalia todas as regras e devolve as violações em formato longo.
+
+    Retorna {'linhas': posições na utilização, 'regra': índice da regra de
+    cada violação, 'nomes': nome de cada regra}, ordenado por linha. Uma
+    linha aparece uma vez para cada regra que viola.
+    """
+    linhas, indices = [], []
+    for i, regra in enumerate(regras):
+        violacoes = np.flatnonzero(_mascara_regra(tabela, regra))
+        linhas.append(violacoes)
+        indices.append(np.full(len(violacoes), i, dtype=np.int32))
+    linhas = np.concatenate(linhas) if linhas else np.zeros(0, dtype=np.intp)
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+    ordem = np.lexsort((indices, linhas))
+    return {'linhas': linhas[ordem], 'regra': indices[ordem], 'nomes': np.array([r['regra'] for r in regras], dtype=object)}
+
+
+# ---------------------------
+# 14. COBRANÇAS DUPLICADAS
+# ---------------------------
+def _colunas_duplicidade(utilizacao):
+    """Colunas que identificam uma cobrança: beneficiário, código, data e valor (as que existirem)."""
+    beneficiario = 'ID_Beneficiario' if 'ID_Beneficiario' in utilizacao.columns else 'Nome_do_Associado'
+    return [col for col in [beneficiario, coluna_codigo(utilizacao), 'Data_do_Atendimento', 'Valor']
+            if col is not None and col in utilizacao.columns]
+
+
+def duplicados_exatos(utilizacao):
+    """Cobranças repetidas (mesma chave de _colunas_duplicidade), exceto a primeira de cada grupo.
+
+    Ordena o hash (uint64) da chave e compara vizinhos, sem comparar pares.
+    Retorna (linhas repetidas, linha original de cada uma), em ordem de linha.
+    """
+    colunas = _colunas_duplicidade(utilizacao)
+    if not colunas or len(utilizacao) < 2:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    chaves = pd.util.hash_pandas_object(utilizacao[colunas], index=False).to_numpy()
+    ordem = np.argsort(chaves, kind='stable')
+    repetida = np.concatenate([[False], chaves[ordem][1:] == chaves[ordem][:-1]])
+    # Primeira linha do grupo de cada posição: o último início de grupo até ali
+    inicio = np.maximum.accumulate(np.where(repetida, 0, np.arange(len(ordem))))
+    linhas, origem = ordem[repetida], ordem[inicio][repetida]
+    ordem_linhas = np.argsort(linhas, kind='stable')
+    return linhas[ordem_linhas], origem[ordem_linhas]
+
+
+def detectar_duplicados(utilizacao, janela_dias=JANELA_DUPLICIDADE_DIAS):
+    """Cobranças exatas e próximas (mesmo beneficiário e código em até `janela_dias`).
+
+    As próximas vêm de uma varredura ordenada por (beneficiário, código, data):
+    cada linha é comparada só com a anterior do mesmo par. Repetições exatas
+    não são contadas de novo como próximas. Retorna um DataFrame com 'linha'
+    (posição na utilização), 'origem' (cobrança anterior), 'tipo'
+    ('Exata'/'Próxima') e 'dias' (distância até a origem), ordenado por linha.
+    """
+    linhas, origem = duplicados_exatos(utilizacao)
+    partes = [pd.DataFrame({'linha': linhas, 'origem': origem, 'tipo': 'Exata', 'dias': 0})]
+
+    colunas = _colunas_duplicidade(utilizacao)
+    codigo = coluna_codigo(utilizacao)
+    if codigo is not None and 'Data_do_Atendimento' in colunas and len(utilizacao) > 1:
+        beneficiario = pd.factorize(utilizacao[colunas[0]])[0]
+        codigos = pd.factorize(utilizacao[codigo])[0]
+        datas = utilizacao['Data_do_Atendimento'].to_numpy(dtype='datetime64[D]')
+        validas = ~np.isnat(datas)
+        dias = np.where(validas, datas.astype(np.int64), 0)
+        ordem = np.lexsort((dias, codigos, beneficiario))
+        anterior, atual = ordem[:-1], ordem[1:]
+        distancia = dias[atual] - dias[anterior]
+        exata = np.zeros(len(utilizacao), dtype=bool)
+        exata[linhas] = True
+        proxima = ((beneficiario[atual] == beneficiario[anterior]) & (beneficiario[atual] >= 0)
+                   & (codigos[atual] == codigos[anterior]) & (codigos[atual] >= 0)
+                   & validas[atual] & validas[anterior]
+                   & (distancia <= janela_dias) & ~exata[atual])
+        partes.append(pd.DataFrame({'linha': atual[proxima], 'origem': anterior[proxima],
+                                    'tipo': 'Próxima', 'dias': distancia[proxima]}))
+    return pd.concat(partes, ignore_index=True).sort_values('linha', kind='stable').reset_index(drop=True)
+
+
+# ---------------------------
+# 15. ESCORE DE ANOMALIA POR COORTE
+# ---------------------------
+def _mediana_por_grupo(grupos, valores, n_grupos):
+    """Mediana de `valores` em cada grupo (códigos 0..n_grupos-1, todos não vazios), com uma única ordenação."""
+    ordenados = valores[np.lexsort((valores, grupos))]
+    contagem = np.bincount(grupos, minlength=n_grupos)
+    inicio = np.concatenate([[0], np.cumsum(contagem)[:-1]])
+    return (ordenados[inicio + (contagem - 1) // 2] + ordenados[inicio + contagem // 2]) / 2
+
+
+def escore_robusto(grupos, valores, n_grupos):
+    """Escore z robusto por grupo: 0,6745 * (x - mediana) / MAD.
+
+    Com MAD zero (mais da metade do grupo com o mesmo valor) usa o desvio
+    absoluto médio * 1,2533; se também for zero, o escore é 0.
+    """
+    valores = valores.astype(np.float64)
+    mediana = _mediana_por_grupo(grupos, valores, n_grupos)
+    desvio = np.abs(valores - mediana[grupos])
+    mad = _mediana_por_grupo(grupos, desvio, n_grupos)
+    media_desvio = np.bincount(grupos, weights=desvio, minlength=n_grupos) / np.bincount(grupos, minlength=n_grupos)
+    escala = np.where(mad > 0, mad / 0.6745, media_desvio * 1.253314)
+    escala = escala[grupos]
+    return np.divide(valores - mediana[grupos], escala, out=np.zeros(len(valores)), where=escala > 0)
+
+
+def _rotulos_faixa(faixas=FAIXAS_ETARIAS):
+    return [f'{inicio}-{fim - 1}' for inicio, fim in zip(faixas[:-1], faixas[1:])] + [f'{faixas[-1]}+']
+
+
+def pontuar_beneficiarios(dados):
+    """Escore robusto de custo e volume de cada beneficiário em relação à sua coorte.
+
+    Coorte = plano mais usado x faixa etária (na data do último atendimento
+    do arquivo) x sexo x tipo de beneficiário. Só entram beneficiários com
+    atendimento; coortes com menos de TAMANHO_MINIMO_COORTE pessoas ficam sem
+    escore (NaN). Retorna um DataFrame ordenado pelo 'Escore' (maior entre
+    custo e volume), do maior para o menor, para que um limiar vire um corte
+    por busca binária.
+    """
+    utilizacao, cadastro = dados['utilizacao'], dados['cadastro']
+    colunas = ['ID_Beneficiario', 'Coorte', 'Valor', 'Volume', 'Z_Custo', 'Z_Volume', 'Escore']
+    if 'ID_Beneficiario' not in utilizacao.columns or 'Valor' not in utilizacao.columns:
+        return pd.DataFrame(columns=colunas)
+    ids = utilizacao['ID_Beneficiario'].to_numpy()
+    validas = ids >= 0
+    n_beneficiarios = len(dados['beneficiarios'])
+    valor = somar_centavos(ids[validas], centavos(utilizacao)[validas], n_beneficiarios)
+    volume = np.bincount(ids[validas], minlength=n_beneficiarios)
+    pessoas = np.flatnonzero(volume > 0)
+
+    atributos = {}
+    # Plano e tipo: o valor mais frequente nos atendimentos de cada beneficiário
+    for nome, col in [('plano', coluna_plano(utilizacao)), ('tipo', 'Tipo_Beneficiario')]:
+        if col is not None and col in utilizacao.columns:
+            codigos, valores = pd.factorize(utilizacao[col])
+            pares = pd.DataFrame({'id': ids, 'codigo': codigos})[validas & (codigos >= 0)]
+            mais_frequente = pares.value_counts().reset_index().drop_duplicates('id')
+            por_id = np.full(n_beneficiarios, -1, dtype=np.int32)
+            por_id[mais_frequente['id'].to_numpy()] = mais_frequente['codigo'].to_numpy()
+            atributos[nome] = (por_id[pessoas], _rotulos(valores))
+    if 'ID_Beneficiario' in cadastro.columns:
+        sexo_col = coluna_sexo(cadastro)
+        if sexo_col is not None:
+            codigos, valores = pd.factorize(cadastro[sexo_col])
+            atributos['sexo'] = (_por_beneficiario(cadastro, codigos.astype(np.int32), n_beneficiarios, -1)[pessoas],
+                                 _rotulos(valores))
+        if 'Data_de_Nascimento' in cadastro.columns and 'Data_do_Atendimento' in utilizacao.columns:
+            referencia = utilizacao['Data_do_Atendimento'].max()
+            nascimento = _por_beneficiario(cadastro, cadastro['Data_de_Nascimento'].to_numpy(dtype='datetime64[D]'),
+                                           n_beneficiarios, np.datetime64('NaT'))[pessoas]
+            if not pd.isna(referencia):
+                vividos = np.datetime64(referencia, 'D') - nascimento
+                idade = np.where(np.isnat(vividos), -1, vividos.astype(np.int64) // 365)
+                faixa = np.where(idade >= 0, np.searchsorted(FAIXAS_ETARIAS, idade, side='right') - 1, -1)
+                atributos['faixa'] = (faixa.astype(np.int32), pd.Index(_rotulos_faixa()))
+
+    # Coorte: combinação dos códigos dos atributos (-1 = não informado também forma coorte)
+    codigos_coorte = pd.DataFrame({nome: codigos for nome, (codigos, _) in atributos.items()})
+    if atributos:
+        coorte, _ = pd.factorize(pd.MultiIndex.from_frame(codigos_coorte))
+    else:
+        coorte = np.zeros(len(pessoas), dtype=np.intp)
+    n_coortes = int(coorte.max()) + 1 if len(coorte) else 0
+    z_custo = escore_robusto(coorte, valor[pessoas], n_coortes)
+    z_volume = escore_robusto(coorte, volume[pessoas], n_coortes)
+    pequena = np.bincount(coorte, minlength=n_coortes)[coorte] < TAMANHO_MINIMO_COORTE
+    z_custo[pequena] = np.nan
+    z_volume[pequena] = np.nan
+
+    rotulo = np.full(len(pessoas), 'Todos', dtype=object)
+    for i, (codigos, valores) in enumerate(atributos.values()):
+        parte = np.where(codigos >= 0, np.asarray(valores.astype(str), dtype=object)[np.maximum(codigos, 0)], 'n/i')
+        rotulo = parte if i == 0 else rotulo + ' · ' + parte
+    resultado = pd.DataFrame({
+        'ID_Beneficiario': pessoas.astype(np.int32),
+        'Coorte': rotulo,
+        'Valor': valor[pessoas],
+        'Volume': volume[pessoas],
+        'Z_Custo': z_custo.round(2),
+        'Z_Volume': z_volume.round(2),
+        'Escore': np.fmax(z_custo, z_volume).round(2),
+    })
+    return resultado.sort_values('Escore', ascending=False, kind='stable', na_position='last').reset_index(drop=True)
+
+
+# ---------------------------
+# 16. UTILIZAÇÃO EM JANELAS MÓVEIS
+# ---------------------------
+def somas_em_janela(grupos, dias, valores, janela):
+    """Atendimentos e valor nos `janela` dias terminados em cada linha (inclusive), dentro do mesmo grupo.
+
+    As linhas devem estar ordenadas por (grupo, dia). Grupo e dia viram uma
+    única chave inteira crescente; o início de cada janela sai de uma busca
+    binária e as somas, de uma soma acumulada.
+    """
+    if not len(dias):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    dias = dias - dias.min() + janela
+    chave = grupos.astype(np.int64) * (int(dias.max()) + 1) + dias
+    inicio = np.searchsorted(chave, chave - (janela - 1), side='left')
+    fim = np.searchsorted(chave, chave, side='right')
+    acumulado = np.concatenate([[0], np.cumsum(valores, dtype=np.int64)])
+    return fim - inicio, acumulado[fim] - acumulado[inicio]
+
+
+def picos_de_utilizacao(utilizacao, chaves, limites, janelas=JANELAS_UTILIZACAO):
+    """Maior nº de atendimentos de cada grupo (`chaves`) em janelas móveis de cada tamanho.
+
+    Para cada janela j: 'Pico_{j}d' (atendimentos), 'Valor_{j}d' (custo da
+    janela do pico, em centavos) e 'Fim_{j}d' (data do último atendimento
+    dela). 'Uso_Frequente' marca os grupos que atingem `limites[j]` em
+    alguma janela. Linhas sem data ou sem chave ficam de fora.
+    """
+    colunas = [col for col in chaves if col in utilizacao.columns]
+    if len(colunas) < len(chaves) or 'Data_do_Atendimento' not in utilizacao.columns:
+        return pd.DataFrame(columns=chaves + ['Uso_Frequente'])
+    datas = utilizacao['Data_do_Atendimento'].to_numpy(dtype='datetime64[D]')
+    codigos = [pd.factorize(utilizacao[col])[0] for col in colunas]
+    validas = ~np.isnat(datas)
+    for codigo in codigos:
+        validas &= codigo >= 0
+    linhas = np.flatnonzero(validas)
+    if not len(linhas):
+        return pd.DataFrame(columns=chaves + ['Uso_Frequente'])
+    grupos = pd.factorize(pd.MultiIndex.from_arrays([codigo[linhas] for codigo in codigos]))[0]
+    dias = datas[linhas].astype(np.int64)
+    ordem = np.lexsort((dias, grupos))
+    linhas, grupos, dias = linhas[ordem], grupos[ordem], dias[ordem]
+    valores = centavos(utilizacao)[linhas] if 'Valor' in utilizacao.columns else np.zeros(len(linhas), dtype=np.int64)
+
+    # Uma linha por grupo (primeira ocorrência), com os valores originais das chaves
+    primeiras = np.flatnonzero(np.concatenate([[True], grupos[1:] != grupos[:-1]]))
+    resultado = utilizacao.iloc[linhas[primeiras]][colunas].reset_index(drop=True)
+    frequente = np.zeros(len(primeiras), dtype=bool)
+    for janela in janelas:
+        contagem, soma = somas_em_janela(grupos, dias, valores, janela)
+        # Pico de cada grupo: última linha do grupo na ordem (grupo, contagem)
+        por_contagem = np.lexsort((contagem, grupos))
+        pico = por_contagem[np.concatenate([primeiras[1:], [len(grupos)]]) - 1]
+        resultado[f'Pico_{janela}d'] = contagem[pico]
+        resultado[f'Valor_{janela}d'] = soma[pico]
+        resultado[f'Fim_{janela}d'] = dias[pico].astype('datetime64[D]')
+        frequente |= contagem[pico] >= limites[janela]
+    resultado['Uso_Frequente'] = frequente
+    return resultado
+
+
+# ---------------------------
+# 17. CONDIÇÕES CRÔNICAS
+# ---------------------------
+def carregar_catalogo_cronicos(caminho=ARQUIVO_CATALOGO_CRONICOS):
+    """Catálogo {condição: [prefixos de CID]} do JSON em `caminho`, ou CATALOGO_CRONICOS sem arquivo."""
+    if not caminho:
+        return CATALOGO_CRONICOS
+    with open(caminho, encoding='utf-8') as f:
+        catalogo = json.load(f)
+    if not isinstance(catalogo, dict) or not all(isinstance(p, list) for p in catalogo.values()):
+        raise ValueError(f"Catálogo de condições crônicas inválido em {caminho}: esperado {{condição: [prefixos]}}")
+    return catalogo
+
+
+def normalizar_cids(valores):
+    """CIDs em maiúsculas, sem ponto, hífen ou espaços ('e11.9' -> 'E119'), para casar por prefixo."""
+    return pd.Index(valores).astype(str).str.upper().str.replace(r'[\s.\-]', '', regex=True).to_numpy(dtype=str)
+
+
+def classificar_prefixos(valores, catalogo):
+    """Índice da condição de cada valor (-1 = nenhuma) pelo prefixo mais longo do catálogo.
+
+    Os valores são ordenados uma vez; os que começam com um prefixo formam
+    uma faixa contígua, marcada de uma vez. Os prefixos são aplicados do mais
+    curto para o mais longo, então o mais específico prevalece.
+    """
+    valores = np.asarray(valores, dtype=str)
+    condicao = np.full(len(valores), -1, dtype=np.int16)
+    prefixos = [(prefixo, i) for i, lista in enumerate(catalogo.values()) for prefixo in normalizar_cids(lista)]
+    if not len(valores) or not prefixos:
+        return condicao
+    prefixos.sort(key=lambda item: len(item[0]))
+    ordem = np.argsort(valores, kind='stable')
+    inicio, fim = _faixas_prefixos(valores[ordem], [prefixo for prefixo, _ in prefixos])
+    por_posicao = np.full(len(valores), -1, dtype=np.int16)
+    for (_, i), a, b in zip(prefixos, inicio, fim):
+        por_posicao[a:b] = i
+    condicao[ordem] = por_posicao
+    return condicao
+
+
+def condicoes_por_cid(utilizacao, catalogo=CATALOGO_CRONICOS):
+    """Condição crônica de cada atendimento a partir do Codigo_do_CID.
+
+    O casamento é feito só nos CIDs distintos e levado às linhas pelos códigos
+    do factorize. Retorna {'codigos': int16 por linha (-1 = nenhuma condição
+    ou sem coluna de CID), 'valores': nomes das condições, na ordem do catálogo}.
+    """
+    valores = pd.Index(list(catalogo))
+    if 'Codigo_do_CID' not in utilizacao.columns:
+        return {'codigos': np.full(len(utilizacao), -1, dtype=np.int16), 'valores': valores}
+    codigos, distintos = pd.factorize(utilizacao['Codigo_do_CID'])
+    por_codigo = np.append(classificar_prefixos(normalizar_cids(_rotulos(distintos)), catalogo), np.int16(-1))
+    return {'codigos': por_codigo[codigos], 'valores': valores}
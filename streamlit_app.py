@@ -1,14 +1,22 @@
 import pandas as pd
 import numpy as np
-from unidecode import unidecode
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go 
 from io import BytesIO
 import re
+import hashlib
+from concurrent.futures.process import BrokenProcessPool
 # Importação para tabelas interativas (AgGrid)
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, DataReturnMode
 from datetime import date # Importação adicional para garantir objetos de data puros
+from processamento import (preparar_dados, preparar_varios, hash_arquivo, hash_arquivos, salvar_snapshot, carregar_snapshot, listar_snapshots,
+                           normalize_name, nomes_por_id, id_por_nome, agregar_por_beneficiario, construir_indices,
+                           construir_cubo, agregar_cubo, coluna_codigo,
+                           coluna_sexo, coluna_plano,
+                           intervalo_valores, buscar_beneficiarios, aplicar_filtros, abas_relatorio, aba_exportacao, exportar_em_bytes, anexar_mes, carregar_historico, evolucao_historico, ler_manifesto,
+                           versao_historico, linhas_do_beneficiario, em_reais, centavos, somar_centavos, detectar_duplicados, agregar_linhas, reduzir_serie, top_n_com_outros, picos_de_utilizacao, COLUNAS_INTERNAS, EXTENSOES_EXPORTACAO,
+                           JANELA_DUPLICIDADE_DIAS, LIMIAR_ESCORE_ANOMALIA, JANELAS_UTILIZACAO, LIMITES_USO_FREQUENTE)
 
 # ---------------------------
 # 0. CONFIGURAÇÃO DE PÁGINA E TEMA
@@ -214,43 +222,373 @@ st.markdown("""
 # ---------------------------
 # 1. FUNÇÕES DE FORMATAÇÃO
 # ---------------------------
+def formatar_numeros_br(valores, casas=2, prefixo=''):
+    """Formata um array inteiro de números no padrão brasileiro (1.234,56) de uma vez, sem laço por valor.
+
+    Mesmo resultado de '{:,.<casas>f}' com os separadores trocados; NaN vira zero.
+    Os caracteres são montados numa matriz (valor x posição, alinhada à direita)
+    e lidos como strings de largura fixa. Retorna um array de strings.
+    """
+    valores = np.asarray(valores, dtype=np.float64).ravel()
+    negativos = np.signbit(valores) & ~np.isnan(valores)
+    unidades = np.round(np.abs(np.nan_to_num(valores)) * 10 ** casas).astype(np.int64)
+    # dígitos exibidos por valor (no mínimo "0,00")
+    total_digitos = len(str(int(unidades.max()))) if len(unidades) else 1
+    digitos = np.full(len(unidades), casas + 1)
+    for k in range(casas + 1, total_digitos):
+        digitos += unidades >= 10 ** k
+
+    # layout da direita para a esquerda: (caractere ou None para dígito, ordem do dígito que o exige)
+    layout = [(None, k) for k in range(casas)] + ([(',', casas)] if casas else [])
+    for k in range(casas, max(total_digitos, casas + 1)):
+        if k > casas and (k - casas) % 3 == 0:
+            layout.append(('.', k))
+        layout.append((None, k))
+    largura = len(layout)
+    matriz = np.full((len(unidades), largura), ord(' '), dtype=np.uint8)
+    for j, (caractere, k) in enumerate(layout):
+        codigo = 48 + (unidades // 10 ** k) % 10 if caractere is None else ord(caractere)
+        matriz[:, largura - 1 - j] = np.where(k < digitos, codigo, ord(' '))
+
+    texto = np.strings.lstrip(matriz.view(f'S{largura}').ravel()).astype(np.str_)
+    texto = np.where(negativos, np.strings.add('-', texto), texto)
+    return np.strings.add(prefixo, texto) if prefixo else texto
+
+
+def formatar_brl(valores):
+    """Versão vetorizada de format_brl: array de centavos -> array de strings 'R$ 1.234,56'."""
+    return formatar_numeros_br(em_reais(np.asarray(valores, dtype=np.float64)), casas=2, prefixo='R$ ')
+
+
 def format_brl(value):
-    """Formata um float ou int para string no padrão monetário brasileiro (R$ 1.234,56)"""
-    if pd.isna(value):
-        return "R$ 0,00"
-    # Garante que o valor é float antes de formatar
-    value = float(value) 
-    # Formata para string BR: ponto para milhar, vírgula para decimal
-    return "R$ {:,.2f}".format(value).replace(",", "TEMP").replace(".", ",").replace("TEMP", ".")
+    """Formata um valor em centavos para string no padrão monetário brasileiro (R$ 1.234,56).
+    Os valores monetários ficam em centavos em todo o dashboard e só viram reais aqui."""
+    return str(formatar_brl([value])[0])
 
 # FUNÇÃO: Formata o DataFrame inteiro com o padrão BR
 def style_dataframe_brl(df, value_cols=['Valor']):
     """Aplica formatação monetária BR em colunas específicas de um DataFrame.
-    Retorna um Styler para uso no st.dataframe."""
-    
-    # Criamos uma cópia do DF para aplicar o Styler
-    df_styled = df.copy() 
-    
-    formatters = {}
-    
+    Retorna um DataFrame com essas colunas já formatadas como texto (vetorizado, sem
+    Styler célula a célula); o DataFrame original não é alterado nem copiado."""
+    formatados = {}
+
     # 1. Colunas de Valor (R$ 1.234,56)
     for col in value_cols:
-        if col in df_styled.columns:
-            # Usamos a função format_brl como formatter
-            formatters[col] = format_brl
-    
+        if col in df.columns:
+            formatados[col] = formatar_brl(df[col].to_numpy())
+
     # 2. Colunas de Volume (1.234)
-    if 'Volume' in df_styled.columns and 'Volume' not in formatters:
-        # Formato de número inteiro com separador de milhar BR (ponto)
-        formatters['Volume'] = lambda x: '{:,.0f}'.format(x).replace(",", "TEMP").replace(".", ",").replace("TEMP", ".")
-        
-    if 0 in df_styled.columns and 0 not in formatters:
-        formatters[0] = lambda x: '{:,.0f}'.format(x).replace(",", "TEMP").replace(".", ",").replace("TEMP", ".")
+    for col in ['Volume', 0]:
+        if col in df.columns and col not in formatados:
+            formatados[col] = formatar_numeros_br(df[col].to_numpy(), casas=0)
+
+    if not formatados:
+        return df
+    # cópia rasa: as demais colunas continuam compartilhadas com o original (copy-on-write)
+    resultado = df.copy(deep=False)
+    for col, texto in formatados.items():
+        resultado[col] = texto
+    return resultado
+
+# FUNÇÃO: Tabela paginada no servidor (só a página visível vai para o navegador)
+OPCOES_LINHAS_POR_PAGINA = [25, 50, 100, 250]
+
+def tabela_paginada(df, chave, value_cols=['Valor']):
+    """Mostra `df` em páginas: filtro de texto, ordenação e paginação rodam no servidor
+    e só as linhas da página (já formatadas com style_dataframe_brl) são enviadas ao
+    navegador. Tabelas que cabem numa página são mostradas direto, sem controles.
+    `chave` prefixa as chaves dos widgets (precisa ser única na página)."""
+    if len(df) <= OPCOES_LINHAS_POR_PAGINA[0]:
+        st.dataframe(style_dataframe_brl(df, value_cols), use_container_width=True, hide_index=True)
+        return
+
+    col_filtro, col_ordem, col_sentido, col_tamanho = st.columns([3, 2, 1, 1])
+    with col_filtro:
+        termo = st.text_input("🔎 Filtrar", key=f"{chave}_filtro", placeholder="Texto em qualquer coluna...")
+    with col_ordem:
+        ordenar_por = st.selectbox("Ordenar por", ["(ordem atual)"] + list(df.columns), key=f"{chave}_ordem")
+    with col_sentido:
+        decrescente = st.toggle("Decrescente", key=f"{chave}_desc")
+    with col_tamanho:
+        tamanho = st.selectbox("Linhas", OPCOES_LINHAS_POR_PAGINA, index=1, key=f"{chave}_tamanho")
+
+    # posições das linhas visíveis: filtra e ordena sem copiar o DataFrame
+    posicoes = np.arange(len(df))
+    if termo:
+        encontrado = np.zeros(len(df), dtype=bool)
+        for col in df.columns:
+            if not pd.api.types.is_numeric_dtype(df[col]):
+                encontrado |= df[col].astype(str).str.contains(termo, case=False, regex=False).to_numpy()
+        posicoes = posicoes[encontrado]
+    if ordenar_por != "(ordem atual)":
+        coluna = df[ordenar_por].iloc[posicoes]
+        if not pd.api.types.is_numeric_dtype(coluna) and not pd.api.types.is_datetime64_any_dtype(coluna):
+            coluna = coluna.astype(str)
+        ordem = coluna.reset_index(drop=True).sort_values(ascending=not decrescente, kind='stable', na_position='last').index
+        posicoes = posicoes[ordem.to_numpy()]
+
+    paginas = max(1, -(-len(posicoes) // tamanho))
+    chave_pagina = f"{chave}_pagina"
+    if st.session_state.get(chave_pagina, 1) > paginas:
+        st.session_state[chave_pagina] = paginas
+    pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, step=1, key=chave_pagina)
+
+    inicio = (pagina - 1) * tamanho
+    visiveis = posicoes[inicio:inicio + tamanho]
+    st.dataframe(style_dataframe_brl(df.iloc[visiveis], value_cols), use_container_width=True, hide_index=True)
+    st.caption(f"Linhas {inicio + 1 if len(visiveis) else 0}–{inicio + len(visiveis)} de {len(posicoes):,}".replace(",", ".")
+               + (f" (filtradas de {len(df):,})".replace(",", ".") if termo else ""))
+
+# ---------------------------
+# 1.1. CACHE DE INGESTÃO
+# ---------------------------
+# Cada arquivo distinto fica em cache (compartilhado entre sessões) pelo hash do seu conteúdo.
+# O limite de entradas e o TTL evitam que a memória cresça sem controle com vários uploads.
+MAX_ARQUIVOS_EM_CACHE = 4
+TTL_CACHE_SEGUNDOS = 6 * 60 * 60
+# Meses da base histórica carregados por padrão (os mais recentes)
+MESES_HISTORICO_PADRAO = 12
+
+@st.cache_resource(max_entries=MAX_ARQUIVOS_EM_CACHE, ttl=TTL_CACHE_SEGUNDOS, show_spinner="⏳ Processando arquivo...")
+def carregar_dados(hash_conteudo, _conteudo=None, _nome_arquivo=''):
+    """Lê e limpa o arquivo (ou a lista [(nome, bytes)] de arquivos) uma única vez por conteúdo. Os parâmetros com `_`
+    não entram na chave do cache (o hash já identifica o arquivo).
+    Usa o snapshot Feather salvo em disco quando existe; senão processa o Excel
+    e grava o snapshot para as próximas sessões. Os índices (filtros etc.) são
+    montados aqui e ficam no mesmo cache.
+    Os DataFrames retornados são compartilhados: não devem ser alterados in-place."""
+    dados = carregar_snapshot(hash_conteudo)
+    if dados is None:
+        if isinstance(_conteudo, list):
+            try:
+                dados = preparar_varios(_conteudo)
+            except (BrokenProcessPool, OSError, RuntimeError):
+                # Pool de processos indisponível no servidor: lê os arquivos um a um
+                dados = preparar_varios(_conteudo, max_processos=1)
+        else:
+            dados = preparar_dados(_conteudo)
+        try:
+            salvar_snapshot(dados, hash_conteudo, _nome_arquivo)
+        except OSError as e:
+            st.warning(f"⚠️ Não foi possível salvar o snapshot dos dados processados: {e}")
+    return construir_indices(dados)
+
+@st.cache_resource(max_entries=2, ttl=TTL_CACHE_SEGUNDOS, show_spinner="⏳ Carregando base histórica...")
+def carregar_base_historica(versao, meses):
+    """Base histórica acumulada (partições Feather por mês), só com as partições de `meses`.
+    A chave inclui a versão da base, que muda a cada carga mensal, então uma nova carga
+    invalida o cache automaticamente."""
+    return construir_indices(carregar_historico(meses=meses))
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def calcular_cubo(hash_conteudo, hash_filtros, _dados, _mask_util):
+    """Cubo (beneficiário, mês, plano, código) -> (Valor, Volume), calculado uma vez por
+    estado dos filtros. A chave do cache é o hash do arquivo + o hash da máscara de filtros."""
+    return construir_cubo(_dados['utilizacao'], _mask_util, _dados['dimensoes_cubo'])
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def calcular_duplicados(hash_conteudo, janela_dias, _dados):
+    """Cobranças duplicadas do arquivo inteiro, uma vez por (arquivo, janela); os filtros são aplicados depois."""
+    return detectar_duplicados(_dados['utilizacao'], janela_dias)
+
+# ---------------------------
+# 1.2. AGREGADOS SOB DEMANDA (POR PAINEL)
+# ---------------------------
+# Cada painel declara em PAINEIS os agregados de que precisa. Só o painel visível é executado e
+# cada agregado é calculado uma vez por estado dos filtros (cache pela chave arquivo + filtros);
+# `contexto` traz o cubo, as dimensões, os DataFrames filtrados e a máscara do estado atual.
+def _agregado_benef(contexto):
+    """Custo e volume por beneficiário (índice = ID inteiro; nomes só para exibição)."""
+    if 'ID_Beneficiario' not in contexto['utilizacao_filtrada'].columns:
+        return None
+    agregado = agregar_cubo(contexto['cubo'], ['ID_Beneficiario']).set_index('ID_Beneficiario')
+    agregado.insert(0, 'Nome_do_Associado', nomes_por_id(contexto['beneficiarios'], agregado.index))
+    return agregado
+
+def _por_dimensao(dim, coluna=None):
+    """Agregado do cubo por uma dimensão (None se a dimensão não existir no arquivo)."""
+    def calcular(contexto):
+        if dim not in contexto['dimensoes']:
+            return None
+        resultado = agregar_cubo(contexto['cubo'], [dim], contexto['dimensoes'])
+        return resultado.rename(columns={dim: coluna}) if coluna else resultado
+    return calcular
+
+def _cubo_municipio(contexto):
+    """Células (beneficiário x código) do cubo com o município do beneficiário (pelo ID inteiro)."""
+    cadastro_filtrado = contexto['cadastro_filtrado']
+    if 'codigo' not in contexto['dimensoes'] or 'Municipio_do_Participante' not in cadastro_filtrado.columns:
+        return None
+    df_merge = agregar_cubo(contexto['cubo'], ['ID_Beneficiario', 'codigo']).merge(
+        cadastro_filtrado[['ID_Beneficiario', 'Municipio_do_Participante']].drop_duplicates(),
+        on='ID_Beneficiario',
+        how='left'
+    )
+    # Coluna pode ser categórica (otimizar_tipos): vira object para aceitar o rótulo novo
+    df_merge['Municipio_do_Participante'] = df_merge['Municipio_do_Participante'].astype(object).fillna('Desconhecido')
+    return df_merge
+
+def _ids_busca(contexto):
+    """Máscara (por ID) dos beneficiários presentes no cadastro ou na utilização filtrados."""
+    permitidos = np.zeros(len(contexto['beneficiarios']), dtype=bool)
+    for df_ids in (contexto['cadastro_filtrado'], contexto['utilizacao_filtrada']):
+        if 'ID_Beneficiario' in df_ids.columns:
+            ids = df_ids['ID_Beneficiario'].to_numpy()
+            permitidos[ids[ids >= 0]] = True
+    return permitidos
+
+def _uso_frequente(nivel):
+    """Picos de utilização em janelas móveis (7/30/90 dias) por beneficiário ou por beneficiário + código."""
+    def calcular(contexto):
+        utilizacao_filtrada = contexto['utilizacao_filtrada']
+        chaves = ['ID_Beneficiario'] if nivel == 'beneficiario' else ['ID_Beneficiario', coluna_codigo(utilizacao_filtrada)]
+        if None in chaves:
+            return None
+        picos = picos_de_utilizacao(utilizacao_filtrada, chaves, LIMITES_USO_FREQUENTE[nivel])
+        return picos[picos['Uso_Frequente']].drop(columns='Uso_Frequente')
+    return calcular
+
+def _por_condicao(contexto):
+    """Custo e prevalência por condição crônica (catálogo casado com os CIDs na ingestão).
+
+    Prevalência = beneficiários com a condição / beneficiários com atendimento no filtro.
+    """
+    utilizacao_filtrada = contexto['utilizacao_filtrada']
+    if 'ID_Beneficiario' not in utilizacao_filtrada.columns or 'Valor' not in utilizacao_filtrada.columns:
+        return None
+    nomes = contexto['condicoes']['valores']
+    codigos = contexto['condicoes']['codigos'][contexto['mask_util']].astype(np.int64)
+    ids = utilizacao_filtrada['ID_Beneficiario'].to_numpy().astype(np.int64)
+    com_condicao = codigos >= 0
+    atendimentos = np.bincount(codigos[com_condicao], minlength=len(nomes))
+    valor = somar_centavos(codigos[com_condicao], centavos(utilizacao_filtrada)[com_condicao], len(nomes))
+    # Pares (condição, beneficiário) distintos numa única chave inteira
+    n_ids = len(contexto['beneficiarios'])
+    pares = np.unique(codigos[com_condicao & (ids >= 0)] * n_ids + ids[com_condicao & (ids >= 0)])
+    pessoas = np.bincount(pares // n_ids, minlength=len(nomes))
+    total_pessoas = max(len(np.unique(ids[ids >= 0])), 1)
+    resultado = pd.DataFrame({
+        'Condição': nomes,
+        'Beneficiários': pessoas,
+        'Prevalência (%)': (100 * pessoas / total_pessoas).round(1),
+        'Atendimentos': atendimentos,
+        'Valor': valor,
+        'Custo por Beneficiário': valor // np.maximum(pessoas, 1),
+    })
+    return resultado[resultado['Atendimentos'] > 0].sort_values('Valor', ascending=False).reset_index(drop=True)
+
+AGREGADOS = {
+    'totais': lambda contexto: agregar_cubo(contexto['cubo']),
+    'agregado_benef': _agregado_benef,
+    'evolucao_mensal': _por_dimensao('mes', 'Mes_Ano'),
+    'por_plano': _por_dimensao('plano'),
+    'por_codigo': _por_dimensao('codigo'),
+    'cubo_municipio': _cubo_municipio,
+    'ids_busca': _ids_busca,
+    'uso_frequente_benef': _uso_frequente('beneficiario'),
+    'uso_frequente_codigo': _uso_frequente('procedimento'),
+    'por_condicao': _por_condicao,
+}
+
+PAINEIS = {
+    "📊 KPIs Gerais": ['totais', 'agregado_benef', 'evolucao_mensal', 'cubo_municipio'],
+    "📈 Comparativo": ['por_plano'],
+    "🚨 Alertas": ['agregado_benef', 'ids_busca', 'uso_frequente_benef', 'uso_frequente_codigo'],
+    "🏥 Análise Médica": ['por_codigo', 'por_condicao'],
+    "🔍 Busca": ['agregado_benef', 'ids_busca'],
+    "📤 Exportação": [],
+}
+
+# Widgets com estado que deve sobreviver à troca de aba
+WIDGETS_PERSISTENTES = ["busca_input", "busca_selectbox", "municipio_ranking", "custo_lim_🚨 Alertas", "vol_lim_🚨 Alertas", "janela_duplicidade", "limiar_escore", "condicao_cronica"]
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def calcular_agregado(nome, hash_conteudo, hash_filtros, _contexto):
+    """Um agregado de AGREGADOS, em cache por (nome, arquivo, estado dos filtros)."""
+    return AGREGADOS[nome](_contexto)
+
+def agregados_do_painel(painel, hash_conteudo, hash_filtros, contexto):
+    """Calcula (ou lê do cache) apenas os agregados declarados pelo painel."""
+    return {nome: calcular_agregado(nome, hash_conteudo, hash_filtros, contexto) for nome in PAINEIS.get(painel, [])}
 
-    # Aplica o estilo.
-    if formatters:
-        return df_styled.style.format(formatters)
-    return df_styled
+# ---------------------------
+# 1.3. GRÁFICOS EM CACHE
+# ---------------------------
+# Cada figura é montada uma vez por (gráfico, arquivo, estado dos filtros, parâmetro extra) e
+# reaproveitada nos reruns seguintes; séries longas e barras com muitas categorias são reduzidas antes.
+@st.cache_resource(max_entries=64, show_spinner=False)
+def figura_em_cache(id_grafico, hash_conteudo, hash_filtros, extra, _construir):
+    """Figura Plotly em cache. `extra` diferencia variações do mesmo gráfico (município,
+    beneficiário...); `_construir` monta a figura e não entra na chave."""
+    return _construir()
+
+def figura_evolucao(evolucao, cor_linha, cor_marcador, cor_preenchimento):
+    """Linha de custo por mês (Mes_Ano x Valor), reduzida por LTTB se for longa."""
+    serie = reduzir_serie(evolucao, 'Valor')
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=serie['Mes_Ano'],
+        y=em_reais(serie['Valor']),
+        mode='lines+markers',
+        name='Custo',
+        line=dict(color=cor_linha, width=3),
+        marker=dict(size=8, color=cor_marcador),
+        fill='tozeroy',
+        fillcolor=cor_preenchimento
+    ))
+    fig.update_layout(
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        xaxis=dict(showgrid=True, gridcolor='#f0f0f0'),
+        yaxis=dict(showgrid=True, gridcolor='#f0f0f0', tickprefix="R$ ", tickformat=",.2f"),
+        hovermode='x unified',
+        height=400
+    )
+    return fig
+
+def figura_barras_plano(comp, plano_col, medida, titulo, escala, monetario):
+    """Barras de `medida` por plano (top-N + "Outros" quando há muitos planos)."""
+    comp = top_n_com_outros(comp, plano_col, medida)
+    texto = formatar_brl(comp[medida].to_numpy()) if monetario else comp[medida]
+    y = em_reais(comp[medida]) if monetario else comp[medida]
+    fig = go.Figure(data=[go.Bar(
+        x=comp[plano_col],
+        y=y,
+        marker=dict(
+            color=y,
+            colorscale=escala,
+            showscale=True
+        ),
+        text=texto,
+        textposition='outside'
+    )])
+    fig.update_layout(
+        title=titulo,
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        height=400
+    )
+    if monetario:
+        fig.update_layout(yaxis=dict(tickprefix="R$ ", tickformat=",.2f"))
+    return fig
+
+def figura_top_codigos(top10_ranking, selected_municipio):
+    """Barras horizontais dos 10 códigos/procedimentos de maior volume no município."""
+    fig_cod = px.bar(
+        top10_ranking.assign(**{'Custo Total': em_reais(top10_ranking['Custo Total'])}),
+        x='Custo Total',
+        y='Código/Procedimento',
+        orientation='h',
+        title=f'Top 10 Códigos/Procedimentos por Custo em {selected_municipio}',
+        color='Custo Total',
+        color_continuous_scale=px.colors.sequential.Plasma
+    )
+    fig_cod.update_layout(
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        yaxis={'categoryorder':'total ascending'}
+    )
+    return fig_cod
 
 # ---------------------------
 # 2. AUTENTICAÇÃO
@@ -332,80 +670,101 @@ if st.session_state.logged_in:
     # ---------------------------
     # 4. Upload do arquivo
     # ---------------------------
-    uploaded_file = st.file_uploader("📁 Escolha o arquivo .xltx ou .xlsx", type=["xlsx", "xltx"])
-    if uploaded_file is not None:
-        # Leitura das abas
-        utilizacao = pd.read_excel(uploaded_file, sheet_name='Utilizacao')
-        cadastro = pd.read_excel(uploaded_file, sheet_name='Cadastro')
-        try:
-            medicina_trabalho = pd.read_excel(uploaded_file, sheet_name='Medicina_do_Trabalho')
-        except:
-            medicina_trabalho = pd.DataFrame()
-        try:
-            atestados = pd.read_excel(uploaded_file, sheet_name='Atestados')
-        except:
-            atestados = pd.DataFrame()
-
-        # ---------------------------
-        # 5. Padronização e Limpeza de Dados
-        # ---------------------------
-        def clean_cols(df):
-            df.columns = [unidecode(col).strip().replace(' ','_').replace('-','_') for col in df.columns]
-            return df
-        utilizacao = clean_cols(utilizacao)
-        cadastro = clean_cols(cadastro)
-        medicina_trabalho = clean_cols(medicina_trabalho)
-        atestados = clean_cols(atestados)
-
-        # Conversão de datas
-        date_cols_util = ['Data_do_Atendimento','Competencia','Data_de_Nascimento']
-        date_cols_cad = ['Data_de_Nascimento','Data_de_Admissao_do_Empregado','Data_de_Adesao_ao_Plano','Data_de_Cancelamento']
-        date_cols_med = ['Data_do_Exame']
-        date_cols_at = ['Data_do_Afastamento']
-
-        for col in date_cols_util:
-            if col in utilizacao.columns:
-                utilizacao[col] = pd.to_datetime(utilizacao[col], errors='coerce')
-        for col in date_cols_cad:
-            if col in cadastro.columns:
-                cadastro[col] = pd.to_datetime(cadastro[col], errors='coerce')
-        for col in date_cols_med:
-            if col in medicina_trabalho.columns:
-                medicina_trabalho[col] = pd.to_datetime(medicina_trabalho[col], errors='coerce')
-        for col in date_cols_at:
-            if col in atestados.columns:
-                atestados[col] = pd.to_datetime(atestados[col], errors='coerce')
-
-        # CONVERSÃO DE VALORES DE AMERICANO PARA FLOAT:
-        if 'Valor' in utilizacao.columns:
-            try:
-                # Tenta limpar e converter se for string (Remove R$, espaços e vírgulas de milhar, deixando apenas o ponto decimal)
-                if utilizacao['Valor'].dtype == 'object' or utilizacao['Valor'].dtype == np.dtype('object'):
-                    # Tenta tratar o cenário 1: Padrão Americano (ponto decimal) com vírgula de milhar. Ex: '58,146.17'
-                    utilizacao.loc[:, 'Valor'] = (utilizacao['Valor']
-                                                  .astype(str)
-                                                  .str.replace(r'[^\d\.\,]', '', regex=True) # Remove tudo que não for digito, ponto ou vírgula
-                                                  .str.replace(',', '', regex=False) # Remove vírgula de milhar
-                                                 )
-                    # O resultado agora deve ser '58146.17' (ponto decimal). Converte para float.
-                
-                # Para evitar problemas de SettingWithCopyWarning
-                utilizacao.loc[:, 'Valor'] = pd.to_numeric(utilizacao['Valor'], errors='coerce')
-                
-            except Exception as e:
-                st.warning(f"⚠️ Erro ao converter a coluna 'Valor' para numérico: {e}")
-
+    fonte = st.radio("🗂️ Fonte dos dados", ["📁 Arquivo completo", "📚 Base histórica (carga mensal)"], horizontal=True)
+    usar_historico = fonte.startswith("📚")
+
+    # Opção de reabrir o último arquivo processado (snapshot em disco) sem novo upload
+    snapshots = [] if usar_historico else listar_snapshots()
+    usar_snapshot = False
+    if snapshots:
+        ultimo_snapshot = snapshots[0]
+        usar_snapshot = st.checkbox(
+            f"💾 Reabrir último arquivo processado ({ultimo_snapshot.get('arquivo') or 'sem nome'}, salvo em {ultimo_snapshot['salvo_em'].replace('T', ' ')})"
+        )
 
+    # Vários arquivos (um por empresa, mesmo layout) são lidos em paralelo e consolidados com a coluna 'Empresa'
+    uploaded_files = [] if usar_snapshot or usar_historico else st.file_uploader(
+        "📁 Escolha um ou mais arquivos .xltx ou .xlsx (um por empresa)", type=["xlsx", "xltx"], accept_multiple_files=True
+    ) or []
+    hash_conteudo = None
+    nome_arquivo = ''
+    if usar_historico:
+        # Só o extrato do mês é lido; o histórico fica em disco e não é reprocessado
+        with st.expander("➕ Adicionar extrato mensal à base", expanded=not ler_manifesto()['meses']):
+            arquivo_mes = st.file_uploader("Extrato do mês (.xlsx)", type=["xlsx", "xltx"], key="upload_mensal")
+            if arquivo_mes is not None and st.button("Adicionar à base histórica"):
+                with st.spinner("⏳ Processando extrato do mês..."):
+                    try:
+                        carga = anexar_mes(arquivo_mes.getvalue(), arquivo_mes.name)
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
+                        carga = None
+                if carga is None:
+                    pass
+                elif carga.get('repetida'):
+                    st.info(f"ℹ️ Este arquivo já foi carregado em {carga['anexado_em'].replace('T', ' ')}.")
+                else:
+                    novas = f"{carga['novas']:,}".replace(",", ".")
+                    duplicadas = f"{carga['duplicadas']:,}".replace(",", ".")
+                    st.success(f"✅ {novas} atendimentos novos ({', '.join(carga['meses']) or 'nenhum mês'}); "
+                               f"{duplicadas} já existiam e foram ignorados.")
+        # KPIs e tendência da base inteira vêm dos totais do manifesto, sem ler as partições
+        evolucao_base = evolucao_historico()
+        meses_base = evolucao_base['Mes_Ano'].tolist()
+        meses_carregados = ('sem_data',)
+        if meses_base:
+            st.caption(f"📚 Base histórica: {len(meses_base)} meses ({meses_base[0]} a {meses_base[-1]})")
+            col_base1, col_base2 = st.columns(2)
+            with col_base1:
+                st.metric("💰 Custo Total da Base", format_brl(int(evolucao_base['Valor'].sum())))
+            with col_base2:
+                st.metric("📋 Atendimentos na Base", f"{int(evolucao_base['Volume'].sum()):,.0f}".replace(",", "."))
+            st.plotly_chart(figura_evolucao(evolucao_base, '#667eea', '#764ba2', 'rgba(102, 126, 234, 0.1)'), use_container_width=True)
+            # Só as partições dos meses escolhidos são lidas para as análises detalhadas
+            mes_inicio, mes_fim = st.select_slider(
+                "🗓️ Meses carregados para análise", options=meses_base,
+                value=(meses_base[max(len(meses_base) - MESES_HISTORICO_PADRAO, 0)], meses_base[-1]),
+            )
+            meses_carregados = tuple(mes for mes in meses_base if mes_inicio <= mes <= mes_fim)
+        versao = versao_historico()
+        hash_conteudo = f"{versao}-{meses_carregados[0]}-{meses_carregados[-1]}" if versao else None
+    elif len(uploaded_files) == 1:
+        conteudo = uploaded_files[0].getvalue()
+        hash_conteudo = hash_arquivo(conteudo)
+        nome_arquivo = uploaded_files[0].name
+    elif uploaded_files:
+        conteudo = [(arquivo.name, arquivo.getvalue()) for arquivo in uploaded_files]
+        hash_conteudo = hash_arquivos(conteudo)
+        nome_arquivo = ', '.join(sorted(arquivo.name for arquivo in uploaded_files))
+    elif usar_snapshot:
+        conteudo = None
+        hash_conteudo = ultimo_snapshot['hash']
+
+    if hash_conteudo is not None:
         # ---------------------------
-        # 6. Tipo Beneficiário
+        # 5. Leitura, Padronização e Limpeza de Dados
         # ---------------------------
-        if 'Nome_Titular' in utilizacao.columns and 'Nome_do_Associado' in utilizacao.columns:
-            utilizacao['Tipo_Beneficiario'] = np.where(
-                utilizacao['Nome_Titular'] == utilizacao['Nome_do_Associado'],
-                'Titular', 'Dependente'
-            )
+        # Feitas uma única vez por arquivo (processamento.preparar_dados), com cache pelo hash do conteúdo
+        if usar_historico:
+            dados = carregar_base_historica(hash_conteudo, meses_carregados)
         else:
-            utilizacao['Tipo_Beneficiario'] = 'Desconhecido'
+            dados = carregar_dados(hash_conteudo, conteudo, nome_arquivo)
+        utilizacao = dados['utilizacao']
+        cadastro = dados['cadastro']
+        medicina_trabalho = dados['medicina_trabalho']
+        atestados = dados['atestados']
+        beneficiarios = dados['beneficiarios'] # Dimensão ID -> nome (nomes só são usados para exibição)
+        st.caption("⏱️ Leitura por aba: " + " · ".join(
+            f"{aba} {segundos:.2f}s" for aba, segundos in dados['tempos_leitura'].items()
+        ))
+        memoria = dados.get('memoria', {})
+        if memoria:
+            antes = sum(m['antes'] for m in memoria.values()) / 1024 ** 2
+            depois = sum(m['depois'] for m in memoria.values()) / 1024 ** 2
+            st.caption(f"💾 Memória das abas: {antes:.1f} MB → {depois:.1f} MB (tipos otimizados)".replace(".", ","))
+        for coluna, quantidade in dados.get('valores_invalidos', {}).items():
+            if quantidade:
+                st.warning(f"⚠️ {quantidade:,} valor(es) da coluna '{coluna}' não puderam ser convertidos e foram ignorados nos totais.".replace(",", "."))
 
         # ---------------------------
         # 7. Filtros Sidebar
@@ -413,41 +772,51 @@ if st.session_state.logged_in:
         st.sidebar.markdown("---")
         st.sidebar.markdown("### 🎯 Filtros")
         
+        # Índice pré-calculado na ingestão: opções e máscaras dos filtros sem varrer os DataFrames
+        indice_cad = dados['indice_filtros']['cadastro']
+        indice_util = dados['indice_filtros']['utilizacao']
+
+        # Empresa (só quando vários arquivos foram consolidados)
+        empresa_filtro = None
+        if 'Empresa' in indice_util:
+            empresa_opts = list(indice_util['Empresa']['valores'])
+            empresa_filtro = st.sidebar.multiselect("🏢 Empresa", options=empresa_opts, default=empresa_opts)
+
         # Sexo
-        possible_sexo_cols = [col for col in cadastro.columns if 'sexo' in col.lower()]
-        sexo_col = possible_sexo_cols[0] if possible_sexo_cols else None
-        sexo_opts = cadastro[sexo_col].dropna().unique() if sexo_col else []
+        sexo_col = coluna_sexo(cadastro)
+        sexo_opts = list(indice_cad[sexo_col]['valores']) if sexo_col else []
         sexo_filtro = st.sidebar.multiselect("👤 Sexo", options=sexo_opts, default=sexo_opts)
 
         # Tipo Beneficiário
+        tipo_benef_opts = list(indice_util['Tipo_Beneficiario']['valores'])
         tipo_benef_filtro = st.sidebar.multiselect(
             "👥 Tipo Beneficiário",
-            options=utilizacao['Tipo_Beneficiario'].unique(),
-            default=utilizacao['Tipo_Beneficiario'].unique()
+            options=tipo_benef_opts,
+            default=tipo_benef_opts
         )
         
         # NOVO: Filtro Global de Planos
-        possible_plano_cols = [col for col in utilizacao.columns if 'plano' in col.lower() and 'descricao' in col.lower()]
-        plano_col = possible_plano_cols[0] if possible_plano_cols else None
-        plano_opts = utilizacao[plano_col].dropna().unique() if plano_col else []
+        plano_col = coluna_plano(utilizacao)
+        plano_opts = list(indice_util[plano_col]['valores']) if plano_col else []
         plano_filtro = st.sidebar.multiselect("🛡️ Plano Contratado", options=plano_opts, default=plano_opts)
 
 
         # Município
         municipio_filtro = None
         if 'Municipio_do_Participante' in cadastro.columns:
-            municipio_opts = cadastro['Municipio_do_Participante'].dropna().unique()
+            municipio_opts = list(indice_cad['Municipio_do_Participante']['valores'])
             municipio_filtro = st.sidebar.multiselect("📍 Município", options=municipio_opts, default=municipio_opts)
 
         # Faixa etária
         idade_col = 'Data_de_Nascimento'
         min_age, max_age = 0, 100
         if idade_col in cadastro.columns:
-            # Cálculo de idade para obter o min/max real, se aplicável
-            idade_real = (pd.Timestamp.today() - cadastro[idade_col]).dt.days // 365
-            if not idade_real.empty:
-                min_age = max(0, int(idade_real.min()))
-                max_age = int(idade_real.max())
+            # Idades extremas a partir das datas de nascimento já ordenadas no índice
+            nasc_min, nasc_max = intervalo_valores(indice_cad[idade_col])
+            if nasc_min is not None:
+                hoje = pd.Timestamp.today()
+                min_age = max(0, (hoje - pd.Timestamp(nasc_max)).days // 365)
+                max_age = (hoje - pd.Timestamp(nasc_min)).days // 365
                 
         # O slider usará 0-100 como range, mas os defaults serão calculados ou o padrão 18-65
         default_min = 18 if min_age < 18 else min_age
@@ -457,16 +826,17 @@ if st.session_state.logged_in:
         # Período - CORREÇÃO DE ROBUSTEZ AQUI
         # 1. Tenta pegar a data real dos dados, se não conseguir, usa o default.
         data_atend_col = 'Data_do_Atendimento'
-        periodo_min_initial = utilizacao[data_atend_col].min() if data_atend_col in utilizacao.columns and not utilizacao.empty else None
-        periodo_max_initial = utilizacao[data_atend_col].max() if data_atend_col in utilizacao.columns and not utilizacao.empty else None
+        periodo_min_initial, periodo_max_initial = None, None
+        if data_atend_col in utilizacao.columns:
+            periodo_min_initial, periodo_max_initial = intervalo_valores(indice_util[data_atend_col])
         
         # 2. Define defaults (usando datetime.date)
         periodo_min_default = (pd.Timestamp.today().normalize() - pd.DateOffset(years=1)).date()
         periodo_max_default = pd.Timestamp.today().normalize().date()
         
         # 3. Usa data inicial se for válida (not NaT), senão usa o default
-        periodo_min = periodo_min_initial.date() if pd.notna(periodo_min_initial) else periodo_min_default
-        periodo_max = periodo_max_initial.date() if pd.notna(periodo_max_initial) else periodo_max_default
+        periodo_min = pd.Timestamp(periodo_min_initial).date() if periodo_min_initial is not None else periodo_min_default
+        periodo_max = pd.Timestamp(periodo_max_initial).date() if periodo_max_initial is not None else periodo_max_default
 
         # O st.date_input retorna uma lista/tuple de datetime.date
         periodo = st.sidebar.date_input("📆 Período", [periodo_min, periodo_max])
@@ -484,79 +854,45 @@ if st.session_state.logged_in:
         # ---------------------------
         # 8. Aplicar filtros
         # ---------------------------
-        cadastro_filtrado = cadastro.copy()
-        if idade_col in cadastro_filtrado.columns:
-            idade = (pd.Timestamp.today() - cadastro_filtrado[idade_col]).dt.days // 365
-            # Aplica o filtro de Faixa Etária
-            cadastro_filtrado = cadastro_filtrado[(idade >= faixa_etaria[0]) & (idade <= faixa_etaria[1])]
-        
-        # Filtro de Sexo
-        if sexo_filtro and sexo_col:
-            cadastro_filtrado = cadastro_filtrado[cadastro_filtrado[sexo_col].isin(sexo_filtro)]
-            
-        # Filtro de Município
-        if municipio_filtro is not None:
-            if 'Municipio_do_Participante' in cadastro_filtrado.columns:
-                cadastro_filtrado = cadastro_filtrado[cadastro_filtrado['Municipio_do_Participante'].isin(municipio_filtro)]
+        # Os filtros são combinados em máscaras booleanas (AND) sobre o índice (processamento.aplicar_filtros,
+        # a mesma usada pelo pipeline em lote); os DataFrames filtrados são materializados uma única vez.
+        mask_cad, mask_util = aplicar_filtros(
+            dados,
+            sexo=sexo_filtro,
+            tipo_beneficiario=tipo_benef_filtro,
+            plano=plano_filtro,
+            municipio=municipio_filtro,
+            faixa_etaria=faixa_etaria,
+            periodo=(periodo_start, periodo_end),
+            empresa=empresa_filtro,
+        )
 
-        utilizacao_filtrada = utilizacao.copy()
-        
-        # Filtro de Tipo Beneficiário
-        if tipo_benef_filtro:
-            utilizacao_filtrada = utilizacao_filtrada[utilizacao_filtrada['Tipo_Beneficiario'].isin(tipo_benef_filtro)]
-            
-        # Filtro de Plano
-        if plano_filtro and plano_col:
-            utilizacao_filtrada = utilizacao_filtrada[utilizacao_filtrada[plano_col].isin(plano_filtro)]
-
-        # garantir que filtragem cruze com cadastro filtrado se houver Nome_do_Associado em ambas
-        benef_col = 'Nome_do_Associado'
-        if benef_col in utilizacao_filtrada.columns and benef_col in cadastro_filtrado.columns:
-            # Lista de beneficiários válidos após filtros do cadastro (faixa, sexo, município)
-            benef_validos = cadastro_filtrado[benef_col].dropna().unique()
-            utilizacao_filtrada = utilizacao_filtrada[utilizacao_filtrada[benef_col].isin(benef_validos)]
-            
-        # Filtro de Período
-        data_col = 'Data_do_Atendimento'
-        if data_col in utilizacao_filtrada.columns:
-            utilizacao_filtrada = utilizacao_filtrada[
-                (utilizacao_filtrada[data_col] >= periodo_start) & # Usa periodo_start e periodo_end (Timestamp)
-                (utilizacao_filtrada[data_col] <= periodo_end)
-            ]
-        # REFILTRAR CADASTRO após a filtragem da utilização para garantir lista de nomes completa
-        if benef_col in utilizacao_filtrada.columns and benef_col in cadastro_filtrado.columns:
-             benef_utilizados = utilizacao_filtrada[benef_col].dropna().unique()
-             cadastro_filtrado = cadastro_filtrado[cadastro_filtrado[benef_col].isin(benef_utilizados)]
+        cadastro_filtrado = cadastro[mask_cad]
+        utilizacao_filtrada = utilizacao[mask_util]
 
 
         # ---------------------------
-        # 9. Preparar lista de nomes para busca
+        # 9. Cubo de agregados (uma vez por estado dos filtros)
         # ---------------------------
-        nomes_from_cad = set()
-        if 'Nome_do_Associado' in cadastro_filtrado.columns:
-            nomes_from_cad = set(cadastro_filtrado['Nome_do_Associado'].dropna().unique())
-        nomes_from_util = set()
-        if 'Nome_do_Associado' in utilizacao_filtrada.columns:
-            nomes_from_util = set(utilizacao_filtrada['Nome_do_Associado'].dropna().unique())
-
-        nomes_possiveis = sorted(list(nomes_from_cad.union(nomes_from_util)))
+        # Todas as abas leem totais, séries mensais, rankings por plano/código e agregados por
+        # beneficiário deste cubo, em vez de refazer groupbys sobre a utilização filtrada.
+        dimensoes_cubo = dados['dimensoes_cubo']
+        cubo = calcular_cubo(hash_conteudo, hashlib.md5(mask_util.tobytes()).hexdigest(), dados, mask_util)
+
+        # Os agregados de cada painel (AGREGADOS/PAINEIS) são calculados só quando o painel é exibido
+        hash_filtros = hashlib.md5(mask_util.tobytes() + mask_cad.tobytes()).hexdigest()
+        contexto_agregados = {
+            'cubo': cubo,
+            'dimensoes': dimensoes_cubo,
+            'beneficiarios': beneficiarios,
+            'cadastro_filtrado': cadastro_filtrado,
+            'utilizacao_filtrada': utilizacao_filtrada,
+            'mask_util': mask_util,
+            'condicoes': dados['condicoes'],
+        }
 
-        def normalize_name(s):
-            return unidecode(str(s)).strip().upper()
-
-        nomes_norm_map = {normalize_name(n): n for n in nomes_possiveis}
-        
-        # ---------------------------
-        # 9.1. Função para encontrar a coluna de COD
-        # ---------------------------
-        def get_cod_col(df):
-            if 'Nome_do_Procedimento' in df.columns:
-                return 'Nome_do_Procedimento'
-            elif 'Codigo_do_Procedimento' in df.columns:
-                return 'Codigo_do_Procedimento'
-            elif 'Codigo_do_CID' in df.columns:
-                return 'Codigo_do_CID'
-            return None
+        # Coluna de código (procedimento ou CID) usada como dimensão 'codigo' do cubo
+        cod_col = coluna_codigo(utilizacao_filtrada)
 
 
         # ---------------------------
@@ -571,547 +907,492 @@ if st.session_state.logged_in:
         else:
             tabs = []
         
-        tab_objects = st.tabs(tabs)
-        
+        # Só a aba selecionada é executada (st.tabs executaria o conteúdo de todas a cada interação).
+        # O Streamlit descarta o estado de widgets não exibidos; re-atribuir mantém busca, seleção
+        # e limites ao voltar para a aba.
+        for chave in WIDGETS_PERSISTENTES:
+            if chave in st.session_state:
+                st.session_state[chave] = st.session_state[chave]
+        tab_name = st.radio("Aba", tabs, horizontal=True, key="aba_ativa", label_visibility="collapsed") if tabs else None
+        st.markdown("---")
+
         # ---------------------------
         # 11. Implementação do Conteúdo das Tabs
         # ---------------------------
+        agregados = agregados_do_painel(tab_name, hash_conteudo, hash_filtros, contexto_agregados) if tab_name else {}
+        agregado_benef = agregados.get('agregado_benef')
 
-        for i, tab_name in enumerate(tabs):
-            with tab_objects[i]:
-                
-                # --- ABA: KPIs GERAIS (RH) ---
-                if tab_name == "📊 KPIs Gerais":
-                    st.markdown("### 📌 Indicadores Principais")
-                    
-                    # Métricas em cards
-                    custo_total = utilizacao_filtrada['Valor'].sum() if 'Valor' in utilizacao_filtrada.columns else 0
-                    volume_total = len(utilizacao_filtrada)
-                    num_beneficiarios = utilizacao_filtrada['Nome_do_Associado'].nunique() if 'Nome_do_Associado' in utilizacao_filtrada.columns else 0
-                    custo_medio = custo_total / num_beneficiarios if num_beneficiarios > 0 else 0
-
-                    
-                    # PRIMEIRA LINHA: Custo Total e Atendimentos
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.metric("💰 Custo Total", format_brl(custo_total))
-                    with col2:
-                        st.metric("📋 Atendimentos", f"{volume_total:,.0f}".replace(",", "."))
-                    
-                    # SEGUNDA LINHA: Beneficiários e Custo Médio
-                    col3, col4 = st.columns(2)
-                    with col3:
-                        st.metric("👥 Beneficiários", f"{num_beneficiarios:,.0f}".replace(",", "."))
-                    with col4:
-                        st.metric("📊 Custo Médio por Beneficiário", format_brl(custo_medio))
-                    
-                    st.markdown("---")
-                    
-                    # Gráfico de evolução temporal
-                    if 'Data_do_Atendimento' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
-                        st.markdown("### 📈 Evolução de Custos por Mês")
-                        # Para evitar SettingWithCopyWarning
-                        utilizacao_filtrada_temp = utilizacao_filtrada.copy() 
-                        utilizacao_filtrada_temp['Mes_Ano'] = utilizacao_filtrada_temp['Data_do_Atendimento'].dt.to_period('M')
-                        evolucao = utilizacao_filtrada_temp.groupby('Mes_Ano')['Valor'].sum().reset_index()
-                        evolucao['Mes_Ano'] = evolucao['Mes_Ano'].astype(str)
-                        
-                        fig = go.Figure()
-                        fig.add_trace(go.Scatter(
-                            x=evolucao['Mes_Ano'],
-                            y=evolucao['Valor'],
-                            mode='lines+markers',
-                            name='Custo',
-                            line=dict(color='#667eea', width=3),
-                            marker=dict(size=8, color='#764ba2'),
-                            fill='tozeroy',
-                            fillcolor='rgba(102, 126, 234, 0.1)'
-                        ))
-
-                        fig.update_layout(
-                            plot_bgcolor='white',
-                            paper_bgcolor='white',
-                            xaxis=dict(showgrid=True, gridcolor='#f0f0f0'),
-                            yaxis=dict(showgrid=True, gridcolor='#f0f0f0', tickprefix="R$ ", tickformat=",.2f"),
-                            hovermode='x unified',
-                            height=400
-                        )
-                        st.plotly_chart(fig, use_container_width=True)
-
-                    # Top 20 beneficiários (AGORA É TOP 20)
-                    col1_top, col2_top = st.columns(2)
-                    
-                    with col1_top:
-                        if 'Nome_do_Associado' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
-                            st.markdown("### 💎 Top 20 por Custo")
-                            custo_por_benef = utilizacao_filtrada.groupby('Nome_do_Associado')['Valor'].sum().sort_values(ascending=False)
-                            df_custo = custo_por_benef.head(20).reset_index().rename(columns={'Nome_do_Associado':'Beneficiário','Valor':'Valor'})
-                            df_custo.insert(0, 'Ranking', range(1, 1 + len(df_custo)))
-                            st.dataframe(style_dataframe_brl(df_custo), use_container_width=True, height=400, hide_index=True)
-                            
-                            # Exportação do Top 20 Custo (NOVO)
-                            buf_top20 = BytesIO()
-                            df_custo_export = df_custo.copy()
-                            # Para exportação, removemos a formatação de R$
-                            df_custo_export['Valor'] = df_custo_export['Valor'].round(2)
-                            df_custo_export.to_excel(buf_top20, index=False)
-                            buf_top20.seek(0)
-                            st.download_button(
-                                label="📥 Exportar Top 20 Custo",
-                                data=buf_top20,
-                                file_name="top20_custo_beneficiarios.xlsx",
-                                mime="application/vnd.ms-excel",
-                                key="export_top20_custo"
-                            )
-                            
-                    with col2_top:
-                        if 'Nome_do_Associado' in utilizacao_filtrada.columns:
-                            st.markdown("### 📊 Top 20 por Volume")
-                            top20_volume = utilizacao_filtrada.groupby('Nome_do_Associado').size().sort_values(ascending=False)
-                            df_volume = top20_volume.head(20).reset_index().rename(columns={'Nome_do_Associado':'Beneficiário',0:'Volume'})
-                            df_volume.insert(0, 'Ranking', range(1, 1 + len(df_volume)))
-                            st.dataframe(style_dataframe_brl(df_volume, value_cols=[]), use_container_width=True, height=400, hide_index=True)
-
+        # --- ABA: KPIs GERAIS (RH) ---
+        if tab_name == "📊 KPIs Gerais":
+            st.markdown("### 📌 Indicadores Principais")
+            
+            # Métricas em cards
+            totais = agregados['totais']
+            custo_total = totais['Valor'] if 'Valor' in utilizacao_filtrada.columns else 0
+            volume_total = int(totais['Volume'])
+            num_beneficiarios = len(agregado_benef) if agregado_benef is not None else 0
+            custo_medio = custo_total / num_beneficiarios if num_beneficiarios > 0 else 0
 
-                    st.markdown("---")
-                    
-                    # Ranking de CODs por Município
-                    st.markdown("### 🗺️ Ranking de Procedimentos/CIDs por Município")
+            
+            # PRIMEIRA LINHA: Custo Total e Atendimentos
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("💰 Custo Total", format_brl(custo_total))
+            with col2:
+                st.metric("📋 Atendimentos", f"{volume_total:,.0f}".replace(",", "."))
+            
+            # SEGUNDA LINHA: Beneficiários e Custo Médio
+            col3, col4 = st.columns(2)
+            with col3:
+                st.metric("👥 Beneficiários", f"{num_beneficiarios:,.0f}".replace(",", "."))
+            with col4:
+                st.metric("📊 Custo Médio por Beneficiário", format_brl(custo_medio))
+            
+            st.markdown("---")
+            
+            # Gráfico de evolução temporal
+            if 'Data_do_Atendimento' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
+                st.markdown("### 📈 Evolução de Custos por Mês")
+                evolucao = agregados['evolucao_mensal']
+                fig = figura_em_cache('evolucao_mensal', hash_conteudo, hash_filtros, None,
+                                      lambda: figura_evolucao(evolucao, '#667eea', '#764ba2', 'rgba(102, 126, 234, 0.1)'))
+                st.plotly_chart(fig, use_container_width=True)
+
+            # Top 20 beneficiários (AGORA É TOP 20)
+            col1_top, col2_top = st.columns(2)
+            
+            with col1_top:
+                if agregado_benef is not None and 'Valor' in utilizacao_filtrada.columns:
+                    st.markdown("### 💎 Top 20 por Custo")
+                    custo_por_benef = agregado_benef.sort_values('Valor', ascending=False)
+                    df_custo = custo_por_benef.head(20)[['Nome_do_Associado', 'Valor']].reset_index(drop=True).rename(columns={'Nome_do_Associado':'Beneficiário'})
+                    df_custo.insert(0, 'Ranking', range(1, 1 + len(df_custo)))
+                    st.dataframe(style_dataframe_brl(df_custo), use_container_width=True, height=400, hide_index=True)
                     
-                    cod_col = get_cod_col(utilizacao_filtrada)
+                    # Exportação do Top 20 Custo (NOVO)
+                    buf_top20 = BytesIO()
+                    df_custo_export = df_custo.copy()
+                    # Para exportação, o valor vai em reais (número, sem a formatação de R$)
+                    df_custo_export['Valor'] = em_reais(df_custo_export['Valor'])
+                    df_custo_export.to_excel(buf_top20, index=False)
+                    buf_top20.seek(0)
+                    st.download_button(
+                        label="📥 Exportar Top 20 Custo",
+                        data=buf_top20,
+                        file_name="top20_custo_beneficiarios.xlsx",
+                        mime="application/vnd.ms-excel",
+                        key="export_top20_custo"
+                    )
                     
-                    if cod_col and 'Nome_do_Associado' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
-                        
-                        # 1. Merge com Município
-                        df_merge = utilizacao_filtrada.merge(
-                            cadastro_filtrado[['Nome_do_Associado', 'Municipio_do_Participante']].drop_duplicates(),
-                            on='Nome_do_Associado', 
-                            how='left'
-                        )
-                        df_merge['Municipio_do_Participante'] = df_merge['Municipio_do_Participante'].fillna('Desconhecido')
-                        
-                        # 2. Seletor de Município
-                        municipios_validos = sorted(df_merge['Municipio_do_Participante'].unique().tolist())
-                        selected_municipio = st.selectbox(
-                            "📍 Selecione o Município para Análise:", 
-                            options=["TODOS"] + municipios_validos
-                        )
-                        
-                        # 3. Filtragem por Município
-                        if selected_municipio != "TODOS":
-                            df_filtrado_mun = df_merge[df_merge['Municipio_do_Participante'] == selected_municipio]
-                        else:
-                            df_filtrado_mun = df_merge.copy()
-                            
-                        # 4. Agrupamento
-                        ranking_cod = df_filtrado_mun.groupby(cod_col).agg(
-                            Volume=('Valor', 'size'),
-                            Custo_Total=('Valor', 'sum')
-                        ).reset_index()
-                        
-                        # 5. Ordenação (por Volume decrescente)
-                        ranking_cod = ranking_cod.sort_values(by='Volume', ascending=False)
-                        
-                        ranking_cod.insert(0, 'Ranking', range(1, 1 + len(ranking_cod)))
-                        ranking_cod = ranking_cod.rename(columns={cod_col: 'Código/Procedimento', 'Volume': 'Volume (Freq.)', 'Custo_Total': 'Custo Total'})
-                        
-                        st.dataframe(
-                            style_dataframe_brl(ranking_cod, value_cols=['Custo Total']), 
-                            use_container_width=True,
-                            hide_index=True
-                        )
-                        
-                        # Gráfico para visualização
-                        if not ranking_cod.empty:
-                            top10_ranking = ranking_cod.head(10).sort_values(by='Custo Total', ascending=True)
-                            fig_cod = px.bar(
-                                top10_ranking,
-                                x='Custo Total',
-                                y='Código/Procedimento',
-                                orientation='h',
-                                title=f'Top 10 Códigos/Procedimentos por Custo em {selected_municipio}',
-                                color='Custo Total',
-                                color_continuous_scale=px.colors.sequential.Plasma
-                            )
-                            fig_cod.update_layout(
-                                plot_bgcolor='white',
-                                paper_bgcolor='white',
-                                yaxis={'categoryorder':'total ascending'}
-                            )
-                            st.plotly_chart(fig_cod, use_container_width=True)
+            with col2_top:
+                if agregado_benef is not None:
+                    st.markdown("### 📊 Top 20 por Volume")
+                    top20_volume = agregado_benef.sort_values('Volume', ascending=False)
+                    df_volume = top20_volume.head(20)[['Nome_do_Associado', 'Volume']].reset_index(drop=True).rename(columns={'Nome_do_Associado':'Beneficiário'})
+                    df_volume.insert(0, 'Ranking', range(1, 1 + len(df_volume)))
+                    st.dataframe(style_dataframe_brl(df_volume, value_cols=[]), use_container_width=True, height=400, hide_index=True)
 
-                    else:
-                        st.info(f"ℹ️ Não foi possível realizar o ranking. Colunas necessárias ({cod_col}, Nome_do_Associado, Valor) ou Município não encontradas/preenchidas.")
 
-                # --- ABA: COMPARATIVO (RH) ---
-                elif tab_name == "📈 Comparativo":
-                    if plano_col and 'Valor' in utilizacao_filtrada.columns:
-                        st.markdown("### 📊 Análise por Plano")
-                        
-                        comp = utilizacao_filtrada.groupby(plano_col)['Valor'].sum().reset_index()
-                        comp_volume = utilizacao_filtrada.groupby(plano_col).size().reset_index(name='Volume')
-                        
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            fig = go.Figure(data=[go.Bar(
-                                x=comp[plano_col],
-                                y=comp['Valor'],
-                                marker=dict(
-                                    color=comp['Valor'],
-                                    colorscale='Viridis',
-                                    showscale=True
-                                ),
-                                text=comp['Valor'].apply(format_brl),
-                                textposition='outside'
-                            )])
-                            fig.update_layout(
-                                title="Custo por Plano",
-                                plot_bgcolor='white',
-                                paper_bgcolor='white',
-                                yaxis=dict(tickprefix="R$ ", tickformat=",.2f"),
-                                height=400
-                            )
-                            st.plotly_chart(fig, use_container_width=True)
-
-                        with col2:
-                            fig2 = go.Figure(data=[go.Bar(
-                                x=comp_volume[plano_col],
-                                y=comp_volume['Volume'],
-                                marker=dict(
-                                    color=comp_volume['Volume'],
-                                    colorscale='Blues',
-                                    showscale=True
-                                ),
-                                text=comp_volume['Volume'],
-                                textposition='outside'
-                            )])
-                            fig2.update_layout(
-                                title="Volume por Plano",
-                                plot_bgcolor='white',
-                                paper_bgcolor='white',
-                                height=400
-                            )
-                            st.plotly_chart(fig2, use_container_width=True)
-                    else:
-                        st.info("ℹ️ Coluna de plano ou valor não encontrada.")
-                        
-                # --- ABA: ALERTAS (RH) ---
-                elif tab_name == "🚨 Alertas":
-                    st.markdown("### 🚨 Alertas e Inconsistências")
+            st.markdown("---")
+            
+            # Ranking de CODs por Município
+            st.markdown("### 🗺️ Ranking de Procedimentos/CIDs por Município")
+            
+            # 1. Cubo (beneficiário x código) já cruzado com o Município (agregado 'cubo_municipio')
+            df_merge = agregados['cubo_municipio']
+            if cod_col and df_merge is not None and 'Valor' in utilizacao_filtrada.columns:
+                
+                # 2. Seletor de Município
+                municipios_validos = sorted(df_merge['Municipio_do_Participante'].unique().tolist())
+                selected_municipio = st.selectbox(
+                    "📍 Selecione o Município para Análise:", 
+                    options=["TODOS"] + municipios_validos,
+                    key="municipio_ranking"
+                )
+                
+                # 3. Filtragem por Município
+                if selected_municipio != "TODOS":
+                    df_filtrado_mun = df_merge[df_merge['Municipio_do_Participante'] == selected_municipio]
+                else:
+                    df_filtrado_mun = df_merge.copy()
                     
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        # Os inputs de número (custo_lim) já esperam o formato numérico, sem formatação BR
-                        custo_lim = st.number_input("💰 Limite de custo (R$)", value=5000.00, step=100.00, key=f"custo_lim_{tab_name}")
-                    with col2:
-                        vol_lim = st.number_input("📊 Limite de atendimentos", value=20, key=f"vol_lim_{tab_name}")
-
-                    if 'Nome_do_Associado' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
-                        custo_por_benef = utilizacao_filtrada.groupby('Nome_do_Associado')['Valor'].sum()
-                        top10_volume = utilizacao_filtrada.groupby('Nome_do_Associado').size()
-                        
-                        # Filtra E ordena do maior para o menor para que o ranking 1 seja o maior valor.
-                        alert_custo = custo_por_benef[custo_por_benef > custo_lim].sort_values(ascending=False) 
-                        
-                        # Filtra E ordena do maior para o menor para que o ranking 1 seja o maior volume.
-                        alert_vol = top10_volume[top10_volume > vol_lim].sort_values(ascending=False)
+                # 4. Agrupamento (somando as células do cubo)
+                ranking_cod = agregar_cubo(df_filtrado_mun, ['codigo'], dimensoes_cubo).rename(
+                    columns={'codigo': cod_col, 'Valor': 'Custo_Total'}
+                )[[cod_col, 'Volume', 'Custo_Total']]
+                
+                # 5. Ordenação (por Volume decrescente)
+                ranking_cod = ranking_cod.sort_values(by='Volume', ascending=False)
+                
+                ranking_cod.insert(0, 'Ranking', range(1, 1 + len(ranking_cod)))
+                ranking_cod = ranking_cod.rename(columns={cod_col: 'Código/Procedimento', 'Volume': 'Volume (Freq.)', 'Custo_Total': 'Custo Total'})
+                
+                tabela_paginada(ranking_cod, "tabela_ranking_cod", value_cols=['Custo Total'])
+                
+                # Gráfico para visualização
+                if not ranking_cod.empty:
+                    top10_ranking = ranking_cod.head(10).sort_values(by='Custo Total', ascending=True)
+                    fig_cod = figura_em_cache('top_codigos_municipio', hash_conteudo, hash_filtros, selected_municipio,
+                                              lambda: figura_top_codigos(top10_ranking, selected_municipio))
+                    st.plotly_chart(fig_cod, use_container_width=True)
 
-                        col1_alert, col2_alert = st.columns(2)
-                        
-                        with col1_alert:
-                            if not alert_custo.empty:
-                                st.markdown("#### ⚠️ Acima do Limite de Custo")
-                                df_alert_custo = alert_custo.reset_index().rename(columns={'Nome_do_Associado':'Beneficiário','Valor':'Valor'})
-                                df_alert_custo.insert(0, 'Ranking', range(1, 1 + len(df_alert_custo)))
-                                # USANDO A NOVA FUNÇÃO style_dataframe_brl
-                                st.dataframe(style_dataframe_brl(df_alert_custo), use_container_width=True, hide_index=True)
-                            else:
-                                st.success("✅ Nenhum alerta de custo")
-
-                        with col2_alert:
-                            if not alert_vol.empty:
-                                st.markdown("#### ⚠️ Acima do Limite de Volume")
-                                df_alert_vol = alert_vol.reset_index().rename(columns={'Nome_do_Associado':'Beneficiário',0:'Volume'})
-                                df_alert_vol.insert(0, 'Ranking', range(1, 1 + len(df_alert_vol)))
-                                # USANDO A NOVA FUNÇÃO style_dataframe_brl (sem R$)
-                                st.dataframe(style_dataframe_brl(df_alert_vol, value_cols=[]), use_container_width=True, hide_index=True)
-                            else:
-                                st.success("✅ Nenhum alerta de volume")
+            else:
+                st.info(f"ℹ️ Não foi possível realizar o ranking. Colunas necessárias ({cod_col}, Nome_do_Associado, Valor) ou Município não encontradas/preenchidas.")
 
+        # --- ABA: COMPARATIVO (RH) ---
+        elif tab_name == "📈 Comparativo":
+            if plano_col and 'Valor' in utilizacao_filtrada.columns:
+                st.markdown("### 📊 Análise por Plano")
+                
+                comp_plano = agregados['por_plano'].rename(columns={'plano': plano_col})
+                comp = comp_plano[[plano_col, 'Valor']]
+                comp_volume = comp_plano[[plano_col, 'Volume']]
+                
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    fig = figura_em_cache('custo_por_plano', hash_conteudo, hash_filtros, None,
+                                          lambda: figura_barras_plano(comp, plano_col, 'Valor', "Custo por Plano", 'Viridis', monetario=True))
+                    st.plotly_chart(fig, use_container_width=True)
+
+                with col2:
+                    fig2 = figura_em_cache('volume_por_plano', hash_conteudo, hash_filtros, None,
+                                           lambda: figura_barras_plano(comp_volume, plano_col, 'Volume', "Volume por Plano", 'Blues', monetario=False))
+                    st.plotly_chart(fig2, use_container_width=True)
+            else:
+                st.info("ℹ️ Coluna de plano ou valor não encontrada.")
+                
+        # --- ABA: ALERTAS (RH) ---
+        elif tab_name == "🚨 Alertas":
+            st.markdown("### 🚨 Alertas e Inconsistências")
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                # Os inputs de número (custo_lim) são em reais; os agregados estão em centavos
+                custo_lim = st.number_input("💰 Limite de custo (R$)", value=5000.00, step=100.00, key=f"custo_lim_{tab_name}")
+            with col2:
+                vol_lim = st.number_input("📊 Limite de atendimentos", value=20, key=f"vol_lim_{tab_name}")
+
+            if agregado_benef is not None and 'Valor' in utilizacao_filtrada.columns:
+                custo_por_benef = agregado_benef.set_index('Nome_do_Associado')['Valor']
+                top10_volume = agregado_benef.set_index('Nome_do_Associado')['Volume']
+                
+                # Filtra E ordena do maior para o menor para que o ranking 1 seja o maior valor.
+                alert_custo = custo_por_benef[custo_por_benef > round(custo_lim * 100)].sort_values(ascending=False) 
+                
+                # Filtra E ordena do maior para o menor para que o ranking 1 seja o maior volume.
+                alert_vol = top10_volume[top10_volume > vol_lim].sort_values(ascending=False)
 
-                    st.markdown("### ⚠️ Inconsistências")
-                    inconsistencias = pd.DataFrame()
-                    if sexo_col and 'Codigo_do_CID' in utilizacao_filtrada.columns and 'Nome_do_Associado' in utilizacao_filtrada.columns:
-                        def padronizar_nome(nome): return unidecode(str(nome)).strip().upper()
-                        
-                        # Usar cópias para evitar SettingWithCopyWarning
-                        utilizacao_filtrada_temp = utilizacao_filtrada.copy()
-                        cadastro_filtrado_temp = cadastro_filtrado.copy()
-                        
-                        utilizacao_filtrada_temp['Nome_merge'] = utilizacao_filtrada_temp['Nome_do_Associado'].apply(padronizar_nome)
-                        cadastro_filtrado_temp['Nome_merge'] = cadastro_filtrado_temp['Nome_do_Associado'].apply(padronizar_nome)
-                        
-                        utilizacao_merge = utilizacao_filtrada_temp.merge(
-                            cadastro_filtrado_temp[['Nome_merge', sexo_col]].drop_duplicates(), on='Nome_merge', how='left'
-                        )
-                        
-                        # Tratamento da coluna de sexo após o merge
-                        if sexo_col not in utilizacao_merge.columns:
-                            utilizacao_merge[sexo_col] = 'Desconhecido'
-                        else:
-                            utilizacao_merge[sexo_col] = utilizacao_merge[sexo_col].fillna('Desconhecido')
-                        
-                        # Inconsistência: CID de Parto (O80) em homens (Sexo='M')
-                        parto_masc = utilizacao_merge[(utilizacao_merge['Codigo_do_CID']=='O80') & (utilizacao_merge[sexo_col]=='M')]
-                        if not parto_masc.empty:
-                            inconsistencias = pd.concat([inconsistencias, parto_masc.drop(columns='Nome_merge')])
-                            
-                    if not inconsistencias.empty:
-                        inconsistencias = inconsistencias.reset_index(drop=True)
-                        inconsistencias.insert(0, 'Linha', range(1, 1 + len(inconsistencias)))
-                        # Aplicar formatação para a coluna 'Valor' nas inconsistências
-                        st.dataframe(style_dataframe_brl(inconsistencias), use_container_width=True, hide_index=True)
-                    else:
-                        st.success("✅ Nenhuma inconsistência lógica (aparente) encontrada.")
-
-                # --- ABA: ANÁLISE MÉDICA (MEDICO) ---
-                elif tab_name == "🏥 Análise Médica":
-                    st.markdown("### 🧬 Beneficiários com Condições Crônicas")
-                    cids_cronicos = ['E11','I10','J45'] # Diabetes, Hipertensão, Asma
-                    if 'Codigo_do_CID' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
-                        utilizacao_filtrada_temp = utilizacao_filtrada.copy()
-                        # Verifica se o CID começa com um dos códigos crônicos
-                        utilizacao_filtrada_temp.loc[:, 'Cronico'] = utilizacao_filtrada_temp['Codigo_do_CID'].astype(str).str.startswith(tuple(cids_cronicos))
-                        beneficiarios_cronicos = utilizacao_filtrada_temp[utilizacao_filtrada_temp['Cronico']].groupby('Nome_do_Associado')['Valor'].sum()
-                        df_cronicos = beneficiarios_cronicos.reset_index().rename(columns={'Nome_do_Associado':'Beneficiário','Valor':'Valor'})
-                        df_cronicos.insert(0, 'Ranking', range(1, 1 + len(df_cronicos)))
-                        st.dataframe(style_dataframe_brl(df_cronicos), use_container_width=True,hide_index=True)
+                col1_alert, col2_alert = st.columns(2)
+                
+                with col1_alert:
+                    if not alert_custo.empty:
+                        st.markdown("#### ⚠️ Acima do Limite de Custo")
+                        df_alert_custo = alert_custo.reset_index().rename(columns={'Nome_do_Associado':'Beneficiário','Valor':'Valor'})
+                        df_alert_custo.insert(0, 'Ranking', range(1, 1 + len(df_alert_custo)))
+                        # tabela paginada no servidor (valores formatados só na página visível)
+                        tabela_paginada(df_alert_custo, "tabela_alerta_custo")
                     else:
-                        st.info("ℹ️ Colunas de CID ou Valor não encontradas para esta análise.")
-
-                    st.markdown("### 💊 Top 10 Procedimentos por Custo")
-                    if 'Nome_do_Procedimento' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
-                        top_proc = utilizacao_filtrada.groupby('Nome_do_Procedimento')['Valor'].sum().sort_values(ascending=False).head(10)
-                        df_top_proc = top_proc.reset_index().rename(columns={'Nome_do_Procedimento':'Procedimento','Valor':'Valor'})
-                        df_top_proc.insert(0, 'Ranking', range(1, 1 + len(df_top_proc)))
-                        st.dataframe(style_dataframe_brl(df_top_proc), use_container_width=True,hide_index=True)
+                        st.success("✅ Nenhum alerta de custo")
+
+                with col2_alert:
+                    if not alert_vol.empty:
+                        st.markdown("#### ⚠️ Acima do Limite de Volume")
+                        df_alert_vol = alert_vol.reset_index().rename(columns={'Nome_do_Associado':'Beneficiário'})
+                        df_alert_vol.insert(0, 'Ranking', range(1, 1 + len(df_alert_vol)))
+                        # tabela paginada no servidor (volume sem R$)
+                        tabela_paginada(df_alert_vol, "tabela_alerta_volume", value_cols=[])
                     else:
-                        st.info("ℹ️ Colunas de Procedimento/Valor não encontradas para esta análise.")
+                        st.success("✅ Nenhum alerta de volume")
+
+
+            st.markdown("### ⏱️ Uso Frequente")
+            limites_benef = LIMITES_USO_FREQUENTE['beneficiario']
+            st.caption("Maior número de atendimentos em janelas móveis de "
+                       + ", ".join(f"{j} dias (alerta a partir de {limites_benef[j]})" for j in JANELAS_UTILIZACAO) + ".")
+            colunas_valor_janela = [f'Valor_{j}d' for j in JANELAS_UTILIZACAO]
+            for nome, titulo, chave_tabela in [('uso_frequente_benef', "#### 👤 Por beneficiário", "tabela_uso_frequente"),
+                                               ('uso_frequente_codigo', "#### 💉 Mesmo procedimento repetido", "tabela_uso_frequente_codigo")]:
+                picos = agregados[nome]
+                st.markdown(titulo)
+                if picos is not None and not picos.empty:
+                    df_picos = picos.sort_values(f'Pico_{JANELAS_UTILIZACAO[0]}d', ascending=False).reset_index(drop=True)
+                    df_picos.insert(0, 'Beneficiário', nomes_por_id(beneficiarios, df_picos.pop('ID_Beneficiario')))
+                    tabela_paginada(df_picos, chave_tabela, value_cols=colunas_valor_janela)
+                else:
+                    st.success("✅ Nenhum uso frequente nos períodos analisados.")
+
+            st.markdown("### 📈 Fora do Padrão da Coorte")
+            st.caption("Escore robusto (mediana/MAD) de custo e volume de cada beneficiário em relação aos pares do mesmo "
+                       "plano, faixa etária, sexo e tipo, calculado uma vez sobre o arquivo inteiro.")
+            limiar = st.slider("🎯 Escore mínimo", min_value=2.0, max_value=10.0, value=LIMIAR_ESCORE_ANOMALIA, step=0.5, key="limiar_escore")
+            anomalias = dados['anomalias']
+            # Escores já ordenados (maior primeiro): o limiar é um corte por busca binária
+            n_acima = int(np.searchsorted(-anomalias['Escore'].to_numpy(dtype=float), -limiar, side='right'))
+            acima = anomalias.iloc[:n_acima]
+            acima = acima[agregados['ids_busca'][acima['ID_Beneficiario'].to_numpy()]]
+            if not acima.empty:
+                df_anomalias = acima.drop(columns='Escore').reset_index(drop=True)
+                df_anomalias.insert(1, 'Beneficiário', nomes_por_id(beneficiarios, df_anomalias['ID_Beneficiario']))
+                df_anomalias = df_anomalias.drop(columns='ID_Beneficiario')
+                df_anomalias.insert(0, 'Ranking', range(1, 1 + len(df_anomalias)))
+                tabela_paginada(df_anomalias, "tabela_anomalias")
+            else:
+                st.success("✅ Nenhum beneficiário fora do padrão da sua coorte.")
+
+            st.markdown("### 🔁 Cobranças Duplicadas")
+            janela = st.number_input("📅 Janela para cobranças próximas (dias)", min_value=0, max_value=90,
+                                     value=JANELA_DUPLICIDADE_DIAS, key="janela_duplicidade")
+            duplicados = calcular_duplicados(hash_conteudo, int(janela), dados)
+            duplicados = duplicados[mask_util[duplicados['linha'].to_numpy()]]
+            if not duplicados.empty:
+                # Impacto: valor das cobranças repetidas (a primeira de cada grupo não entra)
+                valores_dup = (centavos(utilizacao)[duplicados['linha'].to_numpy()] if 'Valor' in utilizacao.columns
+                               else np.zeros(len(duplicados), dtype=np.int64))
+                exatas = (duplicados['tipo'] == 'Exata').to_numpy()
+                col1_dup, col2_dup, col3_dup = st.columns(3)
+                col1_dup.metric("Duplicatas exatas", f"{int(exatas.sum()):,}".replace(",", "."))
+                col2_dup.metric(f"Cobranças em até {int(janela)} dias", f"{int((~exatas).sum()):,}".replace(",", "."))
+                col3_dup.metric("Impacto estimado", format_brl(int(valores_dup.sum())))
+
+                df_duplicados = utilizacao.iloc[duplicados['linha'].to_numpy()].drop(columns=COLUNAS_INTERNAS, errors='ignore').reset_index(drop=True)
+                df_duplicados.insert(0, 'Dias desde a anterior', duplicados['dias'].to_numpy())
+                df_duplicados.insert(0, 'Tipo', duplicados['tipo'].to_numpy())
+                tabela_paginada(df_duplicados, "tabela_duplicados")
+            else:
+                st.success("✅ Nenhuma cobrança duplicada encontrada.")
+
+            st.markdown("### ⚠️ Inconsistências")
+            # Regras avaliadas uma vez por arquivo (construir_indices); aqui só se aplica o filtro atual
+            regras = dados['inconsistencias']
+            filtradas = mask_util[regras['linhas']]
+            linhas_inc, regra_inc = regras['linhas'][filtradas], regras['regra'][filtradas]
+            if len(linhas_inc):
+                valores_inc = centavos(utilizacao)[linhas_inc] if 'Valor' in utilizacao.columns else np.zeros(len(linhas_inc), dtype=np.int64)
+                resumo_regras = pd.DataFrame({
+                    'Regra': regras['nomes'],
+                    'Atendimentos': np.bincount(regra_inc, minlength=len(regras['nomes'])),
+                    'Valor': somar_centavos(regra_inc, valores_inc, len(regras['nomes'])),
+                })
+                resumo_regras = resumo_regras[resumo_regras['Atendimentos'] > 0].sort_values('Atendimentos', ascending=False)
+                st.dataframe(style_dataframe_brl(resumo_regras), use_container_width=True, hide_index=True)
+
+                inconsistencias = utilizacao.iloc[linhas_inc].drop(columns=COLUNAS_INTERNAS, errors='ignore').reset_index(drop=True)
+                inconsistencias.insert(0, 'Regra', regras['nomes'][regra_inc])
+                inconsistencias.insert(0, 'Linha', range(1, 1 + len(inconsistencias)))
+                # tabela paginada no servidor (Valor formatado só na página visível)
+                tabela_paginada(inconsistencias, "tabela_inconsistencias")
+            else:
+                st.success("✅ Nenhuma inconsistência lógica (aparente) encontrada.")
+
+        # --- ABA: ANÁLISE MÉDICA (MEDICO) ---
+        elif tab_name == "🏥 Análise Médica":
+            st.markdown("### 🧬 Condições Crônicas")
+            por_condicao = agregados['por_condicao']
+            if 'Codigo_do_CID' in utilizacao_filtrada.columns and por_condicao is not None and not por_condicao.empty:
+                st.caption("Condições do catálogo de CIDs crônicos; prevalência sobre os beneficiários com atendimento no filtro.")
+                st.dataframe(style_dataframe_brl(por_condicao, ['Valor', 'Custo por Beneficiário']), use_container_width=True, hide_index=True)
+
+                st.markdown("#### 👥 Beneficiários com Condições Crônicas")
+                condicao = st.selectbox("Condição", ["Todas"] + list(por_condicao['Condição']), key="condicao_cronica")
+                # Condição de cada atendimento já classificada na ingestão (construir_indices)
+                codigos_condicao = dados['condicoes']['codigos'][mask_util]
+                linhas_condicao = (codigos_condicao >= 0 if condicao == "Todas"
+                                   else codigos_condicao == dados['condicoes']['valores'].get_loc(condicao))
+                beneficiarios_cronicos = agregar_por_beneficiario(utilizacao_filtrada[linhas_condicao], beneficiarios)
+                df_cronicos = (beneficiarios_cronicos[['Nome_do_Associado', 'Valor']].sort_values('Valor', ascending=False)
+                               .reset_index(drop=True).rename(columns={'Nome_do_Associado':'Beneficiário'}))
+                df_cronicos.insert(0, 'Ranking', range(1, 1 + len(df_cronicos)))
+                tabela_paginada(df_cronicos, "tabela_cronicos")
+            elif 'Codigo_do_CID' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
+                st.success("✅ Nenhum atendimento com CID de condição crônica no filtro atual.")
+            else:
+                st.info("ℹ️ Colunas de CID ou Valor não encontradas para esta análise.")
+
+            st.markdown("### 💊 Top 10 Procedimentos por Custo")
+            if 'Nome_do_Procedimento' in utilizacao_filtrada.columns and 'Valor' in utilizacao_filtrada.columns:
+                # Quando existe, Nome_do_Procedimento é a dimensão 'codigo' do cubo
+                top_proc = agregados['por_codigo'].sort_values('Valor', ascending=False).head(10)
+                df_top_proc = top_proc[['codigo', 'Valor']].reset_index(drop=True).rename(columns={'codigo':'Procedimento'})
+                df_top_proc.insert(0, 'Ranking', range(1, 1 + len(df_top_proc)))
+                st.dataframe(style_dataframe_brl(df_top_proc), use_container_width=True,hide_index=True)
+            else:
+                st.info("ℹ️ Colunas de Procedimento/Valor não encontradas para esta análise.")
 
-                # --- ABA: BUSCA (RH/MEDICO) ---
-                elif tab_name == "🔍 Busca":
-                    st.markdown("### 🔎 Busca por Beneficiário")
+        # --- ABA: BUSCA (RH/MEDICO) ---
+        elif tab_name == "🔍 Busca":
+            st.markdown("### 🔎 Busca por Beneficiário")
+            # Busca no índice de trigramas da ingestão, restrita aos beneficiários dos filtros atuais
+            ids_busca = agregados['ids_busca']
+            
+            # caixa de busca (tempo real)
+            search_input = st.text_input("Digite nome do beneficiário (busca em tempo real)", key="busca_input")
+
+            # Calcula matches conforme input
+            search_query = search_input.strip()
+            if search_query:
+                # Ranqueados: contém o texto (início do nome, início de palavra, resto) e depois nomes parecidos
+                ids_matches = buscar_beneficiarios(dados['indice_busca'], search_query, ids_busca)
+            else:
+                # quando vazio, sugerir top 20 por volume (se disponível) ou top 20 nomes
+                if agregado_benef is not None:
+                    vol = agregado_benef.sort_values('Volume', ascending=False)
+                    ids_sugeridos = vol.head(20).index.to_numpy()
+                    ids_matches = ids_sugeridos[ids_busca[ids_sugeridos]]
+                else:
+                    ids_matches = np.flatnonzero(ids_busca)[:20]
+            matches = nomes_por_id(beneficiarios, ids_matches).tolist()
+
+            chosen = None
+            if matches:
+                # NEW: 'select_benef' to keep state on refresh
+                chosen = st.selectbox("Resultados da busca — selecione o beneficiário", options=[""] + matches, index=0, key="busca_selectbox")
+                if chosen == "":
+                    st.session_state.selected_benef = None
+                    st.session_state.selected_benef_id = None
+                else:
+                    # O ID vem do próprio resultado da busca (sem procurar o nome de novo)
+                    st.session_state.selected_benef = chosen
+                    st.session_state.selected_benef_id = int(ids_matches[matches.index(chosen)])
+            else:
+                st.write("Nenhum resultado encontrado. Tente refinar os filtros.")
+
+            # --- INÍCIO: Seção Detalhada ---
+            selected_benef = st.session_state.selected_benef 
+            if selected_benef:
+                st.markdown(f"## 👤 Detalhes do Beneficiário: **{selected_benef}**")
+
+                # Preparar dados do beneficiário: só as linhas dele, pelo índice de linhas (sem varrer as abas)
+                selected_id = st.session_state.get('selected_benef_id')
+                if (selected_id is None or selected_id >= len(beneficiarios)
+                        or nomes_por_id(beneficiarios, [selected_id])[0] != selected_benef):
+                    # ID ausente ou de outra base (arquivo trocado): busca binária pelo nome
+                    selected_id = id_por_nome(beneficiarios, selected_benef)
+                indice_linhas = dados['indice_linhas']
+                linhas_util = linhas_do_beneficiario(indice_linhas, 'utilizacao', selected_id, mask_util)
+                linhas_cad = linhas_do_beneficiario(indice_linhas, 'cadastro', selected_id, mask_cad)
+                util_b = utilizacao.iloc[linhas_util]
+                cad_b = cadastro.iloc[linhas_cad]
+
+                # Métricas rápidas
+                col_metrica_1, col_metrica_2, col_metrica_3 = st.columns(3)
+                
+                if 'Nome_do_Associado' in utilizacao_filtrada.columns:
+                    custo_total_b = util_b['Valor'].sum() if 'Valor' in util_b.columns else 0
+                    volume_b = len(util_b)
+                    custo_medio_b = custo_total_b / volume_b if volume_b > 0 else 0
+                    
+                    with col_metrica_1:
+                        st.metric("💰 Custo Total (filtros)", format_brl(custo_total_b)) 
+                    with col_metrica_2:
+                        st.metric("📋 Volume (atendimentos)", f"{volume_b:,.0f}".replace(",", "."))
+                    with col_metrica_3:
+                        st.metric("📊 Custo Médio por Atendimento", format_brl(custo_medio_b))
+
+                # Expander com detalhes
+                with st.expander(f"🔍 Dados detalhados — {selected_benef}", expanded=True):
                     
-                    # caixa de busca (tempo real)
-                    search_input = st.text_input("Digite nome do beneficiário (busca em tempo real)", key="busca_input")
-
-                    # Calcula matches conforme input
-                    search_query = search_input.strip()
-                    matches = []
-                    if search_query:
-                        q_norm = normalize_name(search_query)
-                        # Substring match on normalized names
-                        matches = [orig for norm, orig in nomes_norm_map.items() if q_norm in norm]
-                        matches = sorted(matches)
+                    st.markdown("### 📝 Informações Cadastrais")
+                    if not cad_b.empty:
+                        cad_b_display = cad_b.drop(columns=COLUNAS_INTERNAS, errors='ignore').reset_index(drop=True)
+                        cad_b_display.insert(0, 'ID', range(1, 1 + len(cad_b_display)))
+                        st.dataframe(cad_b_display, use_container_width=True,hide_index=True)
                     else:
-                        # quando vazio, sugerir top 20 por volume (se disponível) ou top 20 nomes
-                        if 'Nome_do_Associado' in utilizacao_filtrada.columns:
-                            vol = utilizacao_filtrada.groupby('Nome_do_Associado').size().sort_values(ascending=False)
-                            suggestions = vol.head(20).index.tolist()
-                            matches = [s for s in suggestions if s in nomes_possiveis]
-                        else:
-                            matches = nomes_possiveis[:20]
-
-                    chosen = None
-                    if matches:
-                        # NEW: 'select_benef' to keep state on refresh
-                        chosen = st.selectbox("Resultados da busca — selecione o beneficiário", options=[""] + matches, index=0, key="busca_selectbox")
-                        if chosen == "":
-                            st.session_state.selected_benef = None
-                        else:
-                            st.session_state.selected_benef = chosen
+                        st.info("ℹ️ Informações cadastrais não encontradas nos filtros aplicados.")
+
+                    st.markdown("### 📋 Utilização do Plano (Atendimentos)")
+                    if not util_b.empty:
+                        util_b_display = util_b.drop(columns=COLUNAS_INTERNAS, errors='ignore').reset_index(drop=True)
+                        util_b_display.insert(0, 'ID_Registro', range(1, 1 + len(util_b_display)))
+                        # tabela paginada; a coluna Valor é formatada em R$ só na página visível
+                        tabela_paginada(util_b_display, "tabela_util_beneficiario")
                     else:
-                        st.write("Nenhum resultado encontrado. Tente refinar os filtros.")
+                        st.info("ℹ️ Nenhum registro de utilização encontrado para os filtros aplicados.")
 
-                    # --- INÍCIO: Seção Detalhada ---
-                    selected_benef = st.session_state.selected_benef 
-                    if selected_benef:
-                        st.markdown(f"## 👤 Detalhes do Beneficiário: **{selected_benef}**")
+                    # Histórico de custos e procedimentos
+                    st.markdown("### 📈 Histórico de Custos")
+                    if 'Valor' in util_b.columns and 'Data_do_Atendimento' in util_b.columns and not util_b.empty:
+                        # evolução do beneficiário (só as linhas desse ID)
+                        evol_b = agregar_linhas(utilizacao, linhas_util, 'mes', dimensoes_cubo).rename(columns={'mes': 'Mes_Ano'})
+                        
+                        fig_b = figura_em_cache('evolucao_beneficiario', hash_conteudo, hash_filtros, selected_id,
+                                                lambda: figura_evolucao(evol_b, '#11998e', '#38ef7d', 'rgba(17, 153, 142, 0.1)'))
+                        st.plotly_chart(fig_b, use_container_width=True)
+                    else:
+                        st.info("ℹ️ Dados de data e valor insuficientes para gráfico de evolução.")
 
-                        # Preparar dados do beneficiário
-                        util_b = utilizacao_filtrada[utilizacao_filtrada['Nome_do_Associado'] == selected_benef].copy()
-                        cad_b = cadastro_filtrado[cadastro_filtrado['Nome_do_Associado'] == selected_benef].copy()
 
-                        # Métricas rápidas
-                        col_metrica_1, col_metrica_2, col_metrica_3 = st.columns(3)
-                        
-                        if 'Nome_do_Associado' in utilizacao_filtrada.columns:
-                            custo_total_b = util_b['Valor'].sum() if 'Valor' in util_b.columns else 0
-                            volume_b = len(util_b)
-                            custo_medio_b = custo_total_b / volume_b if volume_b > 0 else 0
-                            
-                            with col_metrica_1:
-                                st.metric("💰 Custo Total (filtros)", format_brl(custo_total_b)) 
-                            with col_metrica_2:
-                                st.metric("📋 Volume (atendimentos)", f"{volume_b:,.0f}".replace(",", "."))
-                            with col_metrica_3:
-                                st.metric("📊 Custo Médio por Atendimento", format_brl(custo_medio_b))
-
-                        # Expander com detalhes
-                        with st.expander(f"🔍 Dados detalhados — {selected_benef}", expanded=True):
-                            
-                            st.markdown("### 📝 Informações Cadastrais")
-                            if not cad_b.empty:
-                                cad_b_display = cad_b.reset_index(drop=True)
-                                cad_b_display.insert(0, 'ID', range(1, 1 + len(cad_b_display)))
-                                st.dataframe(cad_b_display, use_container_width=True,hide_index=True)
-                            else:
-                                st.info("ℹ️ Informações cadastrais não encontradas nos filtros aplicados.")
-
-                            st.markdown("### 📋 Utilização do Plano (Atendimentos)")
-                            if not util_b.empty:
-                                util_b_display = util_b.reset_index(drop=True)
-                                util_b_display.insert(0, 'ID_Registro', range(1, 1 + len(util_b_display)))
-                                # APLICAR FORMAT_BRL PARA A COLUNA 'Valor' NO DATAFRAME VISUAL
-                                st.dataframe(style_dataframe_brl(util_b_display), use_container_width=True,hide_index=True)
-                            else:
-                                st.info("ℹ️ Nenhum registro de utilização encontrado para os filtros aplicados.")
-
-                            # Histórico de custos e procedimentos
-                            st.markdown("### 📈 Histórico de Custos")
-                            if 'Valor' in util_b.columns and 'Data_do_Atendimento' in util_b.columns and not util_b.empty:
-                                # evolução do beneficiário
-                                util_b.loc[:, 'Mes_Ano'] = util_b['Data_do_Atendimento'].dt.to_period('M')
-                                evol_b = util_b.groupby('Mes_Ano')['Valor'].sum().reset_index()
-                                evol_b['Mes_Ano'] = evol_b['Mes_Ano'].astype(str)
-                                
-                                fig_b = go.Figure()
-                                fig_b.add_trace(go.Scatter(
-                                    x=evol_b['Mes_Ano'],
-                                    y=evol_b['Valor'],
-                                    mode='lines+markers',
-                                    name='Custo',
-                                    line=dict(color='#11998e', width=3),
-                                    marker=dict(size=8, color='#38ef7d'),
-                                    fill='tozeroy',
-                                    fillcolor='rgba(17, 153, 142, 0.1)'
-                                ))
-
-                                fig_b.update_layout(
-                                    plot_bgcolor='white',
-                                    paper_bgcolor='white',
-                                    xaxis=dict(showgrid=True, gridcolor='#f0f0f0'),
-                                    yaxis=dict(showgrid=True, gridcolor='#f0f0f0', tickprefix="R$ ", tickformat=",.2f"),
-                                    hovermode='x unified',
-                                    height=400
-                                )
-                                st.plotly_chart(fig_b, use_container_width=True)
+                    col_proc, col_cid = st.columns(2)
+
+                    with col_proc:
+                        st.markdown("### 💉 Principais Procedimentos")
+                        if 'Nome_do_Procedimento' in util_b.columns and 'Valor' in util_b.columns:
+                            top_proc_b = agregar_linhas(utilizacao, linhas_util, 'codigo', dimensoes_cubo).sort_values('Valor', ascending=False).head(10)
+                            df_top_proc = top_proc_b[['codigo', 'Valor']].reset_index(drop=True).rename(columns={'codigo':'Procedimento'})
+                            df_top_proc.insert(0, 'Ranking', range(1, 1 + len(df_top_proc)))
+                            # USANDO A NOVA FUNÇÃO style_dataframe_brl
+                            st.dataframe(style_dataframe_brl(df_top_proc), use_container_width=True,hide_index=True)
+                        else:
+                            st.info("ℹ️ Colunas de procedimento ou valor não encontradas.")
+                    
+                    with col_cid:
+                        # CIDs associados
+                        st.markdown("### 🩺 CIDs Associados")
+                        if 'Codigo_do_CID' in util_b.columns:
+                            cids = util_b['Codigo_do_CID'].dropna().unique().tolist()
+                            if len(cids) > 0:
+                                st.code(", ".join(map(str, cids)))
                             else:
-                                st.info("ℹ️ Dados de data e valor insuficientes para gráfico de evolução.")
-
-
-                            col_proc, col_cid = st.columns(2)
-
-                            with col_proc:
-                                st.markdown("### 💉 Principais Procedimentos")
-                                if 'Nome_do_Procedimento' in util_b.columns and 'Valor' in util_b.columns:
-                                    top_proc_b = util_b.groupby('Nome_do_Procedimento')['Valor'].sum().sort_values(ascending=False).head(10)
-                                    df_top_proc = top_proc_b.reset_index().rename(columns={'Nome_do_Procedimento':'Procedimento','Valor':'Valor'})
-                                    df_top_proc.insert(0, 'Ranking', range(1, 1 + len(df_top_proc)))
-                                    # USANDO A NOVA FUNÇÃO style_dataframe_brl
-                                    st.dataframe(style_dataframe_brl(df_top_proc), use_container_width=True,hide_index=True)
-                                else:
-                                    st.info("ℹ️ Colunas de procedimento ou valor não encontradas.")
-                            
-                            with col_cid:
-                                # CIDs associados
-                                st.markdown("### 🩺 CIDs Associados")
-                                if 'Codigo_do_CID' in util_b.columns:
-                                    cids = util_b['Codigo_do_CID'].dropna().unique().tolist()
-                                    if len(cids) > 0:
-                                        st.code(", ".join(map(str, cids)))
-                                    else:
-                                        st.info("ℹ️ Nenhum CID associado encontrado.")
-                                else:
-                                    st.info("ℹ️ Coluna 'Codigo_do_CID' não encontrada.")
-
-                            
-                            # Exportar relatório individual em Excel
-                            st.markdown("---")
-                            st.markdown("### 📥 Exportar Relatório Individual")
-                            buf_ind = BytesIO()
-                            with pd.ExcelWriter(buf_ind, engine='xlsxwriter') as writer:
-                                if not util_b.empty:
-                                    # remove a coluna de Mes_Ano temporária para exportação
-                                    util_b_export = util_b.drop(columns=['Mes_Ano', 'Tipo_Beneficiario'], errors='ignore')
-                                    # Garantir o valor numérico para exportação
-                                    if 'Valor' in util_b_export.columns:
-                                        util_b_export['Valor'] = pd.to_numeric(util_b_export['Valor'], errors='coerce')
-                                    util_b_export.to_excel(writer, sheet_name='Utilizacao_Individual', index=False)
-                                if not cad_b.empty:
-                                    # Certifique-se de usar a versão original do cad_b sem a coluna ID temporária para exportação
-                                    cad_b.drop(columns=['ID'], errors='ignore').to_excel(writer, sheet_name='Cadastro_Individual', index=False)
-                                if not medicina_trabalho.empty:
-                                    # Filtragem de medicina do trabalho para o beneficiário
-                                    med_b = medicina_trabalho[medicina_trabalho.get('Nome_do_Associado', pd.Series()).fillna('') == selected_benef]
-                                    if not med_b.empty:
-                                        med_b.to_excel(writer, sheet_name='Medicina_do_Trabalho_Ind', index=False)
-                                if not atestados.empty:
-                                    # Filtragem de atestados para o beneficiário
-                                    at_b = atestados[atestados.get('Nome_do_Associado', pd.Series()).fillna('') == selected_benef]
-                                    if not at_b.empty:
-                                        at_b.to_excel(writer, sheet_name='Atestados_Ind', index=False)
-                            buf_ind.seek(0)
-                            st.download_button(
-                                label="📥 Baixar Relatório Individual (.xlsx)",
-                                data=buf_ind,
-                                file_name=f"relatorio_beneficiario_{normalize_name(selected_benef)[:50]}.xlsx",
-                                mime="application/vnd.ms-excel",
-                                use_container_width=True
-                            )
-                    # --- FIM: Seção Detalhada ---
-                
-               
-
-
-                # --- ABA: EXPORTAÇÃO (RH) ---
-                elif tab_name == "📤 Exportação":
-                    st.markdown("### 📥 Exportar Relatório Completo")
-                    st.write("Baixe todas as abas do arquivo processado, respeitando os filtros de `Período`, `Sexo`, `Município`, `Faixa Etária`, `Tipo de Beneficiário` e `Plano` aplicados.")
-                    buffer = BytesIO()
-                    with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-                        # Para exportar, é melhor que os dados voltem ao formato numérico puro
-                        # Remove a coluna temporária 'Tipo_Beneficiario' se for exportar a Utilizacao completa
-                        utilizacao_filtrada_export = utilizacao_filtrada.drop(columns=['Tipo_Beneficiario'], errors='ignore')
-                        
-                        # Garantir o valor numérico para exportação
-                        if 'Valor' in utilizacao_filtrada_export.columns:
-                            utilizacao_filtrada_export['Valor'] = pd.to_numeric(utilizacao_filtrada_export['Valor'], errors='coerce')
-                            
-                        utilizacao_filtrada_export.to_excel(writer, sheet_name='Utilizacao_Filtrada', index=False)
-                        cadastro_filtrado.to_excel(writer, sheet_name='Cadastro_Filtrado', index=False)
-                        
-                        # A exportação do Medicina do Trabalho e Atestados é filtrada pelo Cadastro Filtrado
-                        med_export = medicina_trabalho.copy()
-                        if 'Nome_do_Associado' in med_export.columns and 'Nome_do_Associado' in cadastro_filtrado.columns:
-                            med_export = med_export[med_export['Nome_do_Associado'].isin(cadastro_filtrado['Nome_do_Associado'])]
-
-                        at_export = atestados.copy()
-                        if 'Nome_do_Associado' in at_export.columns and 'Nome_do_Associado' in cadastro_filtrado.columns:
-                            at_export = at_export[at_export['Nome_do_Associado'].isin(cadastro_filtrado['Nome_do_Associado'])]
-                            
-                        if not med_export.empty:
-                            med_export.to_excel(writer, sheet_name='Medicina_do_Trabalho_Filtrada', index=False)
-                        if not at_export.empty:
-                            at_export.to_excel(writer, sheet_name='Atestados_Filtrados', index=False)
-                            
-                    buffer.seek(0)
+                                st.info("ℹ️ Nenhum CID associado encontrado.")
+                        else:
+                            st.info("ℹ️ Coluna 'Codigo_do_CID' não encontrada.")
+
+                    
+                    # Exportar relatório individual em Excel
+                    st.markdown("---")
+                    st.markdown("### 📥 Exportar Relatório Individual")
+                    # o arquivo só é montado quando o botão é clicado
+                    abas_ind = []
+                    if not util_b.empty:
+                        colunas_util_b = [col for col in utilizacao.columns if col not in ['Tipo_Beneficiario'] + COLUNAS_INTERNAS]
+                        abas_ind.append(aba_exportacao('Utilizacao_Individual', utilizacao, colunas_util_b, linhas_util))
+                    if not cad_b.empty:
+                        abas_ind.append(aba_exportacao('Cadastro_Individual', cadastro, linhas=linhas_cad))
+                    linhas_med = linhas_do_beneficiario(indice_linhas, 'medicina_trabalho', selected_id)
+                    if len(linhas_med):
+                        abas_ind.append(aba_exportacao('Medicina_do_Trabalho_Ind', medicina_trabalho, linhas=linhas_med))
+                    linhas_at = linhas_do_beneficiario(indice_linhas, 'atestados', selected_id)
+                    if len(linhas_at):
+                        abas_ind.append(aba_exportacao('Atestados_Ind', atestados, linhas=linhas_at))
                     st.download_button(
-                        "📥 Baixar Relatório Filtrado (.xlsx)", 
-                        buffer, 
-                        "dashboard_plano_saude_filtrado.xlsx", 
-                        "application/vnd.ms-excel", 
+                        label="📥 Baixar Relatório Individual (.xlsx)",
+                        data=lambda: exportar_em_bytes(abas_ind),
+                        file_name=f"relatorio_beneficiario_{normalize_name(selected_benef)[:50]}.xlsx",
+                        mime="application/vnd.ms-excel",
                         use_container_width=True
                     )
-                    st.success("✅ Processamento de dados concluído. Utilize as abas.")
+            # --- FIM: Seção Detalhada ---
+        
+       
+
+
+        # --- ABA: EXPORTAÇÃO (RH) ---
+        elif tab_name == "📤 Exportação":
+            st.markdown("### 📥 Exportar Relatório Completo")
+            st.write("Baixe todas as abas do arquivo processado, respeitando os filtros de `Período`, `Sexo`, `Município`, `Faixa Etária`, `Tipo de Beneficiário` e `Plano` aplicados.")
+            formato_export = st.radio(
+                "Formato",
+                ["xlsx", "csv", "parquet"],
+                format_func=lambda f: {"xlsx": "Excel (.xlsx)", "csv": "CSV (.zip, mais rápido)", "parquet": "Parquet (.zip, mais rápido)"}[f],
+                horizontal=True,
+            )
+            # O arquivo só é gerado quando o usuário clica em baixar (callable), em blocos de linhas
+            abas_export = abas_relatorio(utilizacao_filtrada, cadastro_filtrado, medicina_trabalho, atestados)
+            st.download_button(
+                f"📥 Baixar Relatório Filtrado (.{EXTENSOES_EXPORTACAO[formato_export]})",
+                lambda: exportar_em_bytes(abas_export, formato_export),
+                f"dashboard_plano_saude_filtrado.{EXTENSOES_EXPORTACAO[formato_export]}",
+                "application/vnd.ms-excel" if formato_export == "xlsx" else "application/zip",
+                use_container_width=True
+            )
+            st.success("✅ Processamento de dados concluído. Utilize as abas.")
@@ -2,7 +2,7 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import plotly.express as px
-from io import BytesIO
+from processamento import ler_planilha, normalizar_nomes, aba_exportacao, exportar_em_bytes, condicoes_por_cid
 from unidecode import unidecode
 import streamlit_authenticator as stauth
 import toml
@@ -89,18 +89,12 @@ uploaded_file = st.file_uploader("Escolha o arquivo .xlsx", type="xlsx")
 
 if uploaded_file is not None:
     # Leitura das abas
-    utilizacao = pd.read_excel(uploaded_file, sheet_name='Utilizacao')
-    cadastro = pd.read_excel(uploaded_file, sheet_name='Cadastro')
-
-    try:
-        medicina_trabalho = pd.read_excel(uploaded_file, sheet_name='Medicina_do_Trabalho')
-    except:
-        medicina_trabalho = pd.DataFrame()
-
-    try:
-        atestados = pd.read_excel(uploaded_file, sheet_name='Atestados')
-    except:
-        atestados = pd.DataFrame()
+    # Abre o arquivo uma única vez e lê todas as abas (opcionais ausentes viram DataFrames vazios)
+    abas, _ = ler_planilha(uploaded_file)
+    utilizacao = abas['Utilizacao']
+    cadastro = abas['Cadastro']
+    medicina_trabalho = abas['Medicina_do_Trabalho']
+    atestados = abas['Atestados']
 
     # ---------------------------
     # Padronização de colunas
@@ -275,10 +269,9 @@ if uploaded_file is not None:
         st.subheader("⚠️ Inconsistências")
         inconsistencias = pd.DataFrame()
         if sexo_col and 'Codigo_do_CID' in utilizacao_display.columns:
-            def padronizar_nome(nome):
-                return unidecode(str(nome)).strip().upper()
-            utilizacao_display['Nome_merge'] = utilizacao_display['Nome_do_Associado'].apply(padronizar_nome)
-            cadastro_display['Nome_merge'] = cadastro_display['Nome_do_Associado'].apply(padronizar_nome)
+            # Normaliza cada nome distinto uma única vez (em vez de apply linha a linha)
+            utilizacao_display['Nome_merge'] = normalizar_nomes(utilizacao_display['Nome_do_Associado'])
+            cadastro_display['Nome_merge'] = normalizar_nomes(cadastro_display['Nome_do_Associado'])
             utilizacao_merge = utilizacao_display.merge(
                 cadastro_display[['Nome_merge', sexo_col]].drop_duplicates(),
                 on='Nome_merge', how='left'
@@ -299,9 +292,9 @@ if uploaded_file is not None:
     # Tab4: CIDs Crônicos & Procedimentos
     with tab4:
         st.subheader("🏥 Beneficiários Crônicos")
-        cids_cronicos = ['E11','I10','J45']
         if 'Codigo_do_CID' in utilizacao_display.columns:
-            utilizacao_display['Cronico'] = utilizacao_display['Codigo_do_CID'].isin(cids_cronicos)
+            # Mesmo catálogo de condições crônicas (por prefixo de CID) do dashboard principal
+            utilizacao_display['Cronico'] = condicoes_por_cid(utilizacao_display)['codigos'] >= 0
             beneficiarios_cronicos = utilizacao_display[utilizacao_display['Cronico']].groupby('Nome_do_Associado')['Valor'].sum()
             st.dataframe(beneficiarios_cronicos.reset_index().rename(columns={'Nome_do_Associado':'Nome do Associado','Valor':'Valor'}))
         st.subheader("💊 Top Procedimentos")
@@ -313,21 +306,21 @@ if uploaded_file is not None:
     # Tab5: Exportação
     with tab5:
         st.subheader("📤 Exportar Relatório")
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer:
-            if st.session_state.get("role") == "RH":
-                if 'Mes_Ano' in utilizacao_display.columns:
-                    agg = utilizacao_display.groupby('Mes_Ano').agg({'Valor':'sum'}).reset_index()
-                    agg.to_excel(writer, sheet_name='Resumo_Agr', index=False)
-                cadastro_display.to_excel(writer, sheet_name='Cadastro', index=False)
-            else:
-                utilizacao_display.to_excel(writer, sheet_name='Utilizacao', index=False)
-                cadastro_display.to_excel(writer, sheet_name='Cadastro', index=False)
-            if not medicina_trabalho.empty:
-                medicina_trabalho.to_excel(writer, sheet_name='Medicina_do_Trabalho', index=False)
-            if not atestados.empty:
-                atestados.to_excel(writer, sheet_name='Atestados', index=False)
-        st.download_button("📥 Baixar Relatório Completo", buffer, "dashboard_plano_saude.xlsx", "application/vnd.ms-excel")
+        # O arquivo só é gerado quando o usuário clica em baixar, em modo de memória constante
+        abas_export = []
+        if st.session_state.get("role") == "RH":
+            if 'Mes_Ano' in utilizacao_display.columns:
+                agg = utilizacao_display.groupby('Mes_Ano').agg({'Valor':'sum'}).reset_index()
+                abas_export.append(aba_exportacao('Resumo_Agr', agg))
+            abas_export.append(aba_exportacao('Cadastro', cadastro_display))
+        else:
+            abas_export.append(aba_exportacao('Utilizacao', utilizacao_display))
+            abas_export.append(aba_exportacao('Cadastro', cadastro_display))
+        if not medicina_trabalho.empty:
+            abas_export.append(aba_exportacao('Medicina_do_Trabalho', medicina_trabalho))
+        if not atestados.empty:
+            abas_export.append(aba_exportacao('Atestados', atestados))
+        st.download_button("📥 Baixar Relatório Completo", lambda: exportar_em_bytes(abas_export), "dashboard_plano_saude.xlsx", "application/vnd.ms-excel")
 
     st.success("✅ Dashboard carregado com sucesso!")
 else:
@@ -0,0 +1,44 @@
+"""Duplicidades, janelas móveis e escore robusto usados na aba de alertas."""
+import numpy as np
+import pandas as pd
+
+from processamento import detectar_duplicados, escore_robusto, somas_em_janela
+
+
+def test_duplicados_exatos_e_proximos():
+    utilizacao = pd.DataFrame({
+        'Nome_do_Associado': ['Ana', 'Ana', 'Ana', 'Ana', 'Bia', 'Bia'],
+        'Nome_do_Procedimento': ['CONSULTA', 'CONSULTA', 'CONSULTA', 'EXAME', 'CONSULTA', 'CONSULTA'],
+        'Data_do_Atendimento': pd.to_datetime(['2024-01-01', '2024-01-01', '2024-01-05', '2024-01-02',
+                                               '2024-01-01', '2024-03-01']),
+        'Valor': pd.array([100, 100, 100, 50, 80, 80], dtype='Int64'),
+    })
+    duplicados = detectar_duplicados(utilizacao, janela_dias=7)
+    assert duplicados['linha'].tolist() == [1, 2]
+    assert duplicados['origem'].tolist() == [0, 1]
+    assert duplicados['tipo'].tolist() == ['Exata', 'Próxima']
+    assert duplicados['dias'].tolist() == [0, 4]
+    assert detectar_duplicados(utilizacao, janela_dias=3)['linha'].tolist() == [1]
+
+
+def test_somas_em_janela_por_grupo():
+    grupos = np.array([0, 0, 0, 0, 1, 1])
+    dias = np.array([1, 2, 5, 9, 1, 3])
+    valores = np.array([10, 20, 30, 40, 5, 6])
+    quantidade, soma = somas_em_janela(grupos, dias, valores, 3)
+    assert quantidade.tolist() == [1, 2, 1, 1, 1, 2]
+    assert soma.tolist() == [10, 30, 30, 40, 5, 11]
+    vazio = somas_em_janela(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), 3)
+    assert [len(v) for v in vazio] == [0, 0]
+
+
+def test_escore_robusto_pela_mediana_e_mad():
+    escore = escore_robusto(np.array([0, 0, 0, 0, 0, 1, 1, 1]), np.array([1, 2, 3, 4, 100, 5, 5, 5]), 2)
+    # grupo 0: mediana 3, MAD 1 -> 0,6745 * (x - 3); grupo 1 sem dispersão -> 0
+    np.testing.assert_allclose(escore, [-1.349, -0.6745, 0, 0.6745, 65.4265, 0, 0, 0])
+
+
+def test_escore_robusto_com_mad_zero_usa_desvio_medio():
+    escore = escore_robusto(np.array([0, 0, 0, 0]), np.array([5, 5, 5, 9]), 1)
+    # MAD 0: escala = desvio absoluto médio (1) * 1,253314
+    np.testing.assert_allclose(escore, [0, 0, 0, 4 / 1.253314])
@@ -0,0 +1,55 @@
+"""Busca de beneficiários pelo nome (processamento.buscar_beneficiarios)."""
+import numpy as np
+import pandas as pd
+
+from processamento import buscar_beneficiarios, construir_dimensao_beneficiarios, construir_indice_busca, nomes_por_id
+
+NOMES = ['Maria Silva', 'Mariana Costa', 'José Santos', 'Ana Maria Souza', 'Joao Oliveira', 'Ana Mariano',
+         'Pedro Silvano']
+
+
+def _indice():
+    beneficiarios = construir_dimensao_beneficiarios([pd.DataFrame({'Nome_do_Associado': NOMES})])
+    return beneficiarios, construir_indice_busca(beneficiarios)
+
+
+def _buscar(consulta, **kwargs):
+    beneficiarios, indice = _indice()
+    return nomes_por_id(beneficiarios, buscar_beneficiarios(indice, consulta, **kwargs)).tolist()
+
+
+def test_inicio_do_nome_antes_de_inicio_de_palavra():
+    assert _buscar('mari') == ['Maria Silva', 'Mariana Costa', 'Ana Maria Souza', 'Ana Mariano']
+
+
+def test_substring_no_meio_da_palavra_vem_por_ultimo():
+    assert _buscar('ana') == ['Ana Maria Souza', 'Ana Mariano', 'Mariana Costa']
+    assert _buscar('ilva') == ['Maria Silva', 'Pedro Silvano']
+
+
+def test_acentos_caixa_e_ordem_das_palavras():
+    assert _buscar('JOSE santos') == ['José Santos']
+    assert _buscar('santos josé') == ['José Santos']
+
+
+def test_um_erro_de_digitacao_por_palavra():
+    assert _buscar('oliviera') == ['Joao Oliveira']
+    assert _buscar('olveira joao') == ['Joao Oliveira']
+    assert _buscar('mraia') == ['Ana Maria Souza', 'Maria Silva']
+
+
+def test_consulta_curta_busca_so_o_inicio_do_nome():
+    assert _buscar('ma') == ['Maria Silva', 'Mariana Costa']
+
+
+def test_sem_resultado_e_consulta_vazia():
+    assert _buscar('zzz') == []
+    assert _buscar('   ') == []
+
+
+def test_permitidos_e_limite_k():
+    beneficiarios, indice = _indice()
+    permitidos = np.zeros(len(beneficiarios), dtype=bool)
+    permitidos[buscar_beneficiarios(indice, 'ana mariano')] = True
+    assert nomes_por_id(beneficiarios, buscar_beneficiarios(indice, 'mari', permitidos)).tolist() == ['Ana Mariano']
+    assert _buscar('mari', k=2) == ['Maria Silva', 'Mariana Costa']
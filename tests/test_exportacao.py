@@ -0,0 +1,43 @@
+"""Exportação em blocos (processamento.exportar_em_bytes)."""
+import io
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from processamento import aba_exportacao, exportar_em_bytes
+
+
+def _frame_com_periodo():
+    datas = pd.to_datetime(['2024-01-15', '2024-02-03', None])
+    return pd.DataFrame({
+        'Data_do_Atendimento': datas,
+        'Mes_Ano': datas.to_period('M'),
+        'Periodo_Objeto': pd.Series([pd.Period('2024-01', 'M'), None, np.int64(3)], dtype=object),
+        'Valor': [328.57, 10.0, 1.5],
+    })
+
+
+def test_xlsx_exporta_colunas_period_como_texto():
+    conteudo = exportar_em_bytes([aba_exportacao('Utilizacao', _frame_com_periodo())])
+    lido = pd.read_excel(io.BytesIO(conteudo))
+    assert lido['Mes_Ano'].tolist()[:2] == ['2024-01', '2024-02']
+    assert pd.isna(lido['Mes_Ano'].iloc[2])
+    assert lido['Periodo_Objeto'].tolist()[0] == '2024-01'
+    assert lido['Valor'].tolist() == [328.57, 10.0, 1.5]
+
+
+def test_csv_e_parquet_exportam_colunas_period():
+    for formato in ['csv', 'parquet']:
+        conteudo = exportar_em_bytes([aba_exportacao('Utilizacao', _frame_com_periodo())], formato)
+        with zipfile.ZipFile(io.BytesIO(conteudo)) as arquivo:
+            nome = arquivo.namelist()[0]
+            dados = arquivo.read(nome)
+        lido = pd.read_csv(io.BytesIO(dados)) if formato == 'csv' else pd.read_parquet(io.BytesIO(dados))
+        assert lido['Mes_Ano'].tolist()[:2] == ['2024-01', '2024-02']
+
+
+def test_valor_em_centavos_sai_em_reais():
+    df = pd.DataFrame({'Valor': pd.array([32857, 1000], dtype='Int64')})
+    lido = pd.read_excel(io.BytesIO(exportar_em_bytes([aba_exportacao('A', df)])))
+    assert lido['Valor'].tolist() == [328.57, 10.0]
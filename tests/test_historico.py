@@ -0,0 +1,67 @@
+"""Base histórica: carga mensal sem duplicar atendimentos e manifesto."""
+import io
+import json
+
+import pandas as pd
+
+from processamento import anexar_mes, carregar_historico, evolucao_historico, ler_manifesto
+
+
+def _extrato(nomes, datas, valores, cadastro):
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as planilha:
+        pd.DataFrame({
+            'Nome do Associado': nomes,
+            'Data do Atendimento': pd.to_datetime(datas),
+            'Nome do Procedimento': ['CONSULTA'] * len(nomes),
+            'Valor': valores,
+        }).to_excel(planilha, sheet_name='Utilizacao', index=False)
+        pd.DataFrame({'Nome do Associado': cadastro, 'Sexo': ['F'] * len(cadastro)}).to_excel(
+            planilha, sheet_name='Cadastro', index=False)
+    return buffer.getvalue()
+
+
+def test_carga_repetida_nao_duplica_atendimentos(tmp_path):
+    janeiro = _extrato(['Ana', 'Bia'], ['2024-01-10', '2024-02-03'], [10.5, '1.234,56'], ['Ana', 'Bia'])
+    fevereiro = _extrato(['Ana', 'Caio'], ['2024-01-10', '2024-02-20'], [10.5, 3], ['ANA ', 'Caio'])
+
+    carga = anexar_mes(janeiro, 'jan.xlsx', tmp_path)
+    assert (carga['novas'], carga['duplicadas'], carga['meses']) == (2, 0, ['2024-01', '2024-02'])
+    carga = anexar_mes(fevereiro, 'fev.xlsx', tmp_path)
+    assert (carga['novas'], carga['duplicadas'], carga['meses']) == (1, 1, ['2024-02'])
+    assert anexar_mes(fevereiro, 'fev.xlsx', tmp_path)['repetida']
+
+    assert ler_manifesto(tmp_path)['meses'] == {'2024-01': {'linhas': 1, 'Valor': 1050},
+                                                '2024-02': {'linhas': 2, 'Valor': 123756}}
+    dados = carregar_historico(tmp_path)
+    assert dados['utilizacao']['Valor'].tolist() == [1050, 123456, 300]
+    # o cadastro novo substitui o anterior pelo nome normalizado ('ANA ' == 'Ana')
+    assert sorted(dados['cadastro']['Nome_do_Associado'].str.strip()) == ['ANA', 'Bia', 'Caio']
+
+
+def test_carregar_so_os_meses_pedidos_e_evolucao_do_manifesto(tmp_path):
+    anexar_mes(_extrato(['Ana', 'Bia'], ['2024-01-10', '2024-02-03'], [1, 2], ['Ana', 'Bia']), 'a.xlsx', tmp_path)
+    assert carregar_historico(tmp_path, meses=['2024-02'])['utilizacao']['Valor'].tolist() == [200]
+    assert carregar_historico(tmp_path, meses=['2023-12']) is None
+    evolucao = evolucao_historico(tmp_path)
+    assert evolucao['Mes_Ano'].tolist() == ['2024-01', '2024-02']
+    assert evolucao['Valor'].tolist() == [100, 200]
+    assert evolucao['Volume'].tolist() == [1, 1]
+
+
+def test_manifesto_v1_migra_valores_para_centavos(tmp_path):
+    (tmp_path / 'manifesto.json').write_text(json.dumps({
+        'versao': 1,
+        'meses': {'2024-01': {'linhas': 2, 'Valor': 10.29}, '2024-02': {'linhas': 1, 'Valor': 0.1}},
+        'cargas': [],
+        'atualizado_em': None,
+    }), encoding='utf-8')
+    manifesto = ler_manifesto(tmp_path)
+    assert manifesto['versao'] == 2
+    assert manifesto['meses'] == {'2024-01': {'linhas': 2, 'Valor': 1029}, '2024-02': {'linhas': 1, 'Valor': 10}}
+
+
+def test_manifesto_ausente_ou_de_versao_desconhecida(tmp_path):
+    assert ler_manifesto(tmp_path)['meses'] == {}
+    (tmp_path / 'manifesto.json').write_text(json.dumps({'versao': 99, 'meses': {'x': {}}}), encoding='utf-8')
+    assert ler_manifesto(tmp_path)['meses'] == {}
@@ -0,0 +1,74 @@
+"""Conversão de valores monetários e somas exatas em centavos."""
+import numpy as np
+import pandas as pd
+
+from processamento import (agregar_por_beneficiario, construir_dimensao_beneficiarios, converter_moeda,
+                           somar_centavos)
+
+
+def _centavos(valores, formato=None):
+    serie, invalidos = converter_moeda(pd.Series(valores, dtype=object), centavos=True, formato=formato)
+    return [None if pd.isna(v) else int(v) for v in serie], invalidos
+
+
+def test_textos_no_padrao_br():
+    valores, invalidos = _centavos(['1.234,56', 'R$ 10,00', '-R$ 5,5', '  7', '0,125', '1.234.567,89'], 'br')
+    assert valores == [123456, 1000, -550, 700, 13, 123456789]
+    assert invalidos == 0
+
+
+def test_textos_no_padrao_us():
+    valores, invalidos = _centavos(['1,234.56', '10.005', '-0.5', '1,000'], 'us')
+    assert valores == [123456, 1001, -50, 100000]
+    assert invalidos == 0
+
+
+def test_grupos_de_milhar_e_prefixo_invalidos():
+    textos = ['1.2.3', '12.34.567', '1.23', '1.2345', 'RRR5', '5R$', 'R$', 'abc']
+    valores, invalidos = _centavos(textos, 'br')
+    assert valores == [None] * len(textos)
+    assert invalidos == len(textos)
+
+
+def test_vazios_nao_contam_como_invalidos():
+    valores, invalidos = _centavos(['', '   ', None, '2,00'], 'br')
+    assert valores == [None, None, None, 200]
+    assert invalidos == 0
+
+
+def test_formato_detectado_pela_amostra():
+    assert _centavos(['1.234,56', '7,10'])[0] == [123456, 710]
+    assert _centavos(['1,234.56', '7.10'])[0] == [123456, 710]
+
+
+def test_numeros_arredondam_meio_centavo_para_cima():
+    serie, invalidos = converter_moeda(pd.Series([0.285, 1.005, -0.125, 2.675, 10.0, np.nan]), centavos=True)
+    assert serie.tolist()[:5] == [29, 101, -13, 268, 1000]
+    assert pd.isna(serie.iloc[5])
+    assert invalidos == 0
+    inteiros, _ = converter_moeda(pd.Series([3, 12]), centavos=True)
+    assert inteiros.tolist() == [300, 1200]
+
+
+def test_planilha_mista_texto_e_numero():
+    valores, invalidos = _centavos(['1.234,56', 0.285, 7, 'x'], 'br')
+    assert valores == [123456, 29, 700, None]
+    assert invalidos == 1
+
+
+def test_somar_centavos_e_exata_acima_de_2_53():
+    grupos = np.array([0, 0, 1, 0])
+    valores = np.array([2 ** 53, 1, 5, 1], dtype=np.int64)
+    assert somar_centavos(grupos, valores, 3).tolist() == [2 ** 53 + 2, 5, 0]
+
+
+def test_agregar_por_beneficiario_em_centavos():
+    utilizacao = pd.DataFrame({
+        'Nome_do_Associado': ['Ana', 'ANA ', 'Bruno', None],
+        'Valor': pd.array([2 ** 53, 1, 250, 999], dtype='Int64'),
+    })
+    beneficiarios = construir_dimensao_beneficiarios([utilizacao])
+    agregado = agregar_por_beneficiario(utilizacao, beneficiarios)
+    assert agregado['Nome_do_Associado'].tolist() == ['Ana', 'Bruno']
+    assert agregado['Valor'].tolist() == [2 ** 53 + 1, 250]
+    assert agregado['Volume'].tolist() == [2, 1]